@@ -0,0 +1,18 @@
+import importlib
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+# 数据文件写到临时目录，不碰仓库里的 posts.json / groups.json
+os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="bot_tests_")
+
+
+@pytest.fixture(scope="session")
+def bot():
+    return importlib.import_module("群发机器人")
@@ -0,0 +1,120 @@
+import asyncio
+from datetime import timedelta
+from types import SimpleNamespace
+
+import pytest
+
+
+class FakeJob:
+    def __init__(self, name, when):
+        self.name = name
+        self.when = when
+        self.removed = False
+
+    def schedule_removal(self):
+        self.removed = True
+
+
+class FakeJobQueue:
+    def __init__(self):
+        self.jobs_ = []
+
+    def run_once(self, callback, when, data=None, name=None):
+        self.jobs_.append(FakeJob(name, when))
+
+    def get_jobs_by_name(self, name):
+        return [j for j in self.jobs_ if j.name == name and not j.removed]
+
+
+@pytest.fixture
+def repo(bot, tmp_path, monkeypatch):
+    r = bot.PostRepo(bot.JsonStore(tmp_path / "posts.json", list))
+    monkeypatch.setattr(bot, "REPO", r)
+    monkeypatch.setattr(bot, "ARCHIVE_DIR", tmp_path / "archive")
+    return r
+
+
+def schedule_post(bot, pid, send_time, text="hello"):
+    return {"id": pid, "type": "schedule", "groups": ["-1"], "send_time": send_time.isoformat(),
+            "content": {"type": "text", "text": text}, "enabled": True, "job_name": f"schedule_{pid}"}
+
+
+def daily_post(pid, text="daily"):
+    return {"id": pid, "type": "daily", "groups": ["-1"], "recurrence": {"kind": "daily", "time": "09:00:00"},
+            "content": {"type": "text", "text": text}, "enabled": True, "job_name": f"daily_{pid}"}
+
+
+def test_done_at_stamped_then_archived_after_window(bot, repo, monkeypatch):
+    now = bot.now_local()
+    repo.insert(schedule_post(bot, "old", now - timedelta(hours=1), "Summer sale"))
+    repo.insert(schedule_post(bot, "future", now + timedelta(days=1)))
+    repo.insert(daily_post("live"))
+
+    assert bot.archive_posts(now) == []
+    assert repo.get("old")["done_at"] == now.timestamp()
+    assert "done_at" not in repo.get("future") and "done_at" not in repo.get("live")
+
+    early = now + timedelta(hours=bot.ARCHIVE_AFTER_HOURS - 1)
+    assert bot.archive_posts(early) == []
+
+    later = now + timedelta(hours=bot.ARCHIVE_AFTER_HOURS)
+    jq = FakeJobQueue()
+    jq.run_once(None, 0, name="schedule_old")
+    monkeypatch.setattr(bot, "now_local", lambda: later)
+    asyncio.run(bot.archive_posts_job(SimpleNamespace(job_queue=jq)))
+
+    assert [p["id"] for p in repo.all()] == ["future", "live"]
+    assert jq.jobs_[0].removed
+    bot.WRITER.flush()
+    bot.POSTS.flush()
+    segs = list(bot.ARCHIVE_DIR.glob("*.jsonl"))
+    assert [s.stem for s in segs] == [f"{later:%Y-%m}"]
+    rec = bot.json_loads(segs[0].read_bytes().splitlines()[0])
+    assert rec["reason"] == "done" and rec["post"]["id"] == "old"
+
+
+def test_search_by_text_and_id(bot, repo):
+    now = bot.now_local()
+    for pid, text in (("a1", "Summer SALE today"), ("b2", "winter news"), ("c3", "another sale")):
+        repo.insert(schedule_post(bot, pid, now - timedelta(days=3), text))
+        repo.get(pid)["done_at"] = now.timestamp() - 86400 * 2
+    assert len(bot.archive_posts(now)) == 3
+
+    hits, total = bot.search_archive("sale")
+    assert total == 2 and {h["post"]["id"] for h in hits} == {"a1", "c3"}
+    hits, total = bot.search_archive("B2")
+    assert total == 1 and hits[0]["post"]["content"]["text"] == "winter news"
+    assert bot.search_archive("", limit=2)[1] == 3
+    assert bot.find_archived("c3")["post"]["id"] == "c3"
+
+
+def test_restore_reinserts_and_reschedules(bot, repo):
+    now = bot.now_local()
+    ended = daily_post("d0")
+    ended["recurrence"]["end"] = (now - timedelta(days=3)).date().isoformat()
+    ended["next_fire"] = None
+    repo.insert(ended)
+    repo.insert(schedule_post(bot, "s1", now - timedelta(days=2)))
+    for p in repo.all():
+        p["done_at"] = now.timestamp() - 86400 * 2
+    assert len(bot.archive_posts(now)) == 2
+    assert repo.all() == []
+
+    # 已结束的帖子放回来是停用状态，不注册 job
+    jq = FakeJobQueue()
+    for pid in ("d0", "s1"):
+        post, scheduled = bot.restore_archived(jq, bot.find_archived(pid))
+        assert not scheduled and repo.get(pid)["enabled"] is False
+        assert "done_at" not in repo.get(pid) and repo.get(pid)["version"] == 1
+    assert jq.jobs_ == []
+
+    # 还有下一次发送的帖子恢复后重新排期
+    post, scheduled = bot.restore_archived(jq, {"archived_at": 0, "reason": "done", "post": daily_post("d1")})
+    assert scheduled and repo.get("d1")["enabled"] is True and repo.get("d1")["next_fire"]
+    assert [j.name for j in jq.jobs_] == ["daily_d1"]
+
+    # 归档前就停用的保持停用
+    off = daily_post("d2")
+    off["enabled"] = False
+    assert bot.restore_archived(jq, {"post": off}) == (repo.get("d2"), False)
+    assert len(jq.jobs_) == 1
@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+from telegram import Bot
+
+
+def test_concurrent_broadcasts_interleave_over_http(bot):
+    order = []
+
+    async def main():
+        api = bot.FakeBotApi(latency=0.005)
+        await api.start()
+        tg = Bot(bot.LOADTEST_TOKEN, base_url=f"http://127.0.0.1:{api.port}/bot")
+        try:
+            async with tg:
+                def action_for(name):
+                    async def action(cid):
+                        m = await tg.send_message(chat_id=int(cid), text=name)
+                        order.append(name)
+                        return {"chat_id": cid, "message_id": m.message_id}
+                    return action
+
+                b = bot.Broadcaster(workers=1)
+                big = bot.Broadcast("big", [str(-i) for i in range(1, 9)], action_for("big"), weight=2)
+                small = bot.Broadcast("small", ["-100", "-101", "-102"], action_for("small"))
+                b.submit(big)
+                b.submit(small)
+                await asyncio.gather(b.wait(big), b.wait(small))
+        finally:
+            api.stop()
+        return api
+
+    api = asyncio.run(main())
+    # 一个 worker 时严格按轮询：big 每轮取 weight=2 个，small 取 1 个；small 不用等 big 全部发完
+    assert order == ["big", "big", "small"] * 3 + ["big", "big"]
+    assert api.calls["sendMessage"] == 11
+
+
+@pytest.fixture
+def limits(bot, monkeypatch):
+    monkeypatch.setattr(bot, "MAX_ACTIVE_BROADCASTS", 2)
+    monkeypatch.setattr(bot, "MAX_QUEUED_SENDS", 10)
+
+
+def gated(bot, label, n, gate, lane=None):
+    async def action(cid):
+        await gate.wait()
+        return {"chat_id": cid}
+    kw = {"lane": lane} if lane is not None else {}
+    return bot.Broadcast(label, [str(-i) for i in range(1, n + 1)], action, **kw)
+
+
+def test_queue_when_slots_full_and_start_when_one_frees(bot, limits):
+    async def main():
+        b = bot.Broadcaster(workers=4)
+        gate_a, gate_other = asyncio.Event(), asyncio.Event()
+        a = gated(bot, "a", 1, gate_a)
+        c = gated(bot, "c", 1, gate_other)
+        d = gated(bot, "d", 1, gate_other)
+        urgent = gated(bot, "urgent", 1, gate_other, lane=bot.LANE_IMMEDIATE)
+        assert b.submit(a) and b.submit(c)
+        assert not b.submit(d)
+        assert (d.started, b.position(d)) == (False, 1)
+        assert not b.submit(urgent)
+        # 排队按 (通道, 到达顺序)：立即发送的插到定时任务前面
+        assert (b.position(urgent), b.position(d)) == (1, 2)
+
+        wait_a = asyncio.create_task(b.wait(a))
+        gate_a.set()
+        await wait_a
+        assert urgent.started and not d.started and b.position(d) == 1
+        assert [x.label for x in b.running] == ["c", "urgent"]
+
+        gate_other.set()
+        await asyncio.gather(b.wait(c), b.wait(urgent), b.wait(d))
+        assert d.started and d.sent == 1 and b.running == [] and b.waiting == []
+
+    asyncio.run(main())
+
+
+def test_queued_sends_cap(bot, limits):
+    async def main():
+        b = bot.Broadcaster(workers=2)
+        gate = asyncio.Event()
+        first = gated(bot, "first", 8, gate)
+        assert b.submit(first)
+        assert b.queued_sends() == 8
+        second = gated(bot, "second", 3, gate)   # 8 + 3 > 10：槽位有空也要排队
+        assert not b.submit(second) and b.position(second) == 1
+        gate.set()
+        await asyncio.gather(b.wait(first), b.wait(second))
+        assert second.sent == 3
+
+        # 没有进行中的群发时，再大的也直接开始
+        huge = gated(bot, "huge", 50, gate)
+        assert b.submit(huge)
+        await b.wait(huge)
+
+    asyncio.run(main())
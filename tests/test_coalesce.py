@@ -0,0 +1,46 @@
+def text_post(pid, text="x", buttons=None, delete_minutes=0):
+    return {"id": pid, "content": {"type": "text", "text": text}, "buttons": buttons,
+            "delete_minutes": delete_minutes}
+
+
+def ids(units):
+    return [u[2] for u in units]
+
+
+def test_merges_text_posts_with_buttons(bot):
+    units = bot.coalesce_units([text_post("a", "A", {"text": "1"}), text_post("b", "B"),
+                                text_post("c", "C", {"text": "3"})], mode="merge")
+    assert len(units) == 1
+    content, rows, src = units[0]
+    assert content == {"type": "text", "text": "A\n\nB\n\nC"}
+    assert rows == [{"text": "1"}, {"text": "3"}]
+    assert src == ["a", "b", "c"]
+
+
+def test_sequence_mode_and_photos_are_not_merged(bot):
+    posts = [text_post("a"), text_post("b")]
+    assert ids(bot.coalesce_units(posts, mode="sequence")) == [["a"], ["b"]]
+    photo = {"id": "p", "content": {"type": "photo", "photo_id": "f"}}
+    assert ids(bot.coalesce_units([text_post("a"), photo, text_post("b")], mode="merge")) == [["a"], ["p"], ["b"]]
+
+
+def test_different_delete_minutes_are_not_merged(bot):
+    posts = [text_post("a", delete_minutes=5), text_post("b", delete_minutes=10), text_post("c", delete_minutes=10)]
+    assert ids(bot.coalesce_units(posts, mode="merge")) == [["a"], ["b", "c"]]
+
+
+def test_text_limit(bot):
+    sep = len(bot.COALESCE_SEPARATOR)
+    head = "a" * (bot.TEXT_LIMIT - sep - 10)
+    fits = bot.coalesce_units([text_post("a", head), text_post("b", "b" * 10)], mode="merge")
+    assert ids(fits) == [["a", "b"]] and len(fits[0][0]["text"]) == bot.TEXT_LIMIT
+    over = bot.coalesce_units([text_post("a", head), text_post("b", "b" * 11), text_post("c", "c")], mode="merge")
+    assert ids(over) == [["a"], ["b", "c"]]
+
+
+def test_button_row_limit(bot):
+    n = bot.MERGE_MAX_BUTTON_ROWS
+    posts = [text_post(str(i), buttons={"text": str(i)}) for i in range(n + 1)]
+    units = bot.coalesce_units(posts, mode="merge")
+    assert ids(units) == [[str(i) for i in range(n)], [str(n)]]
+    assert len(units[0][1]) == n and units[1][1] == {"text": str(n)}
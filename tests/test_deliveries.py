@@ -0,0 +1,98 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+
+def make_index(bot, tmp_path):
+    return bot.DeliveryIndex(tmp_path / "deliveries.log")
+
+
+def reload(bot, idx):
+    bot.WRITER.flush()
+    fresh = bot.DeliveryIndex(idx.path)
+    fresh.load()
+    return fresh
+
+
+def test_forget_survives_restart(bot, tmp_path):
+    idx = make_index(bot, tmp_path)
+    idx.record("p", "r1", [{"chat_id": "-1", "message_id": 10}, {"chat_id": "-2", "message_id": 11}])
+    idx.record("p", "r2", [{"chat_id": "-1", "message_id": 12}])
+    idx.forget("p", "r1", {"-1"})
+    idx.forget("p", "r2")
+
+    fresh = reload(bot, idx)
+    assert [r["chat_id"] for r in fresh.messages("p", "r1")] == ["-2"]
+    assert fresh.messages("p", "r2") == []
+    assert [run for run, _, _ in fresh.runs("p")] == ["r1"]
+
+
+def sent(*pairs):
+    return [{"chat_id": c, "message_id": m} for c, m in pairs]
+
+
+def test_range_queries_stay_within_prefix(bot, tmp_path):
+    idx = make_index(bot, tmp_path)
+    idx.record("p", "r2", sent(("-2", 21), ("-1", 20)))
+    idx.record("p", "r1", sent(("-1", 10)))
+    idx.record("p1", "r9", sent(("-1", 90)))   # 前缀相同的帖子不能混进来
+    idx.record("p", "r1", [{"chat_id": "-1", "message_id": 11, "merged": True, "bot": "b2"}])
+
+    assert [(r["chat_id"], r["message_id"]) for r in idx.messages("p", "r2")] == [("-1", 20), ("-2", 21)]
+    [rec] = idx.messages("p", "r1")
+    assert rec == {"post_id": "p", "run_id": "r1", "chat_id": "-1", "message_id": 11, "ts": rec["ts"],
+                   "bot": "b2", "merged": True}
+    assert idx.messages("p", "r3") == []
+    assert [(run, n) for run, _, n in idx.runs("p")] == [("r1", 1), ("r2", 2)]
+    assert idx.latest_run("p") == "r2"
+    assert idx.latest_run("p0") is None
+    assert len(idx) == 4
+
+    fresh = reload(bot, idx)
+    assert fresh.messages("p", "r1")[0]["message_id"] == 11
+    assert len(fresh) == 4 and fresh.appended == 1   # 被覆盖的那一行
+
+
+def test_compact_drops_expired_and_rewrites_log(bot, tmp_path, monkeypatch):
+    idx = make_index(bot, tmp_path)
+    old = time.time() - (bot.DELIVERY_RETENTION_DAYS + 1) * 86400
+    monkeypatch.setattr(bot.time, "time", lambda: old)
+    idx.record("p", "old", sent(("-1", 1), ("-2", 2)))
+    monkeypatch.undo()
+    idx.record("p", "new", sent(("-1", 3)))
+    idx.record("p", "new", sent(("-1", 4)))
+    idx.record("q", "gone", sent(("-1", 5)))
+    idx.forget("q", "gone")
+
+    assert idx.compact() == 2
+    assert idx.appended == 0
+    assert [run for run, _, _ in idx.runs("p")] == ["new"]
+    bot.WRITER.flush()
+    assert idx.path.read_text(encoding="utf-8").count("\n") == 1
+    assert idx.compact() == 0
+
+    fresh = reload(bot, idx)
+    assert fresh.messages("p", "new")[0]["message_id"] == 4
+    assert fresh.runs("q") == [] and fresh.appended == 0
+
+
+def test_auto_delete_forgets_deleted_messages(bot, tmp_path, monkeypatch):
+    idx = make_index(bot, tmp_path)
+    monkeypatch.setattr(bot, "DELIVERIES", idx)
+    idx.record("p", "r1", sent(("-1", 10), ("-2", 11), ("-3", 12)))
+    idx.record("q", "r2", [{"chat_id": "-1", "message_id": 10, "merged": True}])
+
+    class FakeBot:
+        async def delete_message(self, chat_id, message_id, rate_limit_args=None):
+            if chat_id == -3:
+                raise RuntimeError("无权限")
+
+    msgs = [{"chat_id": cid, "message_id": mid, "deliveries": [("p", "r1")]} for cid, mid in (("-2", 11), ("-3", 12))]
+    msgs.append({"chat_id": "-1", "message_id": 10, "merged": True, "deliveries": [("p", "r1"), ("q", "r2")]})
+    monkeypatch.setattr(bot, "bulk_bot", lambda context: FakeBot())
+    asyncio.run(bot.delete_messages_job(SimpleNamespace(job=SimpleNamespace(data={"messages": msgs}))))
+
+    # 删除失败的 -3 还留着，可以再撤回
+    assert [r["chat_id"] for r in idx.messages("p", "r1")] == ["-3"]
+    assert idx.runs("q") == []
+    assert [r["chat_id"] for r in reload(bot, idx).messages("p", "r1")] == ["-3"]
@@ -0,0 +1,26 @@
+import asyncio
+
+import pytest
+
+
+@pytest.mark.parametrize("codec", ["stdlib", "orjson"])
+def test_flow_state_round_trip(bot, tmp_path, monkeypatch, codec):
+    codecs = bot.available_codecs()
+    if codec not in codecs:
+        pytest.skip(f"{codec} 未安装")
+    monkeypatch.setattr(bot, "CODEC", codecs[codec])
+    store = bot.FlowPersistence(tmp_path)
+    data = {"selected": {"-100", "-200"}, "step": "pick", "nested": [{"ids": frozenset({1})}]}
+
+    asyncio.run(store.update_user_data(42, data))
+    bot.WRITER.flush()
+    loaded = asyncio.run(bot.FlowPersistence(tmp_path).get_user_data())
+
+    assert loaded == {42: {"selected": {"-100", "-200"}, "step": "pick", "nested": [{"ids": {1}}]}}
+
+
+def test_flow_state_rejects_unknown_types(bot, tmp_path):
+    store = bot.FlowPersistence(tmp_path)
+    asyncio.run(store.update_user_data(7, {"bad": object()}))
+    bot.WRITER.flush()
+    assert not (tmp_path / "7.json").exists()
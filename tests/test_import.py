@@ -0,0 +1,89 @@
+import io
+import json
+
+import pytest
+
+
+def lines(*records):
+    return io.StringIO("".join((r if isinstance(r, str) else json.dumps(r, ensure_ascii=False)) + "\n" for r in records))
+
+
+def test_iter_jsonl_skips_blank_lines_and_reports_bad_json(bot):
+    out = list(bot.iter_jsonl(io.StringIO('{"a": 1}\n\n   \n{oops\n[2]\n')))
+    assert [(n, rec) for n, rec, err in out if err is None] == [(1, {"a": 1}), (5, [2])]
+    assert [n for n, _, err in out if err] == [4]
+
+
+def test_validate_group_record(bot):
+    assert bot.validate_group_record({"chat_id": -100123, "title": " 群 "}) == ("-100123", "群")
+    assert bot.validate_group_record({"chat_id": "-5"}) == ("-5", "group_-5")
+    for bad in ({"chat_id": "abc"}, {"title": "x"}, ["-1"]):
+        with pytest.raises(ValueError):
+            bot.validate_group_record(bad)
+
+
+def post_record(**kw):
+    rec = {"type": "schedule", "groups": ["-1"], "content": {"type": "text", "text": "hi"},
+           "send_time": "2099-01-01T08:00:00"}
+    rec.update(kw)
+    return rec
+
+
+def test_validate_post_record_normalises(bot):
+    post = bot.validate_post_record(post_record(id="p1", groups=[-1, "-2"], owner="7", weight=0))
+    assert post["id"] == "p1"
+    assert post["groups"] == ["-1", "-2"]
+    assert post["owner"] == 7 and post["weight"] == 1
+    assert post["job_name"] == "schedule_p1"
+    assert post["send_time"].startswith("2099-01-01T08:00:00")
+    assert post["enabled"] is True and post["delete_minutes"] == 0
+
+    daily = bot.validate_post_record(post_record(type="daily", send_time=None, daily_time="09:30"))
+    assert daily["recurrence"]["kind"] == "daily"
+
+
+@pytest.mark.parametrize("kw", [
+    {"type": "weekly"},
+    {"groups": []},
+    {"groups": ["x"]},
+    {"content": {"type": "text", "text": ""}},
+    {"content": {"type": "photo"}},
+    {"content": {"type": "video"}},
+    {"delete_minutes": -1},
+    {"delete_minutes": "soon"},
+    {"buttons": ["a"]},
+    {"send_time": "not a time"},
+    {"owner": "me"},
+    {"id": "a\tb"},
+    {"id": "a\nb"},
+    {"id": "a:b"},
+    {"id": "x" * 17},
+])
+def test_validate_post_record_rejects(bot, kw):
+    with pytest.raises(ValueError):
+        bot.validate_post_record(post_record(**kw))
+
+
+def test_import_jsonl_reports_bad_post_ids(bot):
+    chunks = []
+    fp = lines(post_record(id="ok_1-A"), post_record(id="a:b\tc\nd"), post_record(id="p" * 80), post_record())
+    stats = bot.import_jsonl("posts", fp, lambda c: chunks.append(list(c)))
+
+    assert stats["ok"] == 2 and stats["bad"] == 2
+    assert [e.split("：")[0] for e in stats["errors"]] == ["第 2 行", "第 3 行"]
+    imported = [p["id"] for c in chunks for p in c]
+    assert imported[0] == "ok_1-A" and bot.POST_ID_RE.fullmatch(imported[1])
+
+
+def test_import_jsonl_applies_in_bounded_chunks(bot, monkeypatch):
+    monkeypatch.setattr(bot, "IMPORT_CHUNK", 3)
+    monkeypatch.setattr(bot, "IMPORT_ERROR_SHOW", 2)
+    recs = [{"chat_id": -i} for i in range(1, 8)]
+    fp = lines(recs[0], "{bad", recs[1], {"chat_id": "x"}, *recs[2:], "[]")
+    chunks = []
+    stats = bot.import_jsonl("groups", fp, lambda c: chunks.append(list(c)))
+
+    assert [len(c) for c in chunks] == [3, 3, 1]
+    assert [cid for c in chunks for cid, _ in c] == [str(-i) for i in range(1, 8)]
+    assert stats["ok"] == 7 and stats["bad"] == 3
+    assert len(stats["errors"]) == 2 and stats["errors"][0].startswith("第 2 行")
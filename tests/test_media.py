@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+
+
+@pytest.mark.parametrize("src", ["/etc/passwd", "../.env", "sub/../../x.png"])
+def test_media_source_path_stays_in_directory(bot, src):
+    with pytest.raises(ValueError):
+        bot.media_source_path(src)
+
+
+def test_media_source_path_allows_files_in_directory(bot):
+    root = bot.MEDIA_SOURCE_DIR.resolve()
+    assert bot.media_source_path("banner.png") == root / "banner.png"
+
+
+@pytest.mark.parametrize("url", [
+    "http://127.0.0.1/a.png",
+    "http://localhost:8080/a.png",
+    "http://10.0.0.5/a.png",
+    "http://169.254.169.254/latest/meta-data",
+    "http://[::1]/a.png",
+    "ftp://example.com/a.png",
+])
+def test_check_public_url_rejects_internal_targets(bot, url):
+    with pytest.raises(ValueError):
+        asyncio.run(bot.check_public_url(url))
+
+
+def test_check_public_url_allows_public_ip(bot):
+    asyncio.run(bot.check_public_url("https://1.1.1.1/a.png"))
+
+
+def test_download_connects_to_the_checked_address(bot, monkeypatch):
+    """连接用 check_public_url 返回的地址，不再自己解析域名（media.invalid 根本解析不了）"""
+    seen = {}
+
+    async def serve(reader, writer):
+        head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1")
+        seen["host"] = next(h.split(":", 1)[1].strip() for h in head.split("\r\n") if h.lower().startswith("host:"))
+        path = head.split(" ")[1]
+        if path == "/old":
+            writer.write(b"HTTP/1.1 302 Found\r\nLocation: /new.png\r\nContent-Length: 0\r\n\r\n")
+        else:
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\nPNG!")
+        await writer.drain()
+        writer.close()
+
+    checked = []
+
+    async def fake_check(url):
+        checked.append(url)
+        return "127.0.0.1"
+
+    monkeypatch.setattr(bot, "check_public_url", fake_check)
+
+    async def main():
+        server = await asyncio.start_server(serve, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            return port, await bot.read_media_source(f"http://media.invalid:{port}/old")
+        finally:
+            server.close()
+
+    port, data = asyncio.run(main())
+    assert data == b"PNG!"
+    assert seen["host"] == f"media.invalid:{port}"
+    assert checked == [f"http://media.invalid:{port}/old", f"http://media.invalid:{port}/new.png"]
+
+
+def test_validate_media_persists_cached_file_id_through_repo(bot, tmp_path, monkeypatch):
+    repo = bot.PostRepo(bot.JsonStore(tmp_path / "posts.json", list))
+    monkeypatch.setattr(bot, "REPO", repo)
+    monkeypatch.setattr(bot, "MEDIA_CACHE", bot.JsonStore(tmp_path / "media.json", dict))
+    bot.MEDIA_CACHE.set({"h1": {"file_id": "new", "checked": 0}})
+    repo.insert({"id": "p", "content": {"type": "photo", "photo_id": "old", "media": "h1"}})
+    live = repo.get("p")
+
+    class FakeBot:
+        async def get_file(self, fid, rate_limit_args=None):
+            assert fid == "new"
+
+    assert asyncio.run(bot.validate_media(FakeBot(), live))
+    assert live["content"]["photo_id"] == "old"   # 不原地改
+    assert repo.get("p")["content"]["photo_id"] == "new"
+    assert repo.get("p")["version"] == 2
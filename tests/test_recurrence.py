@@ -0,0 +1,79 @@
+from datetime import datetime
+
+import pytest
+
+
+@pytest.fixture
+def at(bot):
+    def make(*args):
+        return datetime(*args, tzinfo=bot.LOCAL_TZ)
+    return make
+
+
+def test_parse_recurrence_forms(bot):
+    assert bot.parse_recurrence("20点30") == {"kind": "daily", "time": "20:30:00"}
+    assert bot.parse_recurrence("周一三五 9点") == {"kind": "weekly", "days": [1, 3, 5], "time": "09:00:00"}
+    assert bot.parse_recurrence("星期1,7 20:30")["days"] == [1, 7]
+    assert bot.parse_recurrence("cron 0  20 * * 1-5") == {"kind": "cron", "expr": "0 20 * * 1-5"}
+    rec = bot.parse_recurrence("每4小时")
+    assert rec["kind"] == "interval" and rec["hours"] == 4 and rec["anchor"]
+
+    ranged = bot.parse_recurrence("20:30 2025/12/01-2025/12/31")
+    assert (ranged["start"], ranged["end"]) == ("2025-12-01", "2025-12-31")
+    assert bot.parse_recurrence("20:30 ~2025/12/31") == {"kind": "daily", "time": "20:30:00", "end": "2025-12-31"}
+
+
+@pytest.mark.parametrize("text", ["", "明天", "周八 20:30", "cron 0 20 * *", "cron 61 * * * *",
+                                  "每0小时", "20:30 2025/12/31-2025/12/01"])
+def test_parse_recurrence_rejects(bot, text):
+    assert bot.parse_recurrence(text) is None
+
+
+def test_parse_cron_fields(bot):
+    minutes, hours, doms, months, dows, dom_any, dow_any = bot.parse_cron("*/15 9-11 1,15 * 7")
+    assert minutes == (0, 15, 30, 45)
+    assert hours == (9, 10, 11)
+    assert doms == {1, 15} and len(months) == 12
+    assert dows == {0}  # 7 与 0 都是周日
+    assert (dom_any, dow_any) == (False, False)
+    with pytest.raises(ValueError):
+        bot.parse_cron("0 0 * * 1/0")
+
+
+def test_next_fire_daily_and_weekly(bot, at):
+    daily = {"kind": "daily", "time": "20:30:00"}
+    assert bot.next_fire_after(daily, at(2025, 12, 1, 10, 0)) == at(2025, 12, 1, 20, 30)
+    assert bot.next_fire_after(daily, at(2025, 12, 1, 20, 30)) == at(2025, 12, 2, 20, 30)
+
+    weekly = {"kind": "weekly", "days": [1, 5], "time": "09:00:00"}  # 2025-12-01 是周一
+    assert bot.next_fire_after(weekly, at(2025, 12, 1, 9, 0)) == at(2025, 12, 5, 9, 0)
+    assert bot.next_fire_after(weekly, at(2025, 12, 5, 10, 0)) == at(2025, 12, 8, 9, 0)
+
+
+def test_next_fire_interval(bot, at):
+    rec = {"kind": "interval", "hours": 4, "anchor": at(2025, 12, 1, 8, 0).isoformat()}
+    assert bot.next_fire_after(rec, at(2025, 12, 1, 7, 0)) == at(2025, 12, 1, 8, 0)
+    assert bot.next_fire_after(rec, at(2025, 12, 1, 8, 0)) == at(2025, 12, 1, 12, 0)
+    assert bot.next_fire_after(rec, at(2025, 12, 2, 1, 0)) == at(2025, 12, 2, 4, 0)
+
+
+def test_next_fire_cron(bot, at):
+    weekdays = {"kind": "cron", "expr": "0 20 * * 1-5"}
+    assert bot.next_fire_after(weekdays, at(2025, 12, 5, 20, 0)) == at(2025, 12, 8, 20, 0)
+    # 日和周都限定时满足其一即可：13 号或周五
+    either = {"kind": "cron", "expr": "30 8 13 * 5"}
+    assert bot.next_fire_after(either, at(2025, 12, 1, 0, 0)) == at(2025, 12, 5, 8, 30)
+    assert bot.next_fire_after(either, at(2025, 12, 12, 9, 0)) == at(2025, 12, 13, 8, 30)
+    assert bot.next_fire_after({"kind": "cron", "expr": "0 0 30 2 *"}, at(2025, 1, 1, 0, 0)) is None
+
+
+def test_next_fire_respects_date_range(bot, at):
+    rec = {"kind": "daily", "time": "20:30:00", "start": "2025-12-10", "end": "2025-12-11"}
+    assert bot.next_fire_after(rec, at(2025, 12, 1, 0, 0)) == at(2025, 12, 10, 20, 30)
+    assert bot.next_fire_after(rec, at(2025, 12, 11, 20, 30)) is None
+
+
+def test_describe_recurrence(bot):
+    assert bot.describe_recurrence(None) == "（无）"
+    assert bot.describe_recurrence({"kind": "weekly", "days": [1, 7], "time": "09:00:00"}) == "每周一、日 09:00"
+    assert bot.describe_recurrence({"kind": "interval", "hours": 4, "end": "2025-12-31"}) == "每 4 小时（… ~ 2025-12-31）"
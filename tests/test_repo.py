@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def repo(bot, tmp_path):
+    r = bot.PostRepo(bot.JsonStore(tmp_path / "posts.json", list))
+    r.insert({"id": "p", "content": {"type": "text", "text": "v1"}})
+    return r
+
+
+def test_transactions_on_one_post_are_serialised(repo):
+    log = []
+
+    async def edit(name, text):
+        async with repo.transaction("p") as post:
+            log.append(f"{name} in")
+            await asyncio.sleep(0.01)
+            post["content"]["text"] = text
+            log.append(f"{name} out")
+
+    async def main():
+        await asyncio.gather(edit("a", "A"), edit("b", "B"))
+
+    asyncio.run(main())
+    assert log == ["a in", "a out", "b in", "b out"]
+    assert repo.get("p")["content"]["text"] == "B"
+    assert repo.get("p")["version"] == 3
+    assert repo._locks == {}
+
+
+def test_stale_update_raises_conflict(bot, repo):
+    async def main():
+        await repo.update("p", lambda p: p.update(enabled=False), expected_version=1)
+        with pytest.raises(bot.ConflictError):
+            await repo.update("p", lambda p: p.update(enabled=True), expected_version=1)
+
+    asyncio.run(main())
+    assert repo.get("p")["enabled"] is False and repo.get("p")["version"] == 2
+    assert repo.conflicts == 1
+
+
+def test_exception_inside_transaction_leaves_record_unchanged(repo):
+    async def main():
+        async with repo.transaction("p") as post:
+            post["content"]["text"] = "half-done"
+            raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(main())
+    assert repo.get("p") == {"id": "p", "content": {"type": "text", "text": "v1"}, "version": 1}
+
+
+def test_delete_keeps_lock_for_waiters(bot, repo):
+    log = []
+
+    async def holder(release):
+        async with repo.transaction("p"):
+            await release.wait()
+
+    async def waiter():
+        try:
+            await repo.update("p", lambda p: p.update(content={"type": "text", "text": "late"}))
+        except bot.ConflictError:
+            log.append("waiter conflict")
+        async with repo.lock("p"):
+            log.append("waiter in")
+            await asyncio.sleep(0.01)
+            log.append("waiter out")
+
+    async def delete_then_newcomer():
+        await repo.delete("p")
+        # 删除刚完成、等待者还没拿到锁时进来的新请求必须排在它后面
+        async with repo.lock("p"):
+            log.append("newcomer in")
+            await asyncio.sleep(0.01)
+            log.append("newcomer out")
+
+    async def main():
+        release = asyncio.Event()
+        h = asyncio.create_task(holder(release))
+        await asyncio.sleep(0)
+        d = asyncio.create_task(delete_then_newcomer())
+        w = asyncio.create_task(waiter())
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(h, d, w)
+
+    asyncio.run(main())
+    assert log[0] == "waiter conflict"
+    assert log[1:] in (["waiter in", "waiter out", "newcomer in", "newcomer out"],
+                       ["newcomer in", "newcomer out", "waiter in", "waiter out"])
+    assert repo.get("p") is None and repo.all() == []
+    assert repo._locks == {}
+
+
+def test_upsert_many_bumps_versions(repo):
+    n = repo.upsert_many([{"id": "p", "content": {}}, {"id": "q", "content": {}}])
+    assert n == 2
+    assert [(p["id"], p["version"]) for p in repo.all()] == [("p", 2), ("q", 1)]
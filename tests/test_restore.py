@@ -0,0 +1,48 @@
+import asyncio
+from datetime import timedelta
+
+
+class FakeJob:
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeJobQueue:
+    def __init__(self, names=()):
+        self._jobs = [FakeJob(n) for n in names]
+
+    def jobs(self):
+        return list(self._jobs)
+
+    def run_once(self, callback, when, data=None, name=None):
+        self._jobs.append(FakeJob(name))
+
+
+def test_only_posts_due_within_horizon_are_registered(bot, tmp_path, monkeypatch):
+    repo = bot.PostRepo(bot.JsonStore(tmp_path / "posts.json", list))
+    monkeypatch.setattr(bot, "REPO", repo)
+    now = bot.now_local()
+
+    def sched(pid, hours, **kw):
+        return {"id": pid, "type": "schedule", "send_time": (now + timedelta(hours=hours)).isoformat(),
+                "job_name": f"schedule_{pid}", **kw}
+
+    posts = [
+        sched("soon", 1),
+        sched("later", 30),
+        sched("off", 1, enabled=False),
+        sched("known", 1),
+        sched("past", -1),
+        {"id": "d", "type": "daily", "recurrence": {"kind": "interval", "hours": 2, "anchor": now.isoformat()}},
+    ]
+    jq = FakeJobQueue(["schedule_known"])
+    registered, deferred = asyncio.run(bot.register_due_posts(jq, posts, now + timedelta(hours=6)))
+
+    assert (registered, deferred) == (2, 1)
+    assert sorted(j.name for j in jq.jobs()) == ["daily_d", "schedule_known", "schedule_soon"]
+    assert posts[-1]["next_fire"]
+
+    # 窗口往后推之后补注册
+    registered, deferred = asyncio.run(bot.register_due_posts(jq, posts, now + timedelta(hours=31)))
+    assert (registered, deferred) == (1, 0)
+    assert "schedule_later" in {j.name for j in jq.jobs()}
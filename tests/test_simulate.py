@@ -0,0 +1,37 @@
+import math
+from datetime import timedelta
+
+
+def run_one(bot, groups, **kw):
+    start = bot.now_local()
+    state = bot.simulate_timeline([{"key": "a", "start": start, "groups": groups}], **kw)
+    return (state["a"]["end"] - start).total_seconds(), state["a"]
+
+
+def test_single_busy_group_respects_per_minute_limit(bot):
+    n, per_min = 100, 20
+    secs, st = run_one(bot, ["-1001"] * n, rate=25, group_rate=per_min, workers=8, latency_ms=100)
+    minutes = math.ceil(n / per_min)
+    # 第 k 批在 (k-1) 分钟时发出：100 条 / 20 每分钟 → 最后一批约在第 4 分钟
+    assert (minutes - 1) * 60 <= secs < (minutes - 1) * 60 + 5
+    assert st["throttled"] == n - per_min
+    assert st["left"] == 0
+
+
+def test_shared_group_between_two_runs(bot):
+    start = bot.now_local()
+    runs = [
+        {"key": "a", "start": start, "groups": ["-1001"] * 15},
+        {"key": "b", "start": start + timedelta(seconds=1), "groups": ["-1001"] * 15},
+    ]
+    state = bot.simulate_timeline(runs, rate=25, group_rate=20, workers=8, latency_ms=100)
+    last = max(st["end"] for st in state.values())
+    # 30 条发往同一个群：第二分钟才能发完
+    assert (last - start).total_seconds() >= 60
+    assert sum(st["throttled"] for st in state.values()) == 10
+
+
+def test_distinct_groups_limited_by_global_rate(bot):
+    secs, st = run_one(bot, [f"-100{i}" for i in range(100)], rate=25, group_rate=20, workers=8, latency_ms=100)
+    assert st["throttled"] == 0
+    assert 3.5 <= secs <= 4.5
@@ -0,0 +1,37 @@
+import asyncio
+import threading
+
+
+def test_json_store_encodes_on_writer_thread_from_snapshot(bot, tmp_path, monkeypatch):
+    store = bot.JsonStore(tmp_path / "posts.json", list)
+    threads = []
+    real_dumps = bot.json_dumps
+
+    def spy(obj, pretty=False):
+        threads.append(threading.current_thread().name)
+        return real_dumps(obj, pretty)
+
+    monkeypatch.setattr(bot, "json_dumps", spy)
+    monkeypatch.setattr(bot, "FLUSH_DELAY", 0)
+
+    async def main():
+        posts = [{"id": "p", "next_fire": "a"}]
+        store.set(posts)
+        await asyncio.sleep(0.01)          # 到点：做快照交给写盘线程
+        posts[0]["next_fire"] = "b"        # 快照之后的原地修改不影响这次写入
+        posts.append({"id": "q"})
+        bot.WRITER.flush()
+
+    asyncio.run(main())
+    assert threads == ["file-writer"]
+    assert bot.json_loads((tmp_path / "posts.json").read_bytes()) == [{"id": "p", "next_fire": "a"}]
+
+
+def test_superseded_writes_are_never_encoded(bot, tmp_path):
+    path = tmp_path / "x.json"
+    calls = []
+    with bot.WRITER._cond:   # 拿住锁，保证两次提交在写盘线程取走之前合并
+        bot.WRITER.submit(path, lambda: calls.append(1) or b"1")
+        bot.WRITER.submit(path, lambda: calls.append(2) or b"2")
+    bot.WRITER.flush()
+    assert calls == [2] and path.read_bytes() == b"2"
@@ -0,0 +1,79 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+from telegram import CallbackQuery, Chat, Message, Update, User
+
+ADMIN = 1001
+
+
+@pytest.fixture(autouse=True)
+def admins(bot, monkeypatch):
+    monkeypatch.setattr(bot, "ADMIN_IDS", {ADMIN})
+
+
+def message(update_id, user_id, text="hi", chat_type="private"):
+    user = User(user_id, "u", False)
+    chat = Chat(user_id if chat_type == "private" else -100, chat_type)
+    msg = Message(update_id, datetime.now(timezone.utc), chat, from_user=user, text=text)
+    return Update(update_id, message=msg)
+
+
+def callback(update_id, user_id):
+    user = User(user_id, "u", False)
+    msg = Message(1, datetime.now(timezone.utc), Chat(user_id, "private"), text="menu")
+    return Update(update_id, callback_query=CallbackQuery(str(update_id), user, "c", message=msg, data="x"))
+
+
+def test_duplicates_are_dropped_within_window(bot):
+    gate = bot.UpdateGate(size=3)
+    assert gate.admit(message(1, ADMIN))
+    assert not gate.admit(message(1, ADMIN))
+    for uid in (2, 3, 4):   # 1 被挤出窗口
+        assert gate.admit(message(uid, ADMIN))
+    assert gate.admit(message(1, ADMIN))
+    assert not gate.admit(message(4, ADMIN))
+    assert len(gate._seen) == 3
+    assert gate.duplicates == 2
+
+
+def test_non_admins_only_reach_public_commands(bot):
+    gate = bot.UpdateGate()
+    assert gate.admit(message(1, ADMIN, "📢 立即发送"))
+    assert gate.admit(callback(2, ADMIN))
+    assert gate.admit(message(3, ADMIN, "hello", chat_type="supergroup"))
+
+    assert not gate.admit(message(4, 7, "📢 立即发送"))
+    assert not gate.admit(callback(5, 7))
+    assert not gate.admit(message(6, 7, "hello", chat_type="supergroup"))
+    assert not gate.admit(message(7, 7, "/start", chat_type="supergroup"))
+
+    assert gate.admit(message(8, 7, "/id"))
+    assert gate.admit(message(9, 7, "/id@SomeBot", chat_type="supergroup"))
+    assert gate.admit(message(10, 7, "/start"))
+    assert (gate.admitted, gate.filtered) == (6, 4)
+
+
+def test_updates_serialised_per_user_concurrent_across_users(bot):
+    proc = bot.PerUserUpdateProcessor(8)
+    active = {}
+    peak = {"all": 0}
+    overlap = []
+
+    async def handle(update):
+        uid = update.effective_user.id
+        if active.get(uid):
+            overlap.append(uid)
+        active[uid] = active.get(uid, 0) + 1
+        peak["all"] = max(peak["all"], sum(active.values()))
+        await asyncio.sleep(0.01)
+        active[uid] -= 1
+
+    async def main():
+        updates = [message(i, 10 + i % 2) for i in range(6)]
+        await asyncio.gather(*(proc.process_update(u, handle(u)) for u in updates))
+
+    asyncio.run(main())
+    assert overlap == []
+    assert peak["all"] == 2
+    assert proc._locks == {}
@@ -7,30 +7,66 @@
 # - 私聊：群管理（查看/删除/清空）
 # - 私聊：立即发送（选群 -> 选择删除分钟 -> 按钮配置 -> 发内容）
 # - 私聊：定时发送（选群 -> 输入时间 -> 删除分钟 -> 按钮配置 -> 发内容）
-# - 私聊：每日循环（选群 -> 输入时间 -> 删除分钟 -> 按钮配置 -> 发内容）
+# - 私聊：循环发送（选群 -> 输入循环规则 -> 删除分钟 -> 按钮配置 -> 发内容）
+#   规则：每天 / 每周几 / 每N小时 / cron，可限定日期范围；下次触发时间预先计算并保存
 # - 我的帖子：查看/编辑内容/删除/启停（按钮也会随任务发出）
-# - 重启恢复 schedule/daily 任务（从 posts.json）
+# - 重启恢复 schedule/daily 任务（从 posts.json，Webhook 启动后在后台分批恢复）
+# - 批量导入/导出：私聊 /export 下载、上传 groups*.jsonl / posts*.jsonl 导入；
+#   命令行：python 群发机器人.py export|import groups|posts [文件]
 # ============================================================
 
+import io
 import os
 import re
+import sys
 import json
+import time
 import uuid
+import heapq
+import asyncio
+import atexit
 import logging
+import threading
+import argparse
+import hashlib
+import array
+import tempfile
+import shutil
+import socket
+import ipaddress
+import urllib.parse
+import cProfile
+import pstats
+import bisect
+import copy
+import contextlib
+import importlib.util
+from collections import deque
+from functools import lru_cache
 from pathlib import Path
-from datetime import datetime, timedelta, timezone, time as dtime
-from typing import Optional, Dict, List, Any, Set
+from datetime import date, datetime, timedelta, timezone, time as dtime
+from typing import Optional, Dict, List, Any, Set, Tuple, Callable, TextIO, Union
 
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InputMediaPhoto,
     ReplyKeyboardMarkup,
     ReplyKeyboardRemove,
     CopyTextButton,  # PTB v21.7+
 )
+import httpcore
+import httpx
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError, TimedOut
+from telegram.request import BaseRequest, HTTPXRequest
 from telegram.ext import (
     Application,
+    BasePersistence,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
+    ExtBot,
+    PersistenceInput,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
@@ -44,6 +80,8 @@ from telegram.ext import (
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
 WEBHOOK_BASE = os.getenv("WEBHOOK_BASE", "").strip()  # https://xxxx.up.railway.app
 PORT = int(os.getenv("PORT", "8080"))
+# 自建 Bot API 服务 / 负载测试替身，如 http://127.0.0.1:8081/bot；不填则直连 Telegram
+BOT_API_URL = os.getenv("BOT_API_URL", "").strip()
 
 # 时区：默认柬埔寨 +7；要改成 +8 就设置 TZ_OFFSET=8
 TZ_OFFSET = int(os.getenv("TZ_OFFSET", "7"))
@@ -65,13 +103,25 @@ logging.basicConfig(
     level=logging.INFO,
 )
 logger = logging.getLogger("BG678WebhookBot")
+# APScheduler 每注册一个 job 都打一行 INFO，任务多时拖慢启动
+logging.getLogger("apscheduler").setLevel(logging.WARNING)
+# httpx 每个请求一行 INFO，群发时日志量和开销都很大
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # =========================
-# 数据文件（跟脚本同目录）
+# 数据文件（默认跟脚本同目录；DATA_DIR 可另指目录）
 # =========================
-BASE_DIR = Path(__file__).resolve().parent
+BASE_DIR = Path(os.getenv("DATA_DIR", "").strip() or Path(__file__).resolve().parent)
 GROUPS_FILE = BASE_DIR / "groups.json"
 POSTS_FILE = BASE_DIR / "posts.json"
+SENDERS_FILE = BASE_DIR / "senders.json"
+FLOWS_DIR = BASE_DIR / "flows"   # 进行中的操作流程，每个用户一个文件
+DELIVERIES_FILE = BASE_DIR / "deliveries.log"
+METRICS_FILE = BASE_DIR / "metrics.json"
+MEDIA_FILE = BASE_DIR / "media.json"
+MEDIA_DIR = BASE_DIR / "media"   # 图片原文件（按内容 sha256 命名），file_id 失效时用来重新上传
+PID_FILE = BASE_DIR / "bot.pid"   # 机器人运行期间存在；命令行导入据此拒绝和运行中的机器人同时写数据文件
+ARCHIVE_DIR = BASE_DIR / "archive"   # 已归档的帖子，按月一个 JSONL 文件，只追加
 
 # =========================
 # 状态机 Key
@@ -100,6 +150,16 @@ S_ASK_URL_BTN_TEXT = "ask_url_btn_text"
 S_ASK_URL_VALUE = "ask_url_value"
 
 S_AWAIT_CONTENT = "await_content"
+DRY_RUN_WORDS = ("预演", "/dryrun")
+
+RECURRENCE_PROMPT = (
+    "请输入循环规则：\n"
+    "✅ 每天：20:30 / 20点30 / 9点\n"
+    "✅ 每周几：周1,3,5 20:30 / 周一三五 9点（1=周一 … 7=周日）\n"
+    "✅ 每N小时：每4小时（从现在开始计）\n"
+    "✅ cron：cron 0 20 * * 1-5（分 时 日 月 周）\n"
+    "可在末尾加日期范围：2025/12/01-2025/12/31 或 ~2025/12/31"
+)
 
 # =========================
 # 菜单
@@ -116,7 +176,7 @@ SEND_MENU = ReplyKeyboardMarkup(
     [
         ["🚀 立即发送"],
         ["⏰ 定时发送"],
-        ["🔁 每日循环发送"],
+        ["🔁 循环发送"],
         ["⬅️ 返回菜单"],
     ],
     resize_keyboard=True
@@ -134,29 +194,534 @@ def now_local() -> datetime:
 def gen_id() -> str:
     return uuid.uuid4().hex[:8]
 
-def load_groups() -> Dict[str, str]:
-    if GROUPS_FILE.exists():
+_last_run_ms = 0
+
+def gen_run_id() -> str:
+    """严格递增的批次 ID（12 位十六进制毫秒数），字符串排序 = 时间顺序"""
+    global _last_run_ms
+    _last_run_ms = max(time.time_ns() // 1_000_000, _last_run_ms + 1)
+    return f"{_last_run_ms:012x}"
+
+# =========================
+# JSON 编解码：装了 orjson 就用（快数倍），否则用标准库；数据结构不变
+# =========================
+JSON_CODEC = os.getenv("JSON_CODEC", "auto")         # auto / orjson / stdlib
+JSON_COMPACT = os.getenv("JSON_COMPACT", "0") == "1"  # 数据文件不缩进：更小更快，但不便手工查看
+
+class StdlibCodec:
+    name = "stdlib"
+
+    @staticmethod
+    def dumps(obj: Any, pretty: bool = False) -> bytes:
+        if pretty:
+            return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    @staticmethod
+    def loads(data) -> Any:
+        return json.loads(data)
+
+class OrjsonCodec:
+    name = "orjson"
+
+    def __init__(self, mod):
+        self._mod = mod
+
+    def dumps(self, obj: Any, pretty: bool = False) -> bytes:
+        opt = self._mod.OPT_NON_STR_KEYS | (self._mod.OPT_INDENT_2 if pretty else 0)
+        return self._mod.dumps(obj, option=opt)
+
+    def loads(self, data) -> Any:
+        return self._mod.loads(data)
+
+def available_codecs() -> Dict[str, Any]:
+    codecs: Dict[str, Any] = {"stdlib": StdlibCodec()}
+    if importlib.util.find_spec("orjson") is not None:
+        import orjson
+        codecs["orjson"] = OrjsonCodec(orjson)
+    return codecs
+
+def pick_codec(name: str = JSON_CODEC):
+    codecs = available_codecs()
+    if name == "auto":
+        return codecs.get("orjson") or codecs["stdlib"]
+    if name not in codecs:
+        logger.warning(f"JSON_CODEC={name} 不可用（pip install {name}?），改用标准库")
+        return codecs["stdlib"]
+    return codecs[name]
+
+CODEC = pick_codec()
+
+def json_dumps(obj: Any, pretty: bool = False) -> bytes:
+    return CODEC.dumps(obj, pretty)
+
+def json_loads(data) -> Any:
+    return CODEC.loads(data)
+
+# =========================
+# 持久化：读走内存，写由后台线程合并落盘（临时文件 + 原子替换）
+# =========================
+FLUSH_DELAY = float(os.getenv("FLUSH_DELAY", "0.5"))  # 多次保存合并成一次写盘的等待秒数
+
+def atomic_write_bytes(path: Path, data: bytes):
+    tmp = path.with_name(f".{path.name}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+class FileWriter:
+    """
+    单个后台写盘线程；同一路径整体写入 / 删除只保留最新一次，追加按提交顺序合并。
+    整体写入可以传一个返回 bytes 的函数：序列化也放到写盘线程里做，被后来的写入覆盖时干脆不做。
+    """
+
+    def __init__(self):
+        self._pending: Dict[Path, List[Tuple[str, Any]]] = {}
+        self._busy = False
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def _enqueue(self, path: Path, mode: str, data: Any):
+        with self._cond:
+            ops = self._pending.setdefault(path, [])
+            if mode in ("w", "d"):
+                ops[:] = [(mode, data)]
+            elif ops and ops[-1][0] == "a":
+                ops[-1] = ("a", ops[-1][1] + data)
+            else:
+                ops.append(("a", data))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="file-writer", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def submit(self, path: Path, data: Union[bytes, Callable[[], bytes]]):
+        self._enqueue(path, "w", data)
+
+    def append(self, path: Path, data: bytes):
+        self._enqueue(path, "a", data)
+
+    def delete(self, path: Path):
+        self._enqueue(path, "d", b"")
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                batch, self._pending = self._pending, {}
+                self._busy = True
+            for path, ops in batch.items():
+                for mode, data in ops:
+                    try:
+                        if mode == "w":
+                            atomic_write_bytes(path, data() if callable(data) else data)
+                        elif mode == "d":
+                            path.unlink(missing_ok=True)
+                        else:
+                            with open(path, "ab") as f:
+                                f.write(data)
+                    except Exception as e:
+                        logger.error(f"[写盘失败] {path} err={e}")
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
+
+    def flush(self, timeout: float = 10.0) -> bool:
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending and not self._busy, timeout)
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._pending) + (1 if self._busy else 0)
+
+WRITER = FileWriter()
+
+class JsonStore:
+    """
+    一个 JSON 文件的内存副本。get() 直接返回内存对象（调用方原地修改后 set() 即可）；
+    set() 在事件循环里只登记脏标记，FLUSH_DELAY 秒后做一份浅快照交给写盘线程序列化。
+    """
+
+    def __init__(self, path: Path, default: Callable[[], Any]):
+        self.path = path
+        self._default = default
+        self._data: Any = None
+        self._loaded = False
+        self._dirty = False
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+    def get(self) -> Any:
+        if not self._loaded:
+            self._data = self._read()
+            self._loaded = True
+        return self._data
+
+    def _read(self) -> Any:
+        if self.path.exists():
+            try:
+                return json_loads(self.path.read_bytes())
+            except Exception as e:
+                logger.error(f"{self.path.name} 解析失败：{e}")
+        return self._default()
+
+    def _snapshot(self) -> Any:
+        """
+        写盘线程用的快照：容器和其中每一项各浅拷贝一层，比序列化便宜得多。
+        各处只原地改到这一层（next_fire、checked 之类），更深的内容都是整条替换（REPO 事务提交副本）。
+        """
+        data = self._data
+        if isinstance(data, list):
+            return [dict(v) if isinstance(v, dict) else v for v in data]
+        if isinstance(data, dict):
+            return {k: dict(v) if isinstance(v, dict) else v for k, v in data.items()}
+        return data
+
+    def set(self, data: Any):
+        self._data = data
+        self._loaded = True
+        self._dirty = True
         try:
-            return json.loads(GROUPS_FILE.read_text(encoding="utf-8"))
-        except Exception as e:
-            logger.error(f"groups.json 解析失败：{e}")
-            return {}
-    return {}
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # 命令行 / 工作线程里没有事件循环：直接写完再返回
+            self.flush()
+            return
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(FLUSH_DELAY, self._submit)
+
+    def _submit(self):
+        self._flush_handle = None
+        if self._dirty:
+            self._dirty = False
+            snap = self._snapshot()
+            WRITER.submit(self.path, lambda: json_dumps(snap, pretty=not JSON_COMPACT))
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        self._submit()
+        WRITER.flush()
+
+GROUPS = JsonStore(GROUPS_FILE, dict)
+POSTS = JsonStore(POSTS_FILE, list)
+SENDER_ASSIGN = JsonStore(SENDERS_FILE, dict)   # {chat_id: 发送 bot id}
+MEDIA_CACHE = JsonStore(MEDIA_FILE, dict)       # {sha256: {"file_id", "checked", "source"}}
+STORES = [GROUPS, POSTS, SENDER_ASSIGN, MEDIA_CACHE]
+
+def flush_stores():
+    for st in STORES:
+        st.flush()
+
+atexit.register(flush_stores)
+
+def write_pid_file():
+    PID_FILE.write_text(str(os.getpid()), encoding="ascii")
+    atexit.register(lambda: PID_FILE.unlink(missing_ok=True))
+
+def running_bot_pid() -> Optional[int]:
+    """同一数据目录下正在运行的机器人进程号；没有（或 pid 文件是上次异常退出留下的）返回 None"""
+    try:
+        pid = int(PID_FILE.read_text(encoding="ascii").strip())
+    except (OSError, ValueError):
+        return None
+    if pid == os.getpid():
+        return None
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return None
+    except PermissionError:
+        pass  # 进程存在，只是属于别的用户
+    return pid
+
+def load_groups() -> Dict[str, str]:
+    return GROUPS.get()
 
 def save_groups(data: Dict[str, str]):
-    GROUPS_FILE.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    GROUPS.set(data)
 
 def load_posts() -> List[Dict[str, Any]]:
-    if POSTS_FILE.exists():
+    return POSTS.get()
+
+# =========================
+# 帖子仓库：按帖子加锁的读-改-写事务 + 版本号
+# =========================
+class ConflictError(ValueError):
+    """帖子在读取之后已被其他操作改过（版本号不一致）"""
+
+class PostRepo:
+    """
+    posts.json 上的事务层。POSTS 里的列表始终是同一个对象，增删改都原地进行；
+    每条帖子带 version，每次提交 +1：
+    - transaction(post_id)：持有该帖子的锁，在副本上改，退出时校验版本并整体替换；
+    - update(post_id, fn, expected_version)：比较版本号后再改（读取和写入之间有 await 的流程用）。
+    """
+
+    def __init__(self, store: JsonStore):
+        self.store = store
+        self._locks: Dict[str, List[Any]] = {}   # post_id -> [锁, 引用数]；持有和等待的都算，归零才删
+        self.conflicts = 0
+
+    def all(self) -> List[Dict[str, Any]]:
+        return self.store.get()
+
+    def get(self, post_id: str) -> Optional[Dict[str, Any]]:
+        return get_post(self.all(), post_id)
+
+    def _index(self, post_id: str) -> int:
+        return next((i for i, p in enumerate(self.all()) if p.get("id") == post_id), -1)
+
+    def busy(self, post_id: str) -> bool:
+        entry = self._locks.get(post_id)
+        return entry is not None and entry[0].locked()
+
+    @contextlib.asynccontextmanager
+    async def lock(self, post_id: str):
+        """持有该帖子的锁；还有人在等时锁一直保留（提前删掉的话后来者会另建一把，和等待者同时进入）"""
+        entry = self._locks.setdefault(post_id, [asyncio.Lock(), 0])
+        entry[1] += 1
         try:
-            return json.loads(POSTS_FILE.read_text(encoding="utf-8"))
-        except Exception as e:
-            logger.error(f"posts.json 解析失败：{e}")
-            return []
-    return []
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._locks.pop(post_id, None)
+
+    def _save(self):
+        self.store.set(self.all())
+
+    def save(self):
+        """只改了调度字段（job_name / next_fire）时用：落盘但不升版本"""
+        self._save()
+
+    def _commit(self, draft: Dict[str, Any], base: int):
+        i = self._index(draft.get("id"))
+        if i < 0:
+            raise ConflictError(f"帖子 {draft.get('id')} 已被删除")
+        cur = self.all()[i]
+        if int(cur.get("version", 0)) != base:
+            self.conflicts += 1
+            raise ConflictError(f"帖子 {draft.get('id')} 已被修改（版本 {base} → {cur.get('version', 0)}）")
+        if draft != cur:
+            draft["version"] = base + 1
+            self.all()[i] = draft
+            self._save()
+
+    @contextlib.asynccontextmanager
+    async def transaction(self, post_id: str):
+        """async with REPO.transaction(pid) as post: 原地改 post；不存在时 post 为 None，异常则不提交"""
+        async with self.lock(post_id):
+            cur = self.get(post_id)
+            if cur is None:
+                yield None
+                return
+            draft = copy.deepcopy(cur)
+            yield draft
+            self._commit(draft, int(cur.get("version", 0)))
+
+    async def update(self, post_id: str, fn: Callable[[Dict[str, Any]], Any],
+                     expected_version: Optional[int] = None) -> Dict[str, Any]:
+        """CAS：当前版本等于 expected_version 才执行 fn(post) 并提交；返回提交后的帖子"""
+        async with self.transaction(post_id) as post:
+            if post is None:
+                raise ConflictError(f"帖子 {post_id} 不存在或已删除")
+            if expected_version is not None and int(post.get("version", 0)) != expected_version:
+                self.conflicts += 1
+                raise ConflictError(f"帖子 {post_id} 已被修改（版本 {expected_version} → {post.get('version', 0)}）")
+            fn(post)
+        return self.get(post_id)
+
+    def insert(self, post: Dict[str, Any]):
+        post["version"] = 1
+        self.all().append(post)
+        self._save()
+
+    def upsert_many(self, records: List[Dict[str, Any]]) -> int:
+        """导入用：同 id 替换（版本接着往上加），新 id 追加；同步完成，中间不让出事件循环"""
+        posts = self.all()
+        index = {p.get("id"): i for i, p in enumerate(posts)}
+        for rec in records:
+            i = index.get(rec["id"])
+            if i is None:
+                rec["version"] = 1
+                index[rec["id"]] = len(posts)
+                posts.append(rec)
+            else:
+                rec["version"] = int(posts[i].get("version", 0)) + 1
+                posts[i] = rec
+        if records:
+            self._save()
+        return len(records)
+
+    def remove_many(self, post_ids: Set[str]) -> int:
+        """归档用：原地移除一批帖子；同步完成"""
+        posts = self.all()
+        before = len(posts)
+        posts[:] = [p for p in posts if p.get("id") not in post_ids]
+        if len(posts) != before:
+            self._save()
+        return before - len(posts)
+
+    async def delete(self, post_id: str) -> Optional[Dict[str, Any]]:
+        async with self.lock(post_id):
+            i = self._index(post_id)
+            post = self.all().pop(i) if i >= 0 else None
+            if post is not None:
+                self._save()
+        return post
+
+    def describe(self) -> str:
+        busy = sum(1 for lk, _ in self._locks.values() if lk.locked())
+        return f"帖子 {len(self.all())} 条，锁 {len(self._locks)} 个（占用 {busy}），版本冲突 {self.conflicts} 次"
+
+REPO = PostRepo(POSTS)
+
+# =========================
+# 操作流程状态（user_data）：每个用户单独落盘，重启后流程可以接着走；超时 / 超量淘汰
+# =========================
+FLOW_TTL_MINUTES = float(os.getenv("FLOW_TTL_MINUTES", "60"))       # 多久没操作就丢弃流程
+FLOW_MAX_USERS = int(os.getenv("FLOW_MAX_USERS", "500"))            # 内存里最多保留多少个用户的状态
+FLOW_SAVE_INTERVAL = float(os.getenv("FLOW_SAVE_INTERVAL", "5"))    # 改动多久后落盘（秒）
+
+def _flow_encode(o):
+    """集合换成 {"__set__": [...]}，其余原样交给 json_dumps（orjson 不支持 default 钩子，只能先走一遍）"""
+    if isinstance(o, dict):
+        return {k: _flow_encode(v) for k, v in o.items()}
+    if isinstance(o, (list, tuple)):
+        return [_flow_encode(v) for v in o]
+    if isinstance(o, (set, frozenset)):
+        return {"__set__": sorted(o, key=str)}
+    return o
+
+def _flow_decode(o):
+    if isinstance(o, dict):
+        if len(o) == 1 and "__set__" in o:
+            return set(o["__set__"])
+        return {k: _flow_decode(v) for k, v in o.items()}
+    if isinstance(o, list):
+        return [_flow_decode(v) for v in o]
+    return o
+
+class FlowPersistence(BasePersistence):
+    """
+    只持久化 user_data。PTB 按 update_interval 只对有改动的用户调用 update_user_data，
+    这里每个用户一个文件，所以每次只写改动的那个人。集合（已选群）存成 {"__set__": [...]}。
+    """
+
+    def __init__(self, directory: Path = FLOWS_DIR):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=FLOW_SAVE_INTERVAL,
+        )
+        self.directory = directory
+        self.touched: Dict[int, float] = {}   # user_id -> 最近一次有改动的时间
+
+    def _path(self, user_id: int) -> Path:
+        return self.directory / f"{user_id}.json"
+
+    async def get_user_data(self) -> Dict[int, Dict[Any, Any]]:
+        self.directory.mkdir(exist_ok=True)
+        cutoff = time.time() - FLOW_TTL_MINUTES * 60
+        loaded: Dict[int, Tuple[float, Dict[Any, Any]]] = {}
+        for path in self.directory.glob("*.json"):
+            try:
+                rec = _flow_decode(json_loads(path.read_bytes()))
+                uid, ts = int(path.stem), float(rec["ts"])
+            except Exception as e:
+                logger.warning(f"[流程状态] 跳过损坏文件 {path.name} err={e}")
+                continue
+            if ts < cutoff or not rec.get("data"):
+                WRITER.delete(path)
+                continue
+            loaded[uid] = (ts, rec["data"])
+        keep = sorted(loaded, key=lambda u: loaded[u][0], reverse=True)[:FLOW_MAX_USERS]
+        self.touched = {u: loaded[u][0] for u in keep}
+        if loaded:
+            logger.info(f"[流程状态] 恢复 {len(keep)} 个用户的进行中流程")
+        return {u: loaded[u][1] for u in keep}
+
+    async def update_user_data(self, user_id: int, data: Dict[Any, Any]) -> None:
+        if not data:
+            if self.touched.pop(user_id, None) is not None:
+                WRITER.delete(self._path(user_id))
+            return
+        now = time.time()
+        self.touched[user_id] = now
+        try:
+            raw = json_dumps({"ts": now, "data": _flow_encode(data)}, pretty=not JSON_COMPACT)
+        except TypeError as e:
+            logger.error(f"[流程状态] user={user_id} 无法保存：{e}")
+            return
+        WRITER.submit(self._path(user_id), raw)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        if self.touched.pop(user_id, None) is not None:
+            WRITER.delete(self._path(user_id))
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def flush(self) -> None:
+        WRITER.flush()
+
+    # 其余数据不持久化
+    async def get_chat_data(self) -> Dict[int, Any]:
+        return {}
+
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> Dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data) -> None:
+        pass
 
-def save_posts(posts: List[Dict[str, Any]]):
-    POSTS_FILE.write_text(json.dumps(posts, ensure_ascii=False, indent=2), encoding="utf-8")
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    def describe(self, app: Application) -> str:
+        return f"流程状态: 内存 {len(app.user_data)} 个用户，进行中 {len(self.touched)} 个（{FLOW_TTL_MINUTES:g} 分钟无操作即丢弃）"
+
+FLOW_STORE = FlowPersistence()
+
+async def evict_flows_job(context: ContextTypes.DEFAULT_TYPE):
+    """丢弃超时的流程；内存里的用户数超过上限时按最近活动淘汰"""
+    app = context.application
+    touched = app.persistence.touched if isinstance(app.persistence, FlowPersistence) else {}
+    now = time.time()
+    cutoff = now - FLOW_TTL_MINUTES * 60
+    last = {uid: touched.get(uid, now) for uid in app.user_data}
+    drop = {uid for uid, ts in last.items() if ts < cutoff or not app.user_data[uid]}
+    alive = sorted((uid for uid in last if uid not in drop), key=lambda u: last[u], reverse=True)
+    drop.update(alive[FLOW_MAX_USERS:])
+    expired = sum(1 for uid in drop if app.user_data[uid])
+    for uid in drop:
+        app.drop_user_data(uid)
+    if expired:
+        logger.info(f"[流程状态] 丢弃 {expired} 个超时 / 超量的流程")
 
 def content_from_message(msg) -> Dict[str, Any]:
     if msg.photo:
@@ -198,6 +763,229 @@ def today_dt(tm: dtime) -> datetime:
     n = now_local()
     return datetime(n.year, n.month, n.day, tm.hour, tm.minute, tm.second, tzinfo=LOCAL_TZ)
 
+# =========================
+# 循环规则（每天 / 每周几 / 每N小时 / cron + 可选日期范围）
+# =========================
+# recurrence 结构：
+#   {"kind": "daily",    "time": "20:30:00"}
+#   {"kind": "weekly",   "days": [1, 3, 5], "time": "20:30:00"}     # 1=周一 … 7=周日
+#   {"kind": "interval", "hours": 4, "anchor": "<ISO 时间>"}
+#   {"kind": "cron",     "expr": "0 20 * * 1-5"}                   # 分 时 日 月 周
+# 可选 "start" / "end"（YYYY-MM-DD，含当天）限定活动日期范围。
+# 帖子另存 "next_fire"（ISO）；启动时直接按它注册，不再重新解析规则。
+WEEKDAY_CN = "一二三四五六日"
+CRON_BOUNDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+def _parse_cron_field(field: str, lo: int, hi: int) -> Set[int]:
+    out: Set[int] = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, s = part.split("/", 1)
+            step = int(s)
+            if step <= 0:
+                raise ValueError(f"步长必须大于 0：{field}")
+        if part == "*":
+            a, b = lo, hi
+        elif "-" in part:
+            a, b = (int(x) for x in part.split("-", 1))
+        else:
+            a = int(part)
+            b = hi if step != 1 else a
+        if a < lo or b > hi or a > b:
+            raise ValueError(f"取值超出范围 {lo}-{hi}：{field}")
+        out.update(range(a, b + 1, step))
+    return out
+
+@lru_cache(maxsize=256)
+def parse_cron(expr: str) -> Tuple[Tuple[int, ...], Tuple[int, ...], frozenset, frozenset, frozenset, bool, bool]:
+    """解析 5 段 cron；返回 (分, 时, 日, 月, 周, 日为*, 周为*)，周取值 0=周日"""
+    fields = expr.split()
+    if len(fields) != 5:
+        raise ValueError("cron 需要 5 个字段：分 时 日 月 周")
+    try:
+        sets = [_parse_cron_field(f, lo, hi) for f, (lo, hi) in zip(fields, CRON_BOUNDS)]
+    except ValueError as e:
+        raise ValueError(f"cron 无法解析：{e}")
+    minutes, hours, doms, months, dows = sets
+    dows = {d % 7 for d in dows}
+    return (tuple(sorted(minutes)), tuple(sorted(hours)), frozenset(doms), frozenset(months),
+            frozenset(dows), fields[2] == "*", fields[4] == "*")
+
+def _cron_next(expr: str, after: datetime) -> Optional[datetime]:
+    minutes, hours, doms, months, dows, dom_any, dow_any = parse_cron(expr)
+    start = (after + timedelta(minutes=1)).replace(second=0, microsecond=0)
+    day = start.date()
+    for _ in range(366 * 5):  # 5 年内找不到就当无解（如 2 月 30 日）
+        if day.month in months:
+            dom_ok = day.day in doms
+            dow_ok = (day.weekday() + 1) % 7 in dows
+            # cron 语义：日、周都限定时满足其一即可
+            if (dom_ok and dow_ok) if (dom_any or dow_any) else (dom_ok or dow_ok):
+                first_day = day == start.date()
+                for h in hours:
+                    if first_day and h < start.hour:
+                        continue
+                    for m in minutes:
+                        if first_day and h == start.hour and m < start.minute:
+                            continue
+                        return datetime(day.year, day.month, day.day, h, m, tzinfo=LOCAL_TZ)
+        day += timedelta(days=1)
+    return None
+
+def _at_time_next(days: Optional[Set[int]], tm: dtime, after: datetime) -> Optional[datetime]:
+    for i in range(8):
+        d = after.date() + timedelta(days=i)
+        if days and d.isoweekday() not in days:
+            continue
+        cand = datetime.combine(d, tm, tzinfo=LOCAL_TZ)
+        if cand > after:
+            return cand
+    return None
+
+def next_fire_after(rec: Dict[str, Any], after: datetime) -> Optional[datetime]:
+    """返回严格晚于 after 的下一次触发时间；超出日期范围返回 None"""
+    if rec.get("start"):
+        lo = datetime.combine(date.fromisoformat(rec["start"]), dtime(0), tzinfo=LOCAL_TZ)
+        after = max(after, lo - timedelta(seconds=1))
+
+    kind = rec.get("kind")
+    if kind in ("daily", "weekly"):
+        days = set(rec.get("days") or []) if kind == "weekly" else None
+        nxt = _at_time_next(days, dtime.fromisoformat(rec["time"]), after)
+    elif kind == "interval":
+        anchor = datetime.fromisoformat(rec["anchor"])
+        step = timedelta(hours=int(rec["hours"]))
+        if after < anchor:
+            nxt = anchor
+        else:
+            nxt = anchor + step * (int((after - anchor) / step) + 1)
+    elif kind == "cron":
+        nxt = _cron_next(rec["expr"], after)
+    else:
+        return None
+
+    if nxt and rec.get("end") and nxt.date() > date.fromisoformat(rec["end"]):
+        return None
+    return nxt
+
+def normalize_recurrence(rec: Any) -> Dict[str, Any]:
+    """校验并规范化 recurrence（导入 / 新建共用），不合法抛 ValueError"""
+    if not isinstance(rec, dict):
+        raise ValueError("recurrence 必须是对象")
+    kind = rec.get("kind")
+    try:
+        if kind in ("daily", "weekly"):
+            tm = parse_time_flexible(str(rec.get("time") or ""))
+            if not tm:
+                raise ValueError(f"时间无法解析：{rec.get('time')!r}")
+            out: Dict[str, Any] = {"kind": kind, "time": tm.strftime("%H:%M:%S")}
+            if kind == "weekly":
+                days = sorted({int(d) for d in rec.get("days") or []})
+                if not days or days[0] < 1 or days[-1] > 7:
+                    raise ValueError("days 必须是 1-7 的非空列表")
+                out["days"] = days
+        elif kind == "interval":
+            hours = int(rec.get("hours") or 0)
+            if hours <= 0:
+                raise ValueError("hours 必须大于 0")
+            anchor = datetime.fromisoformat(rec["anchor"]) if rec.get("anchor") else now_local().replace(second=0, microsecond=0)
+            if anchor.tzinfo is None:
+                anchor = anchor.replace(tzinfo=LOCAL_TZ)
+            out = {"kind": kind, "hours": hours, "anchor": anchor.isoformat()}
+        elif kind == "cron":
+            expr = " ".join(str(rec.get("expr") or "").split())
+            parse_cron(expr)
+            out = {"kind": kind, "expr": expr}
+        else:
+            raise ValueError(f"kind 必须是 daily/weekly/interval/cron：{kind!r}")
+
+        for key in ("start", "end"):
+            if rec.get(key):
+                out[key] = date.fromisoformat(str(rec[key])).isoformat()
+    except (TypeError, KeyError) as e:
+        raise ValueError(f"recurrence 字段错误：{e}")
+
+    if out.get("start") and out.get("end") and out["start"] > out["end"]:
+        raise ValueError("start 不能晚于 end")
+    return out
+
+def parse_recurrence(text: str) -> Optional[Dict[str, Any]]:
+    """
+    管理员输入 -> recurrence：
+      20:30 / 20点30 / 9点            每天
+      周1,3,5 20:30 / 周一三五 9点     每周几
+      每4小时 / every 4h              从现在起每 N 小时
+      cron 0 20 * * 1-5               cron 表达式
+    末尾可追加日期范围：2025/12/01-2025/12/31 或 ~2025/12/31
+    """
+    t = (text or "").strip().replace("：", ":").replace("～", "~")
+    if not t:
+        return None
+
+    rec: Dict[str, Any] = {}
+    m = re.search(r"(\d{4}/\d{1,2}/\d{1,2})?\s*[~至到-]\s*(\d{4}/\d{1,2}/\d{1,2})\s*$", t)
+    try:
+        if m:
+            if m.group(1):
+                rec["start"] = datetime.strptime(m.group(1), "%Y/%m/%d").date().isoformat()
+            rec["end"] = datetime.strptime(m.group(2), "%Y/%m/%d").date().isoformat()
+            t = t[:m.start()].strip()
+
+        if mm := re.fullmatch(r"cron\s+(.+)", t, re.I):
+            rec.update(kind="cron", expr=mm.group(1))
+        elif mm := re.fullmatch(r"(?:每|every\s*)(\d+)\s*(?:个)?\s*(?:小时|h|hours?)", t, re.I):
+            rec.update(kind="interval", hours=int(mm.group(1)))
+        elif mm := re.fullmatch(r"(?:每周|周|星期)([1-7一二三四五六日天](?:[,，、]?[1-7一二三四五六日天])*)\s*(.+)", t):
+            days = {int(c) if c.isdigit() else (7 if c == "天" else WEEKDAY_CN.index(c) + 1)
+                    for c in re.sub(r"[,，、]", "", mm.group(1))}
+            rec.update(kind="weekly", days=sorted(days), time=mm.group(2))
+        else:
+            rec.update(kind="daily", time=t)
+        return normalize_recurrence(rec)
+    except ValueError:
+        return None
+
+def describe_recurrence(rec: Optional[Dict[str, Any]]) -> str:
+    if not rec:
+        return "（无）"
+    kind = rec.get("kind")
+    if kind == "daily":
+        s = f"每天 {rec['time'][:5]}"
+    elif kind == "weekly":
+        s = "每周" + "、".join(WEEKDAY_CN[d - 1] for d in rec.get("days", [])) + f" {rec['time'][:5]}"
+    elif kind == "interval":
+        s = f"每 {rec['hours']} 小时"
+    elif kind == "cron":
+        s = f"cron {rec['expr']}"
+    else:
+        s = str(kind)
+    if rec.get("start") or rec.get("end"):
+        s += f"（{rec.get('start') or '…'} ~ {rec.get('end') or '…'}）"
+    return s
+
+def post_recurrence(p: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """帖子的循环规则；旧数据只有 daily_time 时按每天处理"""
+    if p.get("recurrence"):
+        return p["recurrence"]
+    tm = parse_time_flexible(p.get("daily_time", ""))
+    if tm:
+        return {"kind": "daily", "time": tm.strftime("%H:%M:%S")}
+    return None
+
+def fmt_dt(iso: Optional[str]) -> str:
+    if not iso:
+        return "-"
+    return datetime.fromisoformat(iso).astimezone(LOCAL_TZ).strftime("%Y/%m/%d %H:%M:%S")
+
+def fmt_duration(seconds: float) -> str:
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f"{seconds} 秒"
+    if seconds < 3600:
+        return f"{seconds // 60} 分 {seconds % 60} 秒"
+    return f"{seconds // 3600} 小时 {seconds % 3600 // 60} 分"
+
 def get_post(posts: List[Dict[str, Any]], post_id: str) -> Optional[Dict[str, Any]]:
     return next((x for x in posts if x.get("id") == post_id), None)
 
@@ -215,7 +1003,8 @@ def fmt_post(p: Dict[str, Any]) -> str:
         s += f"⏰ 发送时间: {p.get('send_time')}\n"
         s += f"🗑 自动删除: {int(p.get('delete_minutes', 0))} 分钟\n"
     if p.get("type") == "daily":
-        s += f"🔁 每日时间: {p.get('daily_time')}\n"
+        s += f"🔁 循环规则: {describe_recurrence(post_recurrence(p))}\n"
+        s += f"⏭ 下次发送: {fmt_dt(p.get('next_fire')) if p.get('next_fire') or 'next_fire' not in p else '已结束'}\n"
         s += f"🗑 自动删除: {int(p.get('delete_minutes', 0))} 分钟\n"
     b = p.get("buttons") or {}
     if b:
@@ -256,9 +1045,13 @@ def build_buttons(buttons: Optional[Dict[str, Any]]) -> Optional[InlineKeyboardM
       "copy": {"text": "...", "value": "..."},
       "url":  {"text": "...", "url": "https://..."}
     }
+    合并发送时传入多个这样的 dict 组成的 list，每个一行。
     """
     if not buttons:
         return None
+    if isinstance(buttons, list):
+        rows = [r for b in buttons if (m := build_buttons(b)) for r in m.inline_keyboard]
+        return InlineKeyboardMarkup(rows) if rows else None
 
     row = []
 
@@ -280,159 +1073,2050 @@ def build_buttons(buttons: Optional[Dict[str, Any]]) -> Optional[InlineKeyboardM
         return None
     return InlineKeyboardMarkup([row])
 
-async def send_content(context: ContextTypes.DEFAULT_TYPE, chat_id: int, content: Dict[str, Any], buttons: Optional[Dict[str, Any]] = None):
+async def send_content(context: ContextTypes.DEFAULT_TYPE, chat_id: int, content: Dict[str, Any], buttons: Optional[Dict[str, Any]] = None, lane: Optional[int] = None, bot=None):
     rm = build_buttons(buttons)
+    # 群发 / 清理走独立连接池，交互回复不被挤占
+    if bot is None:
+        bot = context.bot if lane in (None, LANE_INTERACTIVE) else bulk_bot(context)
 
     if content.get("type") == "photo":
-        return await context.bot.send_photo(
+        return await bot.send_photo(
             chat_id=chat_id,
             photo=content.get("photo_id"),
             caption=content.get("caption", "") or "",
-            reply_markup=rm
+            reply_markup=rm,
+            rate_limit_args=lane
         )
     else:
-        return await context.bot.send_message(
+        return await bot.send_message(
             chat_id=chat_id,
             text=content.get("text", "") or "",
-            reply_markup=rm
+            reply_markup=rm,
+            rate_limit_args=lane
         )
 
-# =========================
-# 基础命令
-# =========================
-async def cmd_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    await update.message.reply_text(f"你的 Telegram ID：{user.id}")
-
-async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    if not is_admin(user.id):
-        await update.message.reply_text(f"⛔ 无权限。\n你的ID：{user.id}\n请让管理员把你的ID加入 ADMIN_IDS 环境变量。")
-        return
-    await update.message.reply_text(
-        "✅ BG678 群发机器人（Webhook 稳定版）已启动\n\n"
-        "群内绑定：/register\n群内解绑：/unregister\n私聊群管理：/managegroups\n\n"
-        "也可以直接用下方菜单按钮。",
-        reply_markup=MAIN_KEYBOARD
-    )
-
-async def cmd_debug(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    if not is_admin(user.id):
-        await update.message.reply_text(f"⛔ 无权限。你的ID：{user.id}")
-        return
-    g = load_groups()
-    p = load_posts()
-    jq = "OK" if getattr(context, "job_queue", None) is not None else "MISSING"
-    await update.message.reply_text(
-        "🧪 Debug\n"
-        f"BASE_DIR: {BASE_DIR}\n"
-        f"groups_file: {GROUPS_FILE}\n"
-        f"posts_file: {POSTS_FILE}\n"
-        f"群数量: {len(g)}\n"
-        f"任务数量: {len(p)}\n"
-        f"job_queue: {jq}\n"
-        f"TZ_OFFSET: {TZ_OFFSET}\n"
-    )
-
-# =========================
-# 绑定 / 解绑
-# =========================
-async def register_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat = update.effective_chat
-    user = update.effective_user
-
-    if not is_admin(user.id):
-        await update.message.reply_text(f"⛔ 无权限。你的ID：{user.id}")
-        return
+# ============================================================
+# 出站队列：优先级通道 + 限速（所有 Bot API 调用都经过这里）
+# ============================================================
+# 通道（rate_limit_args 传入，不传 = 交互）：
+#   交互回复 > 立即群发 > 定时/循环群发 > 自动删除
+# 调度用平滑加权轮询：高优先级通道优先，低优先级通道仍保底按权重分到份额，不会饿死。
+LANE_INTERACTIVE = 0
+LANE_IMMEDIATE = 1
+LANE_SCHEDULED = 2
+LANE_CLEANUP = 3
+LANE_NAMES = ("交互", "立即", "定时", "清理")
+
+SEND_RATE_PER_SEC = float(os.getenv("SEND_RATE_PER_SEC", "25"))      # 全局：每秒请求数
+GROUP_RATE_PER_MIN = int(os.getenv("GROUP_RATE_PER_MIN", "20"))      # 单群：每分钟消息数
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "2"))           # 遇到 429 最多重试次数
+LANE_WEIGHTS = [int(x) for x in os.getenv("LANE_WEIGHTS", "8,4,2,1").split(",")]
+
+def retry_after_seconds(exc: RetryAfter) -> float:
+    ra = exc.retry_after
+    return ra.total_seconds() if isinstance(ra, timedelta) else float(ra)
+
+class PriorityRateLimiter(BaseRateLimiter[int]):
+    def __init__(
+        self,
+        rate_per_sec: float = SEND_RATE_PER_SEC,
+        group_rate_per_min: int = GROUP_RATE_PER_MIN,
+        max_retries: int = SEND_MAX_RETRIES,
+        weights: Optional[List[int]] = None,
+    ):
+        self.interval = 1.0 / rate_per_sec if rate_per_sec > 0 else 0.0
+        self.burst = max(1.0, rate_per_sec)
+        self.group_rate = group_rate_per_min
+        self.max_retries = max_retries
+        self.weights = list(weights or LANE_WEIGHTS)
+        self.weights += [1] * (len(LANE_NAMES) - len(self.weights))
+
+        self._lanes: List[deque] = [deque() for _ in LANE_NAMES]
+        self._credits = [0] * len(LANE_NAMES)
+        self._chat_windows: Dict[Any, deque] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._pump_task: Optional[asyncio.Task] = None
+        self._next_at = 0.0
+        self._paused_until = 0.0
+
+        self.granted = [0] * len(LANE_NAMES)
+        self.retry_after_hits = 0
+
+    async def initialize(self) -> None:
+        if self._pump_task is None:
+            self._wakeup = asyncio.Event()
+            self._pump_task = asyncio.create_task(self._pump())
+
+    async def shutdown(self) -> None:
+        if self._pump_task is not None:
+            self._pump_task.cancel()
+            self._pump_task = None
+
+    def _pick_lane(self) -> Optional[int]:
+        # 平滑加权轮询（nginx SWRR）
+        for q in self._lanes:
+            while q and q[0].done():
+                q.popleft()
+        active = [i for i, q in enumerate(self._lanes) if q]
+        if not active:
+            return None
+        total = 0
+        for i in active:
+            self._credits[i] += self.weights[i]
+            total += self.weights[i]
+        best = max(active, key=lambda i: (self._credits[i], -i))
+        self._credits[best] -= total
+        return best
+
+    async def _pump(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not any(self._lanes):
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = loop.time()
+            wait_until = max(self._next_at, self._paused_until)
+            if wait_until > now:
+                await asyncio.sleep(wait_until - now)
+                continue
+            lane = self._pick_lane()
+            if lane is None:
+                continue
+            fut = self._lanes[lane].popleft()
+            fut.set_result(None)
+            self.granted[lane] += 1
+            self._next_at = max(self._next_at, now - self.interval * (self.burst - 1)) + self.interval
+
+    async def _acquire(self, lane: int):
+        fut = asyncio.get_running_loop().create_future()
+        self._lanes[lane].append(fut)
+        self._wakeup.set()
+        await fut
+
+    async def _acquire_chat(self, chat_id: Any):
+        # 单群滑动窗口：先拿到群配额再排全局队列，避免一个群卡住整条通道
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            w = self._chat_windows.setdefault(chat_id, deque())
+            while w and now - w[0] >= 60:
+                w.popleft()
+            if len(w) < self.group_rate:
+                w.append(now)
+                break
+            await asyncio.sleep(60 - (now - w[0]))
+        if len(self._chat_windows) > 1024:
+            for k in [k for k, v in self._chat_windows.items() if not v or now - v[-1] >= 60]:
+                del self._chat_windows[k]
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None or self._wakeup is None:
+            return await callback(*args, **kwargs)
+
+        lane = LANE_INTERACTIVE if rate_limit_args is None else min(int(rate_limit_args), len(LANE_NAMES) - 1)
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+        is_group = isinstance(chat_id, str) or chat_id < 0
 
-    if chat.type not in ("group", "supergroup"):
-        await update.message.reply_text("请在群内使用 /register")
-        return
+        for attempt in range(self.max_retries + 1):
+            if is_group and self.group_rate > 0:
+                await self._acquire_chat(chat_id)
+            await self._acquire(lane)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                wait = retry_after_seconds(e) + 0.1
+                self._paused_until = max(self._paused_until, asyncio.get_running_loop().time() + wait)
+                self.retry_after_hits += 1
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"[限流] {endpoint} chat={chat_id} lane={LANE_NAMES[lane]} 暂停 {wait:.1f}s 后重试")
+
+    def describe(self) -> str:
+        return " / ".join(
+            f"{name}:排队{len(q)} 已发{n}" for name, q, n in zip(LANE_NAMES, self._lanes, self.granted)
+        ) + f"\n429 次数: {self.retry_after_hits}"
 
-    groups = load_groups()
-    groups[str(chat.id)] = chat.title or f"group_{chat.id}"
-    save_groups(groups)
-    await update.message.reply_text(f"✅ 已绑定群：{groups[str(chat.id)]}")
+# ============================================================
+# HTTP 连接池：交互与群发各用一套，互不抢连接
+# ============================================================
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "8"))                 # 交互（管理员操作）
+HTTP_BULK_POOL_SIZE = int(os.getenv("HTTP_BULK_POOL_SIZE", "32"))      # 群发 / 删除
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "10"))
+HTTP_WRITE_TIMEOUT = float(os.getenv("HTTP_WRITE_TIMEOUT", "10"))
+HTTP_POOL_TIMEOUT = float(os.getenv("HTTP_POOL_TIMEOUT", "10"))
+HTTP2 = os.getenv("HTTP2", "0") == "1"                                # 需要 pip install "httpx[http2]"
+
+class RollingStats:
+    """最近 size 个样本的滚动统计，分位数在查看时才排序计算"""
+
+    def __init__(self, size: int = 1000):
+        self.samples: deque = deque(maxlen=size)
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, v: float):
+        self.samples.append(v)
+        self.count += 1
+        self.max = max(self.max, v)
+
+    def percentile(self, q: float) -> float:
+        if not self.samples:
+            return 0.0
+        xs = sorted(self.samples)
+        return xs[min(len(xs) - 1, int(q * len(xs)))]
+
+    def summary(self, scale: float = 1000.0, unit: str = "ms") -> str:
+        return (f"p50 {self.percentile(0.5) * scale:.1f}{unit} / p95 {self.percentile(0.95) * scale:.1f}{unit} / "
+                f"p99 {self.percentile(0.99) * scale:.1f}{unit} / max {self.max * scale:.1f}{unit}（{self.count} 次）")
+
+class MeteredHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest + 连接池排队计时（用与连接池同大小的信号量统计取连接的等待时间）"""
+
+    def __init__(self, name: str, pool_size: int, **kwargs):
+        super().__init__(connection_pool_size=pool_size, **kwargs)
+        self.name = name
+        self.pool_size = pool_size
+        self.pool_wait = RollingStats()
+        self._default_pool_timeout = kwargs.get("pool_timeout")
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    @staticmethod
+    def parse_json_payload(payload: bytes) -> Dict[str, Any]:
+        # Bot API 的响应走统一编解码（orjson 时明显更快）
+        try:
+            return json_loads(payload)
+        except ValueError:
+            try:
+                return json.loads(payload.decode("utf-8", "replace"))
+            except ValueError as exc:
+                raise TelegramError("Invalid server response") from exc
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data=None,
+        read_timeout=BaseRequest.DEFAULT_NONE,
+        write_timeout=BaseRequest.DEFAULT_NONE,
+        connect_timeout=BaseRequest.DEFAULT_NONE,
+        pool_timeout=BaseRequest.DEFAULT_NONE,
+    ):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.pool_size)
+        timeout = self._default_pool_timeout if pool_timeout is BaseRequest.DEFAULT_NONE else pool_timeout
+        t0 = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            self.pool_wait.add(time.perf_counter() - t0)
+            raise TimedOut(f"Pool timeout: {self.name} 连接池已满")
+        self.pool_wait.add(time.perf_counter() - t0)
+        try:
+            return await super().do_request(
+                url, method, request_data, read_timeout, write_timeout, connect_timeout, pool_timeout
+            )
+        finally:
+            self._slots.release()
 
-async def unregister_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat = update.effective_chat
-    user = update.effective_user
+HTTP_REQUESTS: List[MeteredHTTPXRequest] = []
 
-    if not is_admin(user.id):
-        await update.message.reply_text(f"⛔ 无权限。你的ID：{user.id}")
-        return
+def make_request(name: str, pool_size: int) -> MeteredHTTPXRequest:
+    http_version = "1.1"
+    if HTTP2:
+        if importlib.util.find_spec("h2") is not None:
+            http_version = "2"
+        else:
+            logger.warning("HTTP2=1 但未安装 h2（pip install \"httpx[http2]\"），继续使用 HTTP/1.1")
+    req = MeteredHTTPXRequest(
+        name,
+        pool_size,
+        connect_timeout=HTTP_CONNECT_TIMEOUT,
+        read_timeout=HTTP_READ_TIMEOUT,
+        write_timeout=HTTP_WRITE_TIMEOUT,
+        pool_timeout=HTTP_POOL_TIMEOUT,
+        http_version=http_version,
+        httpx_kwargs={"limits": httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        )},
+    )
+    HTTP_REQUESTS.append(req)
+    return req
 
-    if chat.type not in ("group", "supergroup"):
-        await update.message.reply_text("请在群内使用 /unregister")
-        return
+# 群发专用 Bot（同一个 token、同一个限速器，只是走独立连接池）；main() 里创建
+BULK_BOT: Optional[ExtBot] = None
 
-    groups = load_groups()
-    cid = str(chat.id)
-    if cid in groups:
-        title = groups.pop(cid)
-        save_groups(groups)
-        await update.message.reply_text(f"❌ 已解绑群：{title}")
-    else:
-        await update.message.reply_text("该群尚未绑定，无需解绑。")
+def bulk_bot(context: ContextTypes.DEFAULT_TYPE):
+    return BULK_BOT or context.bot
 
 # =========================
-# 私聊群管理
+# 多 Bot 发送池：额外的发送 bot 各有独立限速，群固定分配给一个在群里的 bot
 # =========================
-async def managegroups(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    if not is_admin(user.id):
-        await update.message.reply_text(f"⛔ 无权限。你的ID：{user.id}")
-        return
+SENDER_TOKENS = [t.strip() for t in os.getenv("SENDER_TOKENS", "").split(",") if t.strip()]
+HTTP_SENDER_POOL_SIZE = int(os.getenv("HTTP_SENDER_POOL_SIZE", "16"))
 
-    groups = load_groups()
-    if not groups:
-        await update.message.reply_text("📭 当前没有任何绑定群", reply_markup=MAIN_KEYBOARD)
-        return
+class SenderPool:
+    """
+    主 bot（BULK_BOT）+ SENDER_TOKENS 里的发送 bot。
+    每个群第一次发送时分配给负载最低、且确认在群里的 bot，分配结果存 senders.json；
+    发送 bot 被踢 / 无权限时自动解绑并回退到主 bot。
+    """
 
-    text = "📋 已绑定群：\n\n"
-    kb = []
-    for cid, title in groups.items():
-        text += f"• {title} ({cid})\n"
-        kb.append([InlineKeyboardButton(f"❌ 解绑 {title}", callback_data=f"mg_del:{cid}")])
-    kb.append([InlineKeyboardButton("🧹 清空全部", callback_data="mg_clear")])
+    def __init__(self, main_bot: ExtBot, extra_bots: List[ExtBot]):
+        self.main = main_bot
+        self.extra = extra_bots
+        self.bots: Dict[str, ExtBot] = {}
+        self.load: Dict[str, int] = {}
 
-    await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(kb))
+    async def initialize(self):
+        self.bots[str(self.main.id)] = self.main
+        for b in self.extra:
+            try:
+                await b.initialize()
+                self.bots[str(b.id)] = b
+            except Exception as e:
+                logger.error(f"[发送Bot初始化失败] err={e}")
+
+        assign = SENDER_ASSIGN.get()
+        stale = [cid for cid, bid in assign.items() if bid not in self.bots]
+        for cid in stale:
+            del assign[cid]
+        if stale:
+            SENDER_ASSIGN.set(assign)
+        self.load = {bid: 0 for bid in self.bots}
+        for bid in assign.values():
+            self.load[bid] += 1
+        logger.info(f"发送池：{len(self.bots)} 个 bot，已分配 {len(assign)} 个群")
+
+    async def shutdown(self):
+        for b in self.extra:
+            try:
+                await b.shutdown()
+            except Exception:
+                pass
 
-async def managegroups_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    user = q.from_user
-    if not is_admin(user.id):
-        await q.answer("无权限")
-        return
+    def by_id(self, bid: Optional[str]) -> Optional[ExtBot]:
+        return self.bots.get(str(bid)) if bid else None
 
-    data = q.data
-    groups = load_groups()
+    def unassign(self, cid: str):
+        assign = SENDER_ASSIGN.get()
+        bid = assign.pop(cid, None)
+        if bid:
+            self.load[bid] = max(0, self.load.get(bid, 0) - 1)
+            SENDER_ASSIGN.set(assign)
 
-    if data.startswith("mg_del:"):
-        cid = data.split(":", 1)[1]
-        groups.pop(cid, None)
-        save_groups(groups)
-        await q.answer("已解绑")
-        await q.message.delete()
-        return
+    async def _is_member(self, b: ExtBot, cid: str, lane: int) -> bool:
+        try:
+            m = await b.get_chat_member(chat_id=int(cid), user_id=b.id, rate_limit_args=lane)
+        except Exception:
+            return False
+        return m.status in ("member", "administrator", "creator") or (
+            m.status == "restricted" and getattr(m, "can_send_messages", False)
+        )
 
-    if data == "mg_clear":
-        save_groups({})
-        await q.answer("已清空")
-        await q.message.delete()
-        return
+    async def bot_for(self, cid: str, lane: int) -> ExtBot:
+        assign = SENDER_ASSIGN.get()
+        bid = assign.get(cid)
+        if bid in self.bots:
+            return self.bots[bid]
+        for bid in sorted(self.bots, key=lambda k: self.load[k]):
+            b = self.bots[bid]
+            if b is self.main or await self._is_member(b, cid, lane):
+                assign[cid] = bid
+                self.load[bid] += 1
+                SENDER_ASSIGN.set(assign)
+                return b
+        return self.main
+
+    def describe(self) -> str:
+        lines = []
+        for bid, b in self.bots.items():
+            tag = "主" if b is self.main else "发送"
+            rl = b.rate_limiter
+            hits = rl.retry_after_hits if isinstance(rl, PriorityRateLimiter) else 0
+            lines.append(f"{tag} @{b.username}: {self.load.get(bid, 0)} 群，429 {hits} 次")
+        return "\n".join(lines)
+
+SENDERS: Optional[SenderPool] = None
+
+async def send_via_pool(context: ContextTypes.DEFAULT_TYPE, cid: str, content: Dict[str, Any], buttons: Optional[Dict[str, Any]], lane: int) -> Dict[str, Any]:
+    """按发送池选 bot 发送；返回投递记录（非主 bot 发出的带 "bot" 字段，删除时用同一个 bot）"""
+    # file_id 只对获取它的 bot 有效，图片帖仍由主 bot 发送
+    if SENDERS is None or content.get("type") != "text":
+        m = await send_content(context, int(cid), content, buttons=buttons, lane=lane)
+        return {"chat_id": cid, "message_id": m.message_id}
+
+    bot = await SENDERS.bot_for(cid, lane)
+    try:
+        m = await send_content(context, int(cid), content, buttons=buttons, lane=lane, bot=bot)
+    except (Forbidden, BadRequest) as e:
+        if bot is SENDERS.main:
+            raise
+        logger.warning(f"[发送Bot回退] chat={cid} bot=@{bot.username} err={e}")
+        SENDERS.unassign(cid)
+        bot = SENDERS.main
+        m = await send_content(context, int(cid), content, buttons=buttons, lane=lane, bot=bot)
+
+    res = {"chat_id": cid, "message_id": m.message_id}
+    if bot is not SENDERS.main:
+        res["bot"] = str(bot.id)
+    return res
 
+# ============================================================
+# 媒体：本地文件 / URL 上传一次拿 file_id，按内容哈希缓存；发送前验证，失效自动重传
+# ============================================================
+MEDIA_STAGING_CHAT_ID = int(os.getenv("MEDIA_STAGING_CHAT_ID", "0") or 0)   # 上传用的中转聊天；不填则用任务创建者私聊
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_BYTES", str(10 * 1024 * 1024)))  # Telegram 图片上传上限 10MB
+MEDIA_SOURCE_DIR = Path(os.getenv("MEDIA_SOURCE_DIR", "").strip() or MEDIA_DIR)  # 「图片: 文件名」只能读这个目录下的文件
+MEDIA_MAX_REDIRECTS = 3
+MEDIA_CHECK_LEAD_MIN = int(os.getenv("MEDIA_CHECK_LEAD_MIN", "15"))         # 发送前多少分钟内验证 file_id
+MEDIA_CHECK_MAX_AGE_MIN = int(os.getenv("MEDIA_CHECK_MAX_AGE_MIN", "60"))   # 验证结果有效期
+MEDIA_INPUT_RE = re.compile(r"^(?:图片|media)[:：]\s*(\S+)(?:\s+(.*))?$", re.S)
+_media_locks: Dict[str, asyncio.Lock] = {}
+_media_warned: Set[Tuple[str, str]] = set()
+
+def media_path(h: str) -> Path:
+    return MEDIA_DIR / f"{h}.img"
+
+def _save_media_bytes(data: bytes) -> str:
+    h = hashlib.sha256(data).hexdigest()
+    path = media_path(h)
+    if not path.exists():
+        MEDIA_DIR.mkdir(exist_ok=True)
+        atomic_write_bytes(path, data)
+    return h
+
+def staging_chat(fallback: Optional[int] = None) -> Optional[int]:
+    return MEDIA_STAGING_CHAT_ID or fallback or next(iter(ADMIN_IDS), None)
+
+def is_stale_file_error(e: Exception) -> bool:
+    m = str(e).lower()
+    return "file identifier" in m or "file reference" in m or "remote file" in m or "file_id" in m
+
+async def check_public_url(url: str) -> str:
+    """只允许 http(s) 且域名解析到公网地址的链接，防止借机器人访问内网 / 本机服务；返回检查过的地址"""
+    u = httpx.URL(url)
+    if u.scheme not in ("http", "https") or not u.host:
+        raise ValueError("只支持 http(s) 图片链接")
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(u.host, u.port or (443 if u.scheme == "https" else 80))
+    except socket.gaierror:
+        raise ValueError(f"无法解析域名：{u.host}")
+    for *_, sockaddr in infos:
+        if not ipaddress.ip_address(sockaddr[0].split("%", 1)[0]).is_global:
+            raise ValueError(f"不允许访问内网地址：{u.host}")
+    return infos[0][4][0]
+
+class PinnedBackend(httpcore.AsyncNetworkBackend):
+    """
+    连接时不再解析域名，只连 check_public_url 检查过的地址：两次解析之间 DNS 换绑（rebinding）绕不过检查。
+    Host 头和 TLS 的 SNI / 证书校验仍用原域名。
+    """
+
+    def __init__(self):
+        self._inner = httpcore.AnyIOBackend()
+        self.pinned: Dict[str, str] = {}   # 域名 -> 检查过的地址
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        if host not in self.pinned:
+            raise httpcore.ConnectError(f"地址未经检查：{host}")
+        return await self._inner.connect_tcp(self.pinned[host], port, timeout=timeout,
+                                             local_address=local_address, socket_options=socket_options)
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        raise httpcore.ConnectError("不支持 unix socket")
+
+    async def sleep(self, seconds: float) -> None:
+        await self._inner.sleep(seconds)
+
+def media_source_path(src: str) -> Path:
+    """「图片: 文件名」只能指向 MEDIA_SOURCE_DIR 里的文件（绝对路径、../、软链接跳出目录都拒绝）"""
+    root = MEDIA_SOURCE_DIR.resolve()
+    path = (root / src).resolve()
+    if not path.is_relative_to(root):
+        raise ValueError(f"只能使用 {root} 目录下的文件")
+    return path
+
+async def read_media_source(src: str) -> bytes:
+    """MEDIA_SOURCE_DIR 里的文件或公网 http(s) URL -> 图片字节（超过 MEDIA_MAX_BYTES 报错）"""
+    if is_valid_url(src):
+        url = httpx.URL(src)
+        backend = PinnedBackend()
+        timeout = {"connect": 30, "read": 30, "write": 30, "pool": 30}
+        async with httpcore.AsyncConnectionPool(ssl_context=httpx.create_ssl_context(), network_backend=backend) as pool:
+            # 手动跟随跳转：每一跳都重新检查目标地址，并且只连检查过的那个地址
+            for _ in range(MEDIA_MAX_REDIRECTS + 1):
+                backend.pinned[url.raw_host.decode("ascii")] = await check_public_url(str(url))
+                async with pool.stream("GET", str(url), extensions={"timeout": timeout}) as r:
+                    headers = httpx.Headers(r.headers)
+                    if r.status in (301, 302, 303, 307, 308) and "location" in headers:
+                        url = url.join(headers["location"])
+                        continue
+                    if r.status >= 400:
+                        raise ValueError(f"下载失败：HTTP {r.status}")
+                    buf = bytearray()
+                    async for chunk in r.aiter_stream():
+                        buf += chunk
+                        if len(buf) > MEDIA_MAX_BYTES:
+                            raise ValueError(f"文件超过 {MEDIA_MAX_BYTES // 1024 // 1024}MB")
+                    return bytes(buf)
+        raise ValueError(f"跳转超过 {MEDIA_MAX_REDIRECTS} 次")
+    path = media_source_path(src)
+    if not path.is_file():
+        raise ValueError(f"找不到文件：{src}")
+    if path.stat().st_size > MEDIA_MAX_BYTES:
+        raise ValueError(f"文件超过 {MEDIA_MAX_BYTES // 1024 // 1024}MB")
+    return await asyncio.to_thread(path.read_bytes)
+
+async def _upload_media(bot, h: str, chat_id: Optional[int]) -> str:
+    if not chat_id:
+        raise ValueError("没有可用的中转聊天（MEDIA_STAGING_CHAT_ID）")
+    data = await asyncio.to_thread(media_path(h).read_bytes)
+    m = await bot.send_photo(chat_id=chat_id, photo=data, rate_limit_args=LANE_INTERACTIVE)
+    try:
+        await bot.delete_message(chat_id=chat_id, message_id=m.message_id, rate_limit_args=LANE_INTERACTIVE)
+    except Exception:
+        pass
+    return m.photo[-1].file_id
+
+async def ingest_media(bot, data: bytes, chat_id: Optional[int], source: str = "", file_id: Optional[str] = None) -> str:
+    """保存原图并确保有可用 file_id（相同内容只上传一次），返回内容哈希"""
+    h = await asyncio.to_thread(_save_media_bytes, data)
+    cache = MEDIA_CACHE.get()
+    if file_id:
+        cache[h] = {"file_id": file_id, "checked": time.time(), "source": source or cache.get(h, {}).get("source", "")}
+    elif h not in cache:
+        cache[h] = {"file_id": await _upload_media(bot, h, chat_id), "checked": time.time(), "source": source}
+        logger.info(f"[媒体] 已上传 {source or h[:12]} -> {h[:12]}")
+    MEDIA_CACHE.set(cache)
+    return h
+
+async def store_photo_id(post_id: str, h: str, fid: str):
+    """把新的 file_id 写回帖子（走 REPO，升版本）；帖子已删除或已换了别的图则不动"""
+    def swap(p: Dict[str, Any]):
+        c = p.get("content") or {}
+        if c.get("media") == h:  # 持锁后再确认一次：期间内容可能已被改掉
+            c["photo_id"] = fid
+
+    try:
+        await REPO.update(post_id, swap)
+    except ConflictError:
+        pass  # 已被删除
+
+async def refresh_media(bot, h: str, stale_file_id: Optional[str], chat_id: Optional[int]) -> Optional[str]:
+    """file_id 失效：用原图重新上传一次（并发的发送只有第一个真正上传），同步更新所有用到它的帖子"""
+    lock = _media_locks.setdefault(h, asyncio.Lock())
+    async with lock:
+        cache = MEDIA_CACHE.get()
+        entry = cache.get(h)
+        if entry and entry["file_id"] != stale_file_id:
+            return entry["file_id"]
+        if not media_path(h).exists():
+            logger.error(f"[媒体] {h[:12]} 的 file_id 已失效，且没有原图可重新上传")
+            return None
+        try:
+            fid = await _upload_media(bot, h, chat_id)
+        except Exception as e:
+            logger.error(f"[媒体] {h[:12]} 重新上传失败：{e}")
+            return None
+        cache[h] = {**(entry or {}), "file_id": fid, "checked": time.time()}
+        MEDIA_CACHE.set(cache)
+        ids = [p["id"] for p in REPO.all() if (p.get("content") or {}).get("media") == h]
+        for pid in ids:
+            await store_photo_id(pid, h, fid)
+        logger.warning(f"[媒体] {h[:12]} 的 file_id 已失效，已重新上传")
+        return fid
+
+async def validate_media(bot, post: Dict[str, Any]) -> bool:
+    """
+    确认帖子图片的 file_id 可用；最近验证过的直接通过，失效的尝试重传。
+    不改传入的帖子：换了 file_id 时通过 REPO 写回，调用方需要的话重新 REPO.get。
+    """
+    content = post.get("content") or {}
+    if content.get("type") != "photo":
+        return True
+    h = content.get("media")
+    fid = content.get("photo_id")
+    entry = MEDIA_CACHE.get().get(h) if h else None
+    if entry:
+        if entry["file_id"] != fid:
+            fid = entry["file_id"]
+            await store_photo_id(post["id"], h, fid)
+        if time.time() - entry.get("checked", 0) < MEDIA_CHECK_MAX_AGE_MIN * 60:
+            return True
+    try:
+        await bot.get_file(fid, rate_limit_args=LANE_INTERACTIVE)
+    except BadRequest as e:
+        if not h:
+            logger.error(f"[媒体] file_id 已失效且没有原图：{e}")
+            return False
+        return await refresh_media(bot, h, fid, staging_chat(post.get("owner"))) is not None
+    if entry:
+        entry["checked"] = time.time()
+        MEDIA_CACHE.set(MEDIA_CACHE.get())
+    return True
+
+async def send_resilient(context: ContextTypes.DEFAULT_TYPE, cid: str, content: Dict[str, Any], buttons, lane: int,
+                         chat_id: Optional[int] = None) -> Dict[str, Any]:
+    """
+    send_via_pool + 图片 file_id 失效时重传一次再发（不会因为一个失效的 file_id 整批失败）。
+    content 是本次群发自己的副本：换到的新 file_id 写在这里，后面的群直接用；帖子本身由 refresh_media 经 REPO 更新。
+    """
+    used = content.get("photo_id")
+    try:
+        return await send_via_pool(context, cid, content, buttons, lane)
+    except BadRequest as e:
+        h = content.get("media")
+        if content.get("type") != "photo" or not h or not is_stale_file_error(e):
+            raise
+        fid = await refresh_media(context.bot, h, used, staging_chat(chat_id))
+        if not fid:
+            raise
+        content["photo_id"] = fid
+        return await send_via_pool(context, cid, content, buttons, lane)
+
+async def content_from_input(context: ContextTypes.DEFAULT_TYPE, msg) -> Optional[Dict[str, Any]]:
+    """
+    流程里收到的内容 -> content。除了文字 / 图片，还支持「图片: 路径或URL 说明文字」。
+    图片会保存原图（立即发送除外），之后 file_id 失效可以自动重传。失败时已回复提示，返回 None。
+    """
+    m = MEDIA_INPUT_RE.match((msg.text or "").strip()) if msg.text else None
+    if m:
+        src, caption = m.group(1), (m.group(2) or "").strip()
+        try:
+            data = await read_media_source(src)
+            h = await ingest_media(context.bot, data, staging_chat(msg.chat_id), source=src)
+        except Exception as e:
+            await msg.reply_text(f"❗ 图片读取 / 上传失败：{e}\n请重新发送内容：")
+            return None
+        return {"type": "photo", "photo_id": MEDIA_CACHE.get()[h]["file_id"], "caption": caption, "media": h}
+
+    content = content_from_message(msg)
+    if msg.photo and context.user_data.get(MODE) != M_IMMEDIATE:
+        try:
+            f = await context.bot.get_file(content["photo_id"])
+            data = bytes(await f.download_as_bytearray())
+            content["media"] = await ingest_media(context.bot, data, None, file_id=content["photo_id"])
+        except Exception as e:
+            logger.warning(f"[媒体] 原图保存失败（file_id 失效后将无法自动重传）：{e}")
+    return content
+
+async def validate_media_job(context: ContextTypes.DEFAULT_TYPE):
+    """定时检查即将发送的图片帖，提前发现并修复失效的 file_id"""
+    now = now_local()
+    horizon = now + timedelta(minutes=MEDIA_CHECK_LEAD_MIN)
+    for p in list(load_posts()):
+        content = p.get("content") or {}
+        if content.get("type") != "photo":
+            continue
+        fire_at = post_fire_time(p, now)
+        if not fire_at or fire_at > horizon:
+            continue
+        if await validate_media(context.bot, p):
+            continue
+        key = (p["id"], content.get("photo_id", ""))
+        if key not in _media_warned and p.get("owner"):
+            _media_warned.add(key)
+            try:
+                await context.bot.send_message(
+                    chat_id=p["owner"],
+                    text=f"⚠️ 任务 {p['id']} 的图片已失效，且没有原图可重新上传。请在「我的帖子」里编辑内容，重新发送图片。"
+                )
+            except Exception as e:
+                logger.error(f"[媒体] 失效提醒发送失败 owner={p.get('owner')} err={e}")
+
+def bot_for_record(context: ContextTypes.DEFAULT_TYPE, item: Dict[str, Any]):
+    """投递记录对应的 bot（删除 / 编辑要用发出消息的那个 bot）"""
+    b = SENDERS.by_id(item.get("bot")) if SENDERS else None
+    return b or bulk_bot(context)
+
+def fmt_http_pools() -> str:
+    return "\n".join(f"HTTP {r.name}: {r.pool_size} 连接，取连接等待 {r.pool_wait.summary()}" for r in HTTP_REQUESTS) or "HTTP: 默认"
+
+# ============================================================
+# 投递索引：每条发出的消息 (帖子, 批次, 群) -> (message_id, 时间, 发送 bot)
+# 内存里是按 key 排序的并行数组，bisect 查询 O(log n)；磁盘是追加日志，定期压缩
+# ============================================================
+DELIVERY_RETENTION_DAYS = float(os.getenv("DELIVERY_RETENTION_DAYS", "7"))   # 记录保留天数
+DELIVERY_COMPACT_HOURS = float(os.getenv("DELIVERY_COMPACT_HOURS", "6"))     # 压缩间隔
+IMMEDIATE_POST_ID = "immediate"   # 立即发送没有帖子，统一记在这个 ID 下
+
+class DeliveryIndex:
+    """
+    日志每行：时间戳 \t 帖子 \t 批次 \t 群 \t message_id \t bot（主 bot 为空）[\t m（合并消息）| x（已删除）]
+    同一 key 重复出现时以后写的为准；x 行是撤回留下的删除标记；压缩时丢掉过期、被覆盖和已删除的行。
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._keys: List[Tuple[str, str, str]] = []
+        self._vals: List[Tuple[int, int, str, bool]] = []
+        self._loaded = False
+        self.appended = 0   # 上次压缩后追加的行数
+
+    def load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        cutoff = time.time() - DELIVERY_RETENTION_DAYS * 86400
+        rows: Dict[Tuple[str, str, str], Tuple[int, int, str, bool]] = {}
+        total = 0
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    total += 1
+                    parts = line.rstrip("\n").split("\t")
+                    if len(parts) not in (6, 7):
+                        continue
+                    try:
+                        ts, mid = int(parts[0]), int(parts[4])
+                    except ValueError:
+                        continue
+                    if ts < cutoff:
+                        continue
+                    key = (sys.intern(parts[1]), sys.intern(parts[2]), parts[3])
+                    if parts[6:] == ["x"]:
+                        rows.pop(key, None)
+                        continue
+                    rows[key] = (mid, ts, parts[5], parts[6:] == ["m"])
+        except FileNotFoundError:
+            return
+        self._keys = sorted(rows)
+        self._vals = [rows[k] for k in self._keys]
+        self.appended = total - len(self._keys)
+        logger.info(f"[投递索引] 载入 {len(self._keys)} 条（日志 {total} 行）")
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def _span(self, *prefix: str) -> Tuple[int, int]:
+        lo = bisect.bisect_left(self._keys, prefix)
+        hi = bisect.bisect_left(self._keys, prefix + ("\uffff",))
+        return lo, hi
+
+    def record(self, post_id: str, run_id: str, results: List[Dict[str, Any]]):
+        """记录一次群发的投递结果（同一批次整段替换，一次 O(n) 插入而不是逐条插入）"""
+        if not results:
+            return
+        self.load()
+        ts = int(time.time())
+        post_id, run_id = sys.intern(str(post_id)), sys.intern(str(run_id))
+        lo, hi = self._span(post_id, run_id)
+        block = dict(zip(self._keys[lo:hi], self._vals[lo:hi]))
+        lines = []
+        for r in results:
+            key = (post_id, run_id, str(r["chat_id"]))
+            val = (int(r["message_id"]), ts, str(r.get("bot") or ""), bool(r.get("merged")))
+            block[key] = val
+            lines.append(self._line(key, val))
+        keys = sorted(block)
+        self._keys[lo:hi] = keys
+        self._vals[lo:hi] = [block[k] for k in keys]
+        self.appended += len(lines)
+        WRITER.append(self.path, "".join(lines).encode("utf-8"))
+
+    @staticmethod
+    def _line(key: Tuple[str, str, str], val: Tuple[int, int, str, bool]) -> str:
+        mid, ts, bot, merged = val
+        flag = "\tm" if merged else ""
+        return f"{ts}\t{key[0]}\t{key[1]}\t{key[2]}\t{mid}\t{bot}{flag}\n"
+
+    def _record(self, i: int) -> Dict[str, Any]:
+        post_id, run_id, chat_id = self._keys[i]
+        mid, ts, bot, merged = self._vals[i]
+        rec = {"post_id": post_id, "run_id": run_id, "chat_id": chat_id, "message_id": mid, "ts": ts}
+        if bot:
+            rec["bot"] = bot
+        if merged:
+            rec["merged"] = True
+        return rec
+
+    def messages(self, post_id: str, run_id: str) -> List[Dict[str, Any]]:
+        """某次群发发出的全部消息"""
+        self.load()
+        lo, hi = self._span(str(post_id), str(run_id))
+        return [self._record(i) for i in range(lo, hi)]
+
+    def runs(self, post_id: str) -> List[Tuple[str, int, int]]:
+        """帖子的历次群发：[(批次, 时间戳, 消息数)]，按时间从早到晚"""
+        self.load()
+        lo, hi = self._span(str(post_id))
+        out: List[Tuple[str, int, int]] = []
+        for i in range(lo, hi):
+            run_id = self._keys[i][1]
+            if out and out[-1][0] == run_id:
+                rid, ts, n = out[-1]
+                out[-1] = (rid, min(ts, self._vals[i][1]), n + 1)
+            else:
+                out.append((run_id, self._vals[i][1], 1))
+        return out
+
+    def latest_run(self, post_id: str) -> Optional[str]:
+        self.load()
+        lo, hi = self._span(str(post_id))
+        return self._keys[hi - 1][1] if hi > lo else None
+
+    def forget(self, post_id: str, run_id: str, chat_ids: Optional[Set[str]] = None):
+        """去掉一次群发（或其中部分群）的记录，并追加删除标记，重启后不会从日志里读回来"""
+        self.load()
+        lo, hi = self._span(str(post_id), str(run_id))
+        keep = [i for i in range(lo, hi) if chat_ids is not None and self._keys[i][2] not in chat_ids]
+        ts = int(time.time())
+        kept = set(keep)
+        lines = [f"{ts}\t{k[0]}\t{k[1]}\t{k[2]}\t0\t\tx\n" for i, k in enumerate(self._keys[lo:hi], lo) if i not in kept]
+        self._keys[lo:hi] = [self._keys[i] for i in keep]
+        self._vals[lo:hi] = [self._vals[i] for i in keep]
+        if lines:
+            self.appended += 2 * len(lines)   # 原记录 + 删除标记，压缩时都会丢掉
+            WRITER.append(self.path, "".join(lines).encode("utf-8"))
+
+    def compact(self) -> int:
+        """丢掉过期记录并整体重写日志，返回丢掉的条数"""
+        self.load()
+        cutoff = time.time() - DELIVERY_RETENTION_DAYS * 86400
+        keep = [i for i, v in enumerate(self._vals) if v[1] >= cutoff]
+        dropped = len(self._keys) - len(keep)
+        if dropped == 0 and self.appended == 0:
+            return 0
+        self._keys = [self._keys[i] for i in keep]
+        self._vals = [self._vals[i] for i in keep]
+        data = "".join(self._line(k, v) for k, v in zip(self._keys, self._vals))
+        WRITER.submit(self.path, data.encode("utf-8"))
+        self.appended = 0
+        return dropped
+
+    def describe(self) -> str:
+        try:
+            size = self.path.stat().st_size
+        except OSError:
+            size = 0
+        return f"投递索引: {len(self._keys)} 条，日志 {size // 1024} KB，待压缩 {self.appended} 行，保留 {DELIVERY_RETENTION_DAYS:g} 天"
+
+DELIVERIES = DeliveryIndex(DELIVERIES_FILE)
+
+async def compact_deliveries_job(context: ContextTypes.DEFAULT_TYPE):
+    dropped = DELIVERIES.compact()
+    if dropped:
+        logger.info(f"[投递索引] 压缩：清理过期 {dropped} 条，剩余 {len(DELIVERIES)} 条")
+
+# ============================================================
+# 发送统计：按帖子 / 群 / 天的滚动计数（定长数组，内存固定），/stats 查看
+# ============================================================
+METRICS_DAYS = int(os.getenv("METRICS_DAYS", "14"))              # 保留最近多少天
+METRICS_MAX_KEYS = int(os.getenv("METRICS_MAX_KEYS", "5000"))    # 帖子 / 群各最多统计多少个
+METRICS_RUNS = int(os.getenv("METRICS_RUNS", "200"))             # 记住最近多少次群发的耗时
+FAIL_REASONS = ("forbidden", "bad_request", "rate_limit", "network", "other")
+FAIL_LABELS = {"forbidden": "无权限/被移出", "bad_request": "请求错误", "rate_limit": "限流", "network": "网络/超时", "other": "其他"}
+METRIC_FIELDS = ("sent",) + FAIL_REASONS
+LATENCY_BOUNDS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 30, 60, float("inf"))   # 发送耗时分桶（秒，含排队）
+
+def fail_reason(exc: BaseException) -> str:
+    if isinstance(exc, Forbidden):
+        return "forbidden"
+    if isinstance(exc, RetryAfter):
+        return "rate_limit"
+    if isinstance(exc, BadRequest):
+        return "bad_request"
+    if isinstance(exc, (TimedOut, httpx.HTTPError)) or type(exc).__name__ == "NetworkError":
+        return "network"
+    return "other"
+
+def local_day(ts: Optional[float] = None) -> int:
+    return int(((ts if ts is not None else time.time()) + TZ_OFFSET * 3600) // 86400)
+
+class DayCounters:
+    """METRICS_DAYS 天 × width 个计数放在一个 array 里，按天号取模循环复用（旧的一天在写入时清零）"""
+    __slots__ = ("width", "counts", "stamps")
+
+    def __init__(self, width: int):
+        self.width = width
+        self.counts = array.array("I", bytes(array.array("I").itemsize * METRICS_DAYS * width))
+        self.stamps = array.array("i", [-1] * METRICS_DAYS)
+
+    def add(self, day: int, field: int, n: int = 1):
+        slot = day % METRICS_DAYS
+        if self.stamps[slot] != day:
+            base = slot * self.width
+            self.counts[base:base + self.width] = array.array("I", bytes(array.array("I").itemsize * self.width))
+            self.stamps[slot] = day
+        self.counts[slot * self.width + field] += n
+
+    def total(self, first_day: int, last_day: int) -> List[int]:
+        out = [0] * self.width
+        for slot, day in enumerate(self.stamps):
+            if first_day <= day <= last_day:
+                base = slot * self.width
+                for i in range(self.width):
+                    out[i] += self.counts[base + i]
+        return out
+
+    def dump(self) -> Dict[str, Any]:
+        return {"stamps": list(self.stamps), "counts": list(self.counts)}
+
+    @classmethod
+    def restore(cls, width: int, d: Dict[str, Any]) -> "DayCounters":
+        c = cls(width)
+        if len(d.get("stamps", [])) == METRICS_DAYS and len(d.get("counts", [])) == METRICS_DAYS * width:
+            c.stamps = array.array("i", d["stamps"])
+            c.counts = array.array("I", d["counts"])
+        return c
+
+class Metrics:
+    def __init__(self, path: Path):
+        self.path = path
+        self.posts: Dict[str, DayCounters] = {}
+        self.groups: Dict[str, DayCounters] = {}
+        self.latency = DayCounters(len(LATENCY_BOUNDS))
+        self.runs: deque = deque(maxlen=METRICS_RUNS)   # (帖子, 标签, 开始时间戳, 耗时秒, 群数, 成功, 失败)
+
+    def _counters(self, table: Dict[str, DayCounters], key: str) -> DayCounters:
+        c = table.get(key)
+        if c is None:
+            if len(table) >= METRICS_MAX_KEYS:
+                del table[next(iter(table))]   # 超量时丢掉最早加入的
+            c = table[key] = DayCounters(len(METRIC_FIELDS))
+        return c
+
+    def sent(self, post_id: str, cid: str, seconds: float):
+        day = local_day()
+        self._counters(self.posts, post_id).add(day, 0)
+        self._counters(self.groups, cid).add(day, 0)
+        self.latency.add(day, bisect.bisect_left(LATENCY_BOUNDS, seconds))
+
+    def failed(self, post_id: str, cid: str, exc: BaseException):
+        day, field = local_day(), 1 + FAIL_REASONS.index(fail_reason(exc))
+        self._counters(self.posts, post_id).add(day, field)
+        self._counters(self.groups, cid).add(day, field)
+
+    def run(self, post_id: str, b: "Broadcast"):
+        self.runs.append((post_id, b.label, time.time() - b.elapsed(), b.elapsed(), b.total, b.sent, b.failed))
+
+    def latency_percentile(self, first_day: int, last_day: int, q: float) -> Optional[float]:
+        hist = self.latency.total(first_day, last_day)
+        n = sum(hist)
+        if not n:
+            return None
+        acc = 0
+        for bound, c in zip(LATENCY_BOUNDS, hist):
+            acc += c
+            if acc >= q * n:
+                return bound
+        return LATENCY_BOUNDS[-1]
+
+    def save(self):
+        data = {
+            "days": METRICS_DAYS,
+            "posts": {k: v.dump() for k, v in self.posts.items()},
+            "groups": {k: v.dump() for k, v in self.groups.items()},
+            "latency": self.latency.dump(),
+            "runs": list(self.runs),
+        }
+        WRITER.submit(self.path, json_dumps(data))
+
+    def load(self):
+        try:
+            data = json_loads(self.path.read_bytes())
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.error(f"{self.path.name} 解析失败：{e}")
+            return
+        if data.get("days") != METRICS_DAYS:
+            return
+        w = len(METRIC_FIELDS)
+        self.posts = {k: DayCounters.restore(w, v) for k, v in data.get("posts", {}).items()}
+        self.groups = {k: DayCounters.restore(w, v) for k, v in data.get("groups", {}).items()}
+        self.latency = DayCounters.restore(len(LATENCY_BOUNDS), data.get("latency", {}))
+        self.runs.extend(tuple(r) for r in data.get("runs", []))
+
+METRICS = Metrics(METRICS_FILE)
+
+async def save_metrics_job(context: ContextTypes.DEFAULT_TYPE):
+    METRICS.save()
+
+def _fmt_counts(c: List[int]) -> str:
+    failed = sum(c[1:])
+    total = c[0] + failed
+    if not total:
+        return "无发送"
+    rate = c[0] * 100 / total if total else 100.0
+    s = f"成功 {c[0]}，失败 {failed}（成功率 {rate:.1f}%）"
+    if failed:
+        s += "：" + "，".join(f"{FAIL_LABELS[r]} {n}" for r, n in zip(FAIL_REASONS, c[1:]) if n)
+    return s
+
+def fmt_stats(groups_map: Dict[str, str], post_id: Optional[str] = None) -> str:
+    today = local_day()
+    if post_id:
+        c = METRICS.posts.get(post_id)
+        if c is None:
+            return f"📊 任务 {post_id} 暂无统计"
+        s = f"📊 任务 {post_id}（最近 7 天）\n"
+        for d in range(today - 6, today + 1):
+            day_c = c.total(d, d)
+            if any(day_c):
+                s += f"{datetime.fromtimestamp(d * 86400, tz=timezone.utc).strftime('%m/%d')}：{_fmt_counts(day_c)}\n"
+        runs = [r for r in METRICS.runs if r[0] == post_id][-5:]
+        if runs:
+            s += "\n最近发送：\n"
+            for _, _, start, dur, total, sent, failed in reversed(runs):
+                s += f" - {fmt_ts(int(start))} {total} 群，成功 {sent} 失败 {failed}，耗时 {fmt_duration(dur)}\n"
+        return s
+
+    def window(table: Dict[str, DayCounters], first: int) -> Dict[str, List[int]]:
+        return {k: v.total(first, today) for k, v in table.items()}
+
+    s = "📊 发送统计\n"
+    for name, first, last in (("今天", today, today), ("昨天", today - 1, today - 1), ("近 7 天", today - 6, today)):
+        totals = [sum(col) for col in zip(*(v.total(first, last) for v in METRICS.posts.values()))] or [0] * len(METRIC_FIELDS)
+        s += f"{name}：{_fmt_counts(totals)}\n"
+    p50, p95 = METRICS.latency_percentile(today, today, 0.5), METRICS.latency_percentile(today, today, 0.95)
+    if p50 is not None:
+        s += f"今天单条发送耗时（含排队）：p50 ≤{p50:g}s，p95 ≤{p95:g}s\n"
+
+    week_groups = window(METRICS.groups, today - 6)
+    worst = sorted(((sum(c[1:]), k, c) for k, c in week_groups.items() if sum(c[1:])), reverse=True)[:5]
+    if worst:
+        s += "\n近 7 天失败最多的群：\n"
+        for failed, cid, c in worst:
+            reason = FAIL_REASONS[max(range(len(FAIL_REASONS)), key=lambda i: c[1 + i])]
+            s += f" - {groups_map.get(cid, cid)}（{cid}）失败 {failed}/{failed + c[0]}，主要原因：{FAIL_LABELS[reason]}\n"
+
+    week_posts = window(METRICS.posts, today - 6)
+    busiest = sorted(((c[0] + sum(c[1:]), k, c) for k, c in week_posts.items() if any(c)), reverse=True)[:5]
+    if busiest:
+        s += "\n近 7 天发送最多的任务：\n"
+        for total, pid, c in busiest:
+            s += f" - {pid}：{_fmt_counts(c)}\n"
+
+    runs = list(METRICS.runs)[-5:]
+    if runs:
+        s += "\n最近群发：\n"
+        for pid, label, start, dur, total, sent, failed in reversed(runs):
+            s += f" - {fmt_ts(int(start))} {label}：{total} 群，失败 {failed}，耗时 {fmt_duration(dur)}\n"
+    s += "\n查看单个任务：/stats <任务ID>"
+    return s
+
+async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not is_admin(user.id):
+        await update.message.reply_text(f"⛔ 无权限。你的ID：{user.id}")
+        return
+    post_id = context.args[0] if context.args else None
+    await update.message.reply_text(fmt_stats(load_groups(), post_id))
+
+# ============================================================
+# 群发流水线：多个群发同时进行时按轮询交错（小群发不被大群发拖住）
+# ============================================================
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))  # 同时在途的发送数
+MAX_ACTIVE_BROADCASTS = int(os.getenv("MAX_ACTIVE_BROADCASTS", "4"))    # 同时进行的群发数，超出的排队
+MAX_QUEUED_SENDS = int(os.getenv("MAX_QUEUED_SENDS", "20000"))          # 进行中的群发合计待发条数上限
+
+class Broadcast:
+    """一次群发：对每个群执行 action(chat_id)，结果 / 失败汇总在这里"""
+
+    def __init__(self, label: str, chat_ids: List[str], action: Callable, lane: int = LANE_SCHEDULED, weight: int = 1,
+                 verb: str = "发送"):
+        self.run_id = gen_run_id()
+        self.label = label
+        self.verb = verb
+        self.lane = lane
+        self.weight = max(1, int(weight))
+        self.action = action
+        self.pending = deque(chat_ids)
+        self.total = len(chat_ids)
+        self.in_flight = 0
+        self.sent = 0
+        self.failed = 0
+        self.results: List[Dict[str, Any]] = []
+        self.errors: List[Tuple[str, str]] = []
+        self.started_at = time.monotonic()
+        self.started = False
+        self.finished_at: Optional[float] = None
+        self.done: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._quota = self.weight
+
+    @property
+    def remaining(self) -> int:
+        return len(self.pending) + self.in_flight
+
+    def elapsed(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    def throughput(self) -> float:
+        el = self.elapsed()
+        return (self.sent + self.failed) / el if el > 0 else 0.0
+
+class Broadcaster:
+    def __init__(self, workers: int = BROADCAST_WORKERS):
+        self.workers = max(1, workers)
+        self.active: deque = deque()
+        self.running: List[Broadcast] = []   # 进行中的群发（含已派完、还有在途请求的）
+        self.waiting: List[Tuple[int, int, Broadcast]] = []   # 排队中的群发：堆，按 (通道, 到达顺序)
+        self._seq = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def _ensure_workers(self):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        self._tasks = [t for t in self._tasks if not t.done()]
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    # ---- 准入控制：进行中的群发数 / 合计待发条数超限时排队，完成一个放行一个 ----
+    def queued_sends(self) -> int:
+        return sum(b.remaining for b in self.running)
+
+    def _can_admit(self, b: Broadcast) -> bool:
+        if not self.running:
+            return True   # 再大的群发也不能永远排不上
+        return len(self.running) < MAX_ACTIVE_BROADCASTS and self.queued_sends() + b.total <= MAX_QUEUED_SENDS
+
+    def position(self, b: Broadcast) -> int:
+        """排队位置（1 开始）；不在排队返回 0"""
+        for i, (_, _, w) in enumerate(sorted(self.waiting, key=lambda x: x[:2]), 1):
+            if w is b:
+                return i
+        return 0
+
+    def _start(self, b: Broadcast):
+        b.started = True
+        b.started_at = time.monotonic()
+        self.active.append(b)
+        self.running.append(b)
+        self._ensure_workers()
+        self._wakeup.set()
+
+    def _admit_waiting(self):
+        while self.waiting and self._can_admit(self.waiting[0][2]):
+            self._start(heapq.heappop(self.waiting)[2])
+
+    def submit(self, b: Broadcast) -> bool:
+        """登记一个群发：能直接开始返回 True，否则进入排队返回 False"""
+        if not b.pending:
+            b.started = True
+            b.finished_at = time.monotonic()
+            if not b.done.done():
+                b.done.set_result(b)
+            return True
+        if not self.waiting and self._can_admit(b):
+            self._start(b)
+            return True
+        self._seq += 1
+        heapq.heappush(self.waiting, (b.lane, self._seq, b))
+        logger.info(f"[群发排队] {b.label} {b.total} 群，第 {self.position(b)} 位（进行中 {len(self.running)}）")
+        return False
+
+    async def wait(self, b: Broadcast) -> Broadcast:
+        try:
+            await b.done
+        finally:
+            if b in self.running:
+                self.running.remove(b)
+            elif not b.started:
+                # 排队时被取消
+                self.waiting = [w for w in self.waiting if w[2] is not b]
+                heapq.heapify(self.waiting)
+            self._admit_waiting()
+        return b
+
+    async def run(self, b: Broadcast) -> Broadcast:
+        self.submit(b)
+        return await self.wait(b)
+
+    def _next_item(self) -> Optional[Tuple[Broadcast, str]]:
+        # 轮询：每个群发按 weight 连续取若干个群，然后轮到下一个
+        while self.active:
+            b = self.active[0]
+            if not b.pending:
+                self.active.popleft()
+                continue
+            cid = b.pending.popleft()
+            b._quota -= 1
+            if b._quota <= 0 or not b.pending:
+                b._quota = b.weight
+                self.active.rotate(-1)
+            return b, cid
+        return None
+
+    async def _worker(self):
+        while True:
+            item = self._next_item()
+            if item is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            b, cid = item
+            b.in_flight += 1
+            try:
+                res = await b.action(cid)
+                b.sent += 1
+                if res:
+                    b.results.append(res)
+            except Exception as e:
+                b.failed += 1
+                b.errors.append((cid, str(e)))
+                logger.error(f"[群发失败] {b.label} chat={cid} err={e}")
+            finally:
+                b.in_flight -= 1
+                if not b.pending and b.in_flight == 0 and not b.done.done():
+                    b.finished_at = time.monotonic()
+                    b.done.set_result(b)
+
+BROADCASTER = Broadcaster()
+
+# =========================
+# 群发进度：给发起人 / 指定管理群发一条状态消息，节流编辑
+# =========================
+PROGRESS_CHAT_ID = int(os.getenv("PROGRESS_CHAT_ID", "0") or 0)     # 定时/循环任务的进度发到这里；不填则发给创建者
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", "5"))      # 最快多少秒编辑一次
+PROGRESS_MIN_GROUPS = int(os.getenv("PROGRESS_MIN_GROUPS", "20"))   # 群数少于此值不显示实时进度
+
+def fmt_progress(b: Broadcast) -> str:
+    if not b.started:
+        return (f"⏳ {b.label} 排队中：第 {BROADCASTER.position(b)} 位（{b.total} 群）\n"
+                f"进行中 {len(BROADCASTER.running)} 个群发，待发 {BROADCASTER.queued_sends()} 条；前面完成后自动开始")
+    done = b.sent + b.failed
+    pct = done * 100 // b.total if b.total else 100
+    rate = b.throughput()
+    if b.done.done():
+        return (f"🎉 {b.label} 完成\n"
+                f"✅ 成功 {b.sent}  ❌ 失败 {b.failed}  共 {b.total} 群\n"
+                f"耗时 {fmt_duration(b.elapsed())}，平均 {rate:.1f} 条/秒")
+    eta = fmt_duration(b.remaining / rate) if rate > 0 else "估算中"
+    return (f"📤 {b.label} {b.verb}中… {done}/{b.total}（{pct}%）\n"
+            f"✅ 成功 {b.sent}  ❌ 失败 {b.failed}  ⏳ 剩余 {b.remaining}\n"
+            f"速度 {rate:.1f} 条/秒，预计还需 {eta}")
+
+class ProgressReporter:
+    def __init__(self, bot, chat_id: int, b: Broadcast):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.b = b
+        self.message_id: Optional[int] = None
+        self._last_text = ""
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        try:
+            m = await self.bot.send_message(chat_id=self.chat_id, text=fmt_progress(self.b), rate_limit_args=LANE_INTERACTIVE)
+            self.message_id = m.message_id
+        except Exception as e:
+            logger.error(f"[进度消息发送失败] chat={self.chat_id} err={e}")
+            return
+        self._task = asyncio.create_task(self._loop())
+
+    async def _edit(self):
+        text = fmt_progress(self.b)
+        if text == self._last_text or self.message_id is None:
+            return
+        try:
+            await self.bot.edit_message_text(
+                chat_id=self.chat_id, message_id=self.message_id, text=text, rate_limit_args=LANE_INTERACTIVE
+            )
+            self._last_text = text
+        except Exception as e:
+            logger.warning(f"[进度消息编辑失败] chat={self.chat_id} err={e}")
+
+    async def _loop(self):
+        while not self.b.done.done():
+            await asyncio.wait({self.b.done}, timeout=PROGRESS_INTERVAL)
+            if not self.b.done.done():
+                await self._edit()
+
+    async def finish(self):
+        if self._task:
+            self._task.cancel()
+        await self._edit()
+
+async def broadcast_content(
+    context: ContextTypes.DEFAULT_TYPE,
+    label: str,
+    chat_ids: List[str],
+    content: Dict[str, Any],
+    buttons: Optional[Dict[str, Any]] = None,
+    lane: int = LANE_SCHEDULED,
+    weight: int = 1,
+    progress_chat_id: Optional[int] = None,
+    post_id: str = IMMEDIATE_POST_ID,
+) -> Broadcast:
+    content = dict(content)   # send_resilient 可能换 file_id：只改这次群发的副本，不碰帖子
+
+    async def action(cid: str) -> Dict[str, Any]:
+        t0 = time.monotonic()
+        try:
+            res = await send_resilient(context, cid, content, buttons, lane, progress_chat_id)
+        except Exception as e:
+            METRICS.failed(post_id, cid, e)
+            raise
+        METRICS.sent(post_id, cid, time.monotonic() - t0)
+        return res
+
+    b = Broadcast(label, list(chat_ids), action, lane=lane, weight=weight)
+    await run_broadcast(context, b, progress_chat_id)
+    DELIVERIES.record(post_id, b.run_id, b.results)
+    for r in b.results:
+        r["deliveries"] = [(post_id, b.run_id)]   # 自动删除后据此清掉投递记录
+    METRICS.run(post_id, b)
+    return b
+
+async def run_broadcast(context: ContextTypes.DEFAULT_TYPE, b: Broadcast, progress_chat_id: Optional[int] = None) -> Broadcast:
+    """执行一次群发；群数够多时给 progress_chat_id 显示实时进度"""
+    started = BROADCASTER.submit(b)
+    reporter = None
+    if progress_chat_id and b.total >= PROGRESS_MIN_GROUPS:
+        reporter = ProgressReporter(context.bot, progress_chat_id, b)
+        await reporter.start()
+    elif progress_chat_id and not started:
+        # 小群发没有进度消息，排队时单独告知一声
+        try:
+            await context.bot.send_message(chat_id=progress_chat_id, text=fmt_progress(b), rate_limit_args=LANE_INTERACTIVE)
+        except Exception as e:
+            logger.warning(f"[排队提示发送失败] chat={progress_chat_id} err={e}")
+    await BROADCASTER.wait(b)
+    if reporter:
+        await reporter.finish()
+    return b
+
+def progress_chat_for(post: Dict[str, Any]) -> Optional[int]:
+    return PROGRESS_CHAT_ID or post.get("owner")
+
+def schedule_auto_delete(job_queue, messages: List[Dict[str, Any]], delete_minutes: int):
+    if delete_minutes > 0 and messages and job_queue is not None:
+        job_queue.run_once(
+            delete_messages_job,
+            when=delete_minutes * 60,
+            data={"messages": messages}
+        )
+
+# ============================================================
+# 合并发送（可选）：同一时刻到点的多个任务，对同一个群合并成一条或按间隔依次发送
+# ============================================================
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "0"))       # 收集窗口秒数；0 = 关闭
+COALESCE_MODE = os.getenv("COALESCE_MODE", "merge")              # merge = 文字帖合并成一条；sequence = 依次发送
+COALESCE_SPACING = float(os.getenv("COALESCE_SPACING", "3"))     # 同一群两条消息之间至少间隔秒数
+COALESCE_SEPARATOR = "\n\n"
+TEXT_LIMIT = 4096          # 单条文字消息长度上限
+MERGE_MAX_BUTTON_ROWS = 8  # 合并消息最多带几行按钮
+
+POST_LABELS = {"schedule": "定时发送", "daily": "循环发送"}
+
+async def broadcast_post(context: ContextTypes.DEFAULT_TYPE, post: Dict[str, Any]) -> List[Dict[str, Any]]:
+    b = await broadcast_content(
+        context, f"{POST_LABELS.get(post.get('type'), '发送')} post={post['id']}", post.get("groups", []),
+        post.get("content", {}), buttons=post.get("buttons"), lane=LANE_SCHEDULED,
+        weight=post.get("weight", 1), progress_chat_id=progress_chat_for(post), post_id=post["id"]
+    )
+    return b.results
+
+def coalesce_units(posts: List[Dict[str, Any]], mode: str = COALESCE_MODE) -> List[Tuple[Dict[str, Any], Any, List[str]]]:
+    """
+    同一个群要收到的多个任务 -> 实际要发的消息：[(content, buttons, 来源帖子 ID 列表)]
+    只合并文字帖，且自动删除时间相同（否则先删的会带走别的任务的内容）、合并后不超长。
+    """
+    units: List[Tuple[Dict[str, Any], Any, List[str]]] = []
+    last: Optional[Dict[str, Any]] = None
+    for p in posts:
+        content = p.get("content", {})
+        buttons = p.get("buttons")
+        if (mode == "merge" and last is not None
+                and content.get("type") == "text" and last.get("content", {}).get("type") == "text"
+                and int(p.get("delete_minutes", 0)) == int(last.get("delete_minutes", 0))):
+            prev_content, prev_buttons, ids = units[-1]
+            text = prev_content.get("text", "") + COALESCE_SEPARATOR + (content.get("text") or "")
+            rows = (prev_buttons if isinstance(prev_buttons, list) else [prev_buttons] if prev_buttons else [])
+            rows = rows + ([buttons] if buttons else [])
+            if len(text) <= TEXT_LIMIT and len(rows) <= MERGE_MAX_BUTTON_ROWS:
+                units[-1] = ({"type": "text", "text": text}, rows or None, ids + [p["id"]])
+                last = p
+                continue
+        units.append((dict(content), buttons, [p["id"]]))   # 副本：发送时可能换 file_id
+        last = p
+    return units
+
+class Coalescer:
+    """收集 COALESCE_WINDOW 秒内到点的任务，一起按群规划后分轮发送"""
+
+    def __init__(self):
+        self._batch: List[Tuple[Dict[str, Any], asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self.merged_saved = 0   # 合并后少发的消息数
+
+    async def submit(self, context: ContextTypes.DEFAULT_TYPE, post: Dict[str, Any]) -> List[Dict[str, Any]]:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._batch.append((post, fut))
+        if self._timer is None:
+            self._timer = loop.call_later(COALESCE_WINDOW, self._start_flush, context)
+        return await fut
+
+    def _start_flush(self, context):
+        batch, self._batch, self._timer = self._batch, [], None
+        task = asyncio.create_task(self._flush(context, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, context, batch):
+        try:
+            results = await self._send(context, [p for p, _ in batch])
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for p, fut in batch:
+            if not fut.done():
+                fut.set_result(results.get(p["id"], []))
+
+    async def _send(self, context, posts: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+        if len(posts) == 1:
+            return {posts[0]["id"]: await broadcast_post(context, posts[0])}
+
+        # 每个群收到哪些任务（保持到点顺序）；相同组合只规划一次
+        per_chat: Dict[str, List[Dict[str, Any]]] = {}
+        for p in posts:
+            for cid in p.get("groups", []):
+                per_chat.setdefault(cid, []).append(p)
+        plans: Dict[Tuple[str, ...], list] = {}
+        chat_units: Dict[str, list] = {}
+        for cid, ps in per_chat.items():
+            key = tuple(p["id"] for p in ps)
+            if key not in plans:
+                plans[key] = coalesce_units(ps)
+            chat_units[cid] = plans[key]
+        self.merged_saved += sum(len(ps) - len(chat_units[cid]) for cid, ps in per_chat.items())
+
+        label = "合并发送 " + ",".join(p["id"] for p in posts)
+        weight = max(int(p.get("weight", 1)) for p in posts)
+        owner = progress_chat_for(posts[0])
+        delivered: Dict[str, List[Dict[str, Any]]] = {p["id"]: [] for p in posts}
+        run_ids = {pid: gen_run_id() for pid in delivered}
+        rounds = max(len(u) for u in chat_units.values()) if chat_units else 0
+        # 分轮：第 k 轮给每个群发它的第 k 条，轮与轮之间至少隔 COALESCE_SPACING 秒
+        for k in range(rounds):
+            started = time.monotonic()
+
+            async def action(cid: str, k: int = k) -> Dict[str, Any]:
+                content, buttons, ids = chat_units[cid][k]
+                t0 = time.monotonic()
+                try:
+                    rec = await send_resilient(context, cid, content, buttons, LANE_SCHEDULED, owner)
+                except Exception as e:
+                    for pid in ids:
+                        METRICS.failed(pid, cid, e)
+                    raise
+                for pid in ids:
+                    METRICS.sent(pid, cid, time.monotonic() - t0)
+                return {**rec, "posts": ids}
+
+            chats = [cid for cid, u in chat_units.items() if len(u) > k]
+            b = Broadcast(f"{label}（第 {k + 1}/{rounds} 轮）", chats, action, lane=LANE_SCHEDULED, weight=weight)
+            await run_broadcast(context, b, owner)
+            METRICS.run("+".join(p["id"] for p in posts), b)
+            for r in b.results:
+                ids = r.pop("posts")
+                if len(ids) > 1:
+                    r["merged"] = True
+                r["deliveries"] = [(pid, run_ids[pid]) for pid in ids]
+                for i, pid in enumerate(ids):
+                    # 合并消息只由第一个任务负责自动删除
+                    delivered[pid].append(r if i == 0 else {**r, "shared": True})
+            if k + 1 < rounds:
+                await asyncio.sleep(max(0.0, COALESCE_SPACING - (time.monotonic() - started)))
+
+        for pid, recs in delivered.items():
+            DELIVERIES.record(pid, run_ids[pid], recs)
+        logger.info(f"[合并发送] {len(posts)} 个任务，{len(per_chat)} 个群，{rounds} 轮，累计少发 {self.merged_saved} 条")
+        return delivered
+
+COALESCER = Coalescer()
+
+async def dispatch_post(context: ContextTypes.DEFAULT_TYPE, post: Dict[str, Any]):
+    """定时 / 循环任务到点：发送（开启合并时先进收集窗口），再按帖子设置安排自动删除"""
+    await validate_media(context.bot, post)
+    post = REPO.get(post["id"]) or post   # file_id 可能刚被换过
+    if COALESCE_WINDOW > 0:
+        results = await COALESCER.submit(context, post)
+    else:
+        results = await broadcast_post(context, post)
+    own = [r for r in results if not r.get("shared")]
+    schedule_auto_delete(context.job_queue, own, int(post.get("delete_minutes", 0)))
+
+# ============================================================
+# 发送预演：按当前限速 + 同时段其他任务模拟发送时间线（不会真正发送）
+# ============================================================
+TG_GLOBAL_LIMIT = 30        # Telegram 公布的全局上限：约 30 条/秒
+TG_GROUP_LIMIT = 20         # 单群上限：约 20 条/分钟
+SIMULATE_WINDOW_MIN = int(os.getenv("SIMULATE_WINDOW_MIN", "60"))      # 查找前后多少分钟内的其他任务
+SIMULATE_LATENCY_MS = int(os.getenv("SIMULATE_LATENCY_MS", "150"))     # 估算单次请求耗时
+
+def post_fire_time(p: Dict[str, Any], now: datetime) -> Optional[datetime]:
+    """帖子下一次（晚于 now）发送时间；停用 / 已结束返回 None"""
+    if not p.get("enabled", True):
+        return None
+    if p.get("type") == "schedule":
+        dt = datetime.fromisoformat(p.get("send_time"))
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=LOCAL_TZ)
+        return dt if dt > now else None
+    if p.get("type") == "daily":
+        if p.get("next_fire"):
+            dt = datetime.fromisoformat(p["next_fire"])
+            if dt > now:
+                return dt
+        rec = post_recurrence(p)
+        return next_fire_after(rec, now) if rec else None
+    return None
+
+def post_fires_between(p: Dict[str, Any], lo: datetime, hi: datetime, limit: int = 500) -> List[datetime]:
+    out = []
+    dt = post_fire_time(p, lo - timedelta(seconds=1))
+    rec = post_recurrence(p) if p.get("type") == "daily" else None
+    while dt and dt <= hi and len(out) < limit:
+        out.append(dt)
+        dt = next_fire_after(rec, dt) if rec else None
+    return out
+
+def simulate_timeline(
+    runs: List[Dict[str, Any]],
+    rate: float = SEND_RATE_PER_SEC,
+    group_rate: int = GROUP_RATE_PER_MIN,
+    workers: int = BROADCAST_WORKERS,
+    latency_ms: int = SIMULATE_LATENCY_MS,
+) -> Dict[str, Dict[str, Any]]:
+    """
+    runs: [{"key", "start": datetime, "groups": [...], "weight"}]
+    按群发流水线的规则（全局令牌 + 单群滑动窗口 + 轮询交错）推演，
+    返回 {key: {"start", "end", "throttled"}}；throttled = 因单群限速而推迟的条数
+    """
+    latency = max(latency_ms, 1) / 1000.0
+    eff_rate = min(rate if rate > 0 else float("inf"), workers / latency)
+    step = 1.0 / eff_rate
+
+    base = min((r["start"] for r in runs), default=now_local())
+    upcoming = sorted(runs, key=lambda r: r["start"])
+    state = {r["key"]: {"start": r["start"], "end": r["start"], "throttled": 0, "left": len(r["groups"])} for r in runs}
+    active: deque = deque()
+    deferred: List[Tuple[float, int, str, str]] = []
+    windows: Dict[str, deque] = {}
+    t, seq = 0.0, 0
+
+    def chat_ready_at(cid: str) -> float:
+        w = windows.get(cid)
+        if not w or group_rate <= 0:
+            return t
+        while w and t - w[0] >= 60:
+            w.popleft()
+        return t if len(w) < group_rate else w[0] + 60
+
+    while upcoming or active or deferred:
+        while upcoming and (upcoming[0]["start"] - base).total_seconds() <= t:
+            r = upcoming.pop(0)
+            active.append([r["key"], deque(r["groups"]), max(1, int(r.get("weight", 1))), 0])
+
+        item = None
+        while item is None and deferred and deferred[0][0] <= t:
+            _, _, key, cid = heapq.heappop(deferred)
+            # 推迟期间别的发送可能又占满了这个群的窗口：重新判断，仍未就绪就按新时间放回
+            ready = chat_ready_at(cid)
+            if ready > t:
+                seq += 1
+                heapq.heappush(deferred, (ready, seq, key, cid))
+                continue
+            item = (key, cid)
+        while item is None and active:
+            b = active[0]
+            if not b[1]:
+                active.popleft()
+                continue
+            cid = b[1].popleft()
+            b[3] += 1
+            if b[3] >= b[2] or not b[1]:
+                b[3] = 0
+                active.rotate(-1)
+            ready = chat_ready_at(cid)
+            if ready > t:
+                state[b[0]]["throttled"] += 1
+                seq += 1
+                heapq.heappush(deferred, (ready, seq, b[0], cid))
+                continue
+            item = (b[0], cid)
+
+        if item is None:
+            nxt = [d[0] for d in deferred[:1]]
+            if upcoming:
+                nxt.append((upcoming[0]["start"] - base).total_seconds())
+            if not nxt:
+                break
+            t = max(t, min(nxt))
+            continue
+
+        key, cid = item
+        windows.setdefault(cid, deque()).append(t)
+        st = state[key]
+        st["left"] -= 1
+        st["end"] = base + timedelta(seconds=t + latency)
+        t += step
+
+    return state
+
+def dry_run_report(
+    groups: List[str],
+    fire_at: datetime,
+    posts: List[Dict[str, Any]],
+    exclude_id: Optional[str] = None,
+    weight: int = 1,
+    rate: float = SEND_RATE_PER_SEC,
+    group_rate: int = GROUP_RATE_PER_MIN,
+    workers: int = BROADCAST_WORKERS,
+    latency_ms: int = SIMULATE_LATENCY_MS,
+) -> str:
+    window = timedelta(minutes=SIMULATE_WINDOW_MIN)
+    target = {"key": "__target__", "start": fire_at, "groups": list(groups), "weight": weight}
+    runs = [target]
+    others: Dict[str, Dict[str, Any]] = {}
+    for p in posts:
+        if p.get("id") == exclude_id:
+            continue
+        for i, dt in enumerate(post_fires_between(p, fire_at - window, fire_at + window)):
+            key = f"{p.get('id')}#{i}"
+            runs.append({"key": key, "start": dt, "groups": list(p.get("groups", [])), "weight": p.get("weight", 1)})
+            others[key] = p
+
+    state = simulate_timeline(runs, rate=rate, group_rate=group_rate, workers=workers, latency_ms=latency_ms)
+    me = state["__target__"]
+    eff = min(rate if rate > 0 else float("inf"), workers / (max(latency_ms, 1) / 1000.0))
+
+    target_set = set(groups)
+    overlaps = []
+    for key, p in others.items():
+        st = state[key]
+        if st["start"] <= me["end"] and st["end"] >= me["start"]:
+            shared = len(target_set & set(p.get("groups", [])))
+            overlaps.append((st["start"], p, shared, st))
+    overlaps.sort(key=lambda x: x[0])
+
+    risks = []
+    if rate > TG_GLOBAL_LIMIT:
+        risks.append(f"全局速率 {rate:g}/秒 超过 Telegram 上限 {TG_GLOBAL_LIMIT}/秒，可能触发 429")
+    if group_rate > TG_GROUP_LIMIT:
+        risks.append(f"单群速率 {group_rate}/分钟 超过 Telegram 上限 {TG_GROUP_LIMIT}/分钟")
+    shared_total = sum(x[2] for x in overlaps)
+    if me["throttled"]:
+        risks.append(f"{me['throttled']} 条因单群限速推迟（同群 1 分钟内超过 {group_rate} 条）")
+    if shared_total:
+        risks.append(f"与同时段任务共用 {shared_total} 个群，群成员会连续收到多条")
+    level = "高" if rate > TG_GLOBAL_LIMIT or group_rate > TG_GROUP_LIMIT else ("中" if risks else "低")
+
+    s = "🧪 发送预演（不会真正发送）\n"
+    s += f"开始：{fire_at.astimezone(LOCAL_TZ).strftime('%Y/%m/%d %H:%M:%S')}\n"
+    s += f"群数：{len(groups)}\n"
+    s += f"预计完成：{me['end'].astimezone(LOCAL_TZ).strftime('%Y/%m/%d %H:%M:%S')}（耗时 {fmt_duration((me['end'] - fire_at).total_seconds())}）\n"
+    s += f"有效速率：{eff:.1f} 条/秒（全局 {rate:g}/秒，并发 {workers}，单次约 {latency_ms}ms）\n"
+    s += f"同时段其他任务：{len(overlaps)} 个\n"
+    for start, p, shared, st in overlaps[:10]:
+        s += (f" - {p.get('id')} {start.astimezone(LOCAL_TZ).strftime('%m/%d %H:%M')} "
+              f"{len(p.get('groups', []))} 群，共用 {shared} 群，约 {fmt_duration((st['end'] - st['start']).total_seconds())}\n")
+    s += f"限流风险：{level}\n"
+    for r in risks:
+        s += f" ⚠️ {r}\n"
+    return s
+
+# =========================
+# 运行状态：事件循环延迟采样 + 任务 / 定时任务 / 群发概览（Debug 用）
+# =========================
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))   # 采样间隔秒
+LOOP_LAG_WARN_MS = float(os.getenv("LOOP_LAG_WARN_MS", "500"))     # 超过即记一条卡顿警告
+DEBUG_LIST_MAX = 10
+
+class LoopMonitor:
+    """定时 sleep 一小段，实际醒来比预期晚多少就是事件循环被占住的时间"""
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.lag = RollingStats(600)
+        self.stalls = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="loop-monitor")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            t0 = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - t0 - self.interval)
+            self.lag.add(lag)
+            if lag * 1000 >= LOOP_LAG_WARN_MS:
+                self.stalls += 1
+                logger.warning(f"[事件循环卡顿] 延迟 {lag * 1000:.0f}ms，当前任务 {len(asyncio.all_tasks())} 个")
+
+LOOP_MONITOR = LoopMonitor()
+
+def task_groups() -> List[Tuple[str, int]]:
+    counts: Dict[str, int] = {}
+    for t in asyncio.all_tasks():
+        coro = t.get_coro()
+        name = getattr(coro, "__qualname__", None) or type(coro).__name__
+        counts[name] = counts.get(name, 0) + 1
+    return sorted(counts.items(), key=lambda kv: -kv[1])
+
+def fmt_runtime_status(app: Application) -> str:
+    s = "🩺 运行状态\n"
+    s += f"事件循环延迟: {LOOP_MONITOR.lag.summary()}，卡顿 {LOOP_MONITOR.stalls} 次（≥{LOOP_LAG_WARN_MS:g}ms）\n"
+
+    groups = task_groups()
+    s += f"\nasyncio 任务 {sum(n for _, n in groups)} 个：\n"
+    for name, n in groups[:DEBUG_LIST_MAX]:
+        s += f" - {name} × {n}\n"
+
+    jq = getattr(app, "job_queue", None)
+    jobs = sorted((j for j in jq.jobs() if j.next_t), key=lambda j: j.next_t) if jq else []
+    s += f"\n待执行定时任务 {len(jobs)} 个：\n"
+    for j in jobs[:DEBUG_LIST_MAX]:
+        s += f" - {j.name} @ {j.next_t.astimezone(LOCAL_TZ).strftime('%m/%d %H:%M:%S')}\n"
+
+    running = BROADCASTER.running
+    s += f"\n进行中的群发 {len(running)} 个（上限 {MAX_ACTIVE_BROADCASTS}，待发 {BROADCASTER.queued_sends()}/{MAX_QUEUED_SENDS} 条）：\n"
+    for b in running[:DEBUG_LIST_MAX]:
+        s += (f" - {b.label}：{b.sent + b.failed}/{b.total}，在途 {b.in_flight}，失败 {b.failed}，"
+              f"{b.throughput():.1f} 条/秒，已 {fmt_duration(b.elapsed())}\n")
+    waiting = [w[2] for w in sorted(BROADCASTER.waiting, key=lambda x: x[:2])]
+    if waiting:
+        s += f"\n排队中的群发 {len(waiting)} 个：\n"
+        for i, b in enumerate(waiting[:DEBUG_LIST_MAX], 1):
+            s += f" {i}. {b.label}：{b.total} 群（{LANE_NAMES[b.lane]}）\n"
+    return s
+
+# =========================
+# 性能采样：/profile [秒数] [cprofile]，到时把结果以文件发回私聊
+# =========================
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "300"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))   # 采样间隔；越小越细，开销越大
+PROFILE_MAX_DEPTH = 64
+PROFILE_TOP = 60   # cProfile 报告列出前多少个函数
+
+class StackSampler:
+    """
+    后台线程定时读一次各线程的调用栈（sys._current_frames），按栈累计次数。
+    被测代码不插桩，开销只在采样线程；结果是 collapsed stacks，flamegraph.pl / speedscope 可直接打开。
+    """
+    kind = "sample"
+
+    def __init__(self, interval: float = PROFILE_INTERVAL_MS / 1000):
+        self.interval = interval
+        self.counts: Dict[str, int] = {}
+        self.samples = 0
+        self._labels: Dict[Any, str] = {}      # code 对象 -> "模块:函数"
+        self._names: Dict[int, str] = {}       # 线程 id -> 线程名
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = f"{Path(code.co_filename).stem}:{code.co_name}"
+        return label
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for tid, frame in sys._current_frames().items():
+                if tid == me:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < PROFILE_MAX_DEPTH:
+                    stack.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                if tid not in self._names:
+                    self._names.update((t.ident, t.name) for t in threading.enumerate())
+                stack.append(self._names.get(tid, str(tid)))
+                key = ";".join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+            self.samples += 1
+
+    def report(self) -> str:
+        return "".join(f"{k} {n}\n" for k, n in sorted(self.counts.items(), key=lambda kv: -kv[1]))
+
+    def summary(self) -> str:
+        return f"采样 {self.samples} 次（间隔 {self.interval * 1000:g}ms），{len(self.counts)} 种调用栈"
+
+class CallProfiler:
+    """cProfile 退路：统计事件循环线程里的每次函数调用（handler / job 都在这个线程跑），数字精确但开销大"""
+    kind = "cprofile"
+
+    def __init__(self):
+        self.prof = cProfile.Profile()
+
+    def start(self):
+        self.prof.enable()
+
+    def stop(self):
+        self.prof.disable()
+
+    def report(self) -> str:
+        out = io.StringIO()
+        st = pstats.Stats(self.prof, stream=out)
+        st.sort_stats("cumulative").print_stats(PROFILE_TOP)
+        st.sort_stats("tottime").print_stats(PROFILE_TOP)
+        return out.getvalue()
+
+    def summary(self) -> str:
+        st = pstats.Stats(self.prof)
+        return f"{st.total_calls} 次调用，{len(st.stats)} 个函数"
+
+PROFILE_STATE: Dict[str, Any] = {}   # 进行中的会话：profiler / chat_id / started / seconds
+
+def start_profile(kind: str, seconds: int, chat_id: int):
+    if kind == "sample" and not hasattr(sys, "_current_frames"):
+        kind = "cprofile"  # 非 CPython 没有 _current_frames
+    prof = StackSampler() if kind == "sample" else CallProfiler()
+    prof.start()
+    PROFILE_STATE.update(profiler=prof, chat_id=chat_id, started=time.monotonic(), seconds=seconds)
+    logger.info(f"[采样] 开始 {prof.kind}，{seconds}s")
+    return prof
+
+async def finish_profile(bot):
+    prof = PROFILE_STATE.pop("profiler", None)
+    if prof is None:
+        return
+    prof.stop()
+    elapsed = time.monotonic() - PROFILE_STATE.pop("started")
+    chat_id = PROFILE_STATE.pop("chat_id")
+    PROFILE_STATE.clear()
+    summary = prof.summary()
+    logger.info(f"[采样] 结束 {prof.kind}，{elapsed:.1f}s，{summary}")
+
+    report = await asyncio.to_thread(prof.report)
+    ext = "collapsed.txt" if prof.kind == "sample" else "pstats.txt"
+    await bot.send_document(
+        chat_id=chat_id,
+        document=report.encode("utf-8"),
+        filename=f"profile_{now_local().strftime('%Y%m%d_%H%M%S')}.{ext}",
+        caption=f"📈 {prof.kind} {elapsed:.1f}s：{summary}",
+    )
+
+async def profile_finish_job(context: ContextTypes.DEFAULT_TYPE):
+    await finish_profile(context.bot)
+
+async def cmd_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not is_admin(user.id):
+        await update.message.reply_text(f"⛔ 无权限。你的ID：{user.id}")
+        return
+    if update.effective_chat.type != "private":
+        await update.message.reply_text("请在私聊中使用 /profile")
+        return
+
+    args = [a.lower() for a in (context.args or [])]
+    if "stop" in args:
+        if not PROFILE_STATE:
+            await update.message.reply_text("当前没有进行中的采样。")
+            return
+        remove_jobs_by_name(context.job_queue, "profile")
+        await finish_profile(context.bot)
+        return
+    if PROFILE_STATE:
+        left = PROFILE_STATE["seconds"] - (time.monotonic() - PROFILE_STATE["started"])
+        await update.message.reply_text(f"已有采样进行中（约剩 {max(0, left):.0f} 秒），/profile stop 可提前结束。")
+        return
+    if not ensure_job_queue(context):
+        await update.message.reply_text("❗ job_queue 不可用")
+        return
+
+    seconds = next((int(a) for a in args if a.isdigit()), PROFILE_DEFAULT_SECONDS)
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    prof = start_profile("cprofile" if "cprofile" in args else "sample", seconds, update.effective_chat.id)
+    context.job_queue.run_once(profile_finish_job, when=seconds, name="profile")
+    await update.message.reply_text(
+        f"📈 已开始 {prof.kind} 采样 {seconds} 秒，结束后发送结果文件。\n"
+        "用法：/profile [秒数] [cprofile]，/profile stop 提前结束"
+    )
+
+# =========================
+# 基础命令
+# =========================
+async def cmd_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    await update.message.reply_text(f"你的 Telegram ID：{user.id}")
+
+async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not is_admin(user.id):
+        await update.message.reply_text(f"⛔ 无权限。\n你的ID：{user.id}\n请让管理员把你的ID加入 ADMIN_IDS 环境变量。")
+        return
+    await update.message.reply_text(
+        "✅ BG678 群发机器人（Webhook 稳定版）已启动\n\n"
+        "群内绑定：/register\n群内解绑：/unregister\n私聊群管理：/managegroups\n发送统计：/stats\n归档查找：/archive\n性能采样：/profile\n\n"
+        "也可以直接用下方菜单按钮。",
+        reply_markup=MAIN_KEYBOARD
+    )
+
+async def cmd_debug(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not is_admin(user.id):
+        await update.message.reply_text(f"⛔ 无权限。你的ID：{user.id}")
+        return
+    g = load_groups()
+    p = load_posts()
+    jq = "OK" if getattr(context, "job_queue", None) is not None else "MISSING"
+    if RESTORE_STATE["ready"]:
+        restore = (f"完成（{RESTORE_STATE['restored']} 个，{RESTORE_STATE['seconds']:.2f}s；"
+                   f"{RESTORE_STATE['deferred']} 个在 {RESTORE_HORIZON_HOURS:g} 小时外，到时补注册）")
+    else:
+        restore = f"进行中 {RESTORE_STATE['done']}/{RESTORE_STATE['total']}"
+    rl = context.bot.rate_limiter
+    outbox = rl.describe() if isinstance(rl, PriorityRateLimiter) else "未启用"
+    await update.message.reply_text(
+        "🧪 Debug\n"
+        f"BASE_DIR: {BASE_DIR}\n"
+        f"groups_file: {GROUPS_FILE}\n"
+        f"posts_file: {POSTS_FILE}\n"
+        f"群数量: {len(g)}\n"
+        f"任务数量: {len(p)}（{REPO.describe()}）\n"
+        f"job_queue: {jq}\n"
+        f"任务恢复: {restore}\n"
+        f"TZ_OFFSET: {TZ_OFFSET}\n"
+        f"出站队列: {outbox}\n"
+        f"{fmt_http_pools()}\n"
+        f"{SENDERS.describe() if SENDERS else '发送池: 未启用（SENDER_TOKENS）'}\n"
+        f"{DELIVERIES.describe()}\n"
+        f"{describe_archive()}\n"
+        f"{UPDATE_GATE.describe()}\n"
+        f"{FLOW_STORE.describe(context.application)}\n"
+        f"合并发送: {f'窗口 {COALESCE_WINDOW:g}s，{COALESCE_MODE}，累计少发 {COALESCER.merged_saved} 条' if COALESCE_WINDOW > 0 else '关闭（COALESCE_WINDOW）'}\n"
+    )
+    await update.message.reply_text(fmt_runtime_status(context.application))
+
+# =========================
+# 绑定 / 解绑
+# =========================
+async def register_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat = update.effective_chat
+    user = update.effective_user
+
+    if not is_admin(user.id):
+        await update.message.reply_text(f"⛔ 无权限。你的ID：{user.id}")
+        return
+
+    if chat.type not in ("group", "supergroup"):
+        await update.message.reply_text("请在群内使用 /register")
+        return
+
+    groups = load_groups()
+    groups[str(chat.id)] = chat.title or f"group_{chat.id}"
+    save_groups(groups)
+    await update.message.reply_text(f"✅ 已绑定群：{groups[str(chat.id)]}")
+
+async def unregister_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat = update.effective_chat
+    user = update.effective_user
+
+    if not is_admin(user.id):
+        await update.message.reply_text(f"⛔ 无权限。你的ID：{user.id}")
+        return
+
+    if chat.type not in ("group", "supergroup"):
+        await update.message.reply_text("请在群内使用 /unregister")
+        return
+
+    groups = load_groups()
+    cid = str(chat.id)
+    if cid in groups:
+        title = groups.pop(cid)
+        save_groups(groups)
+        await update.message.reply_text(f"❌ 已解绑群：{title}")
+    else:
+        await update.message.reply_text("该群尚未绑定，无需解绑。")
+
+# =========================
+# 私聊群管理
+# =========================
+async def managegroups(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not is_admin(user.id):
+        await update.message.reply_text(f"⛔ 无权限。你的ID：{user.id}")
+        return
+
+    groups = load_groups()
+    if not groups:
+        await update.message.reply_text("📭 当前没有任何绑定群", reply_markup=MAIN_KEYBOARD)
+        return
+
+    text = "📋 已绑定群：\n\n"
+    kb = []
+    for cid, title in groups.items():
+        text += f"• {title} ({cid})\n"
+        kb.append([InlineKeyboardButton(f"❌ 解绑 {title}", callback_data=f"mg_del:{cid}")])
+    kb.append([InlineKeyboardButton("🧹 清空全部", callback_data="mg_clear")])
+
+    await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(kb))
+
+async def managegroups_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    user = q.from_user
+    if not is_admin(user.id):
+        await q.answer("无权限")
+        return
+
+    data = q.data
+    groups = load_groups()
+
+    if data.startswith("mg_del:"):
+        cid = data.split(":", 1)[1]
+        groups.pop(cid, None)
+        save_groups(groups)
+        await q.answer("已解绑")
+        await q.message.delete()
+        return
+
+    if data == "mg_clear":
+        groups.clear()
+        save_groups(groups)
+        await q.answer("已清空")
+        await q.message.delete()
+        return
+
+# =========================
+# 发送菜单
 # =========================
-# 发送菜单
-# =========================
 async def menu_send(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return
     await update.message.reply_text("请选择发帖方式：", reply_markup=SEND_MENU)
 
 # ============================================================
-# ✅ 新增：通用按钮配置流程（立即/定时/每日 共用）
+# ✅ 新增：通用按钮配置流程（立即/定时/循环 共用）
 # ============================================================
 async def ask_button_enable(msg, context: ContextTypes.DEFAULT_TYPE):
     context.user_data[STEP] = S_ASK_BUTTON_ENABLE
@@ -442,6 +3126,23 @@ async def ask_button_enable(msg, context: ContextTypes.DEFAULT_TYPE):
         "2️⃣ 添加按钮（复制 + 跳转）"
     )
 
+MEDIA_INPUT_HINT = "📎 也可以发送「图片: 图片URL或媒体目录里的文件名 说明文字」，由机器人上传"
+
+def content_prompt(context: ContextTypes.DEFAULT_TYPE, head: str) -> str:
+    head += "\n" + MEDIA_INPUT_HINT
+    if context.user_data.get(MODE) in (M_SCHEDULE, M_DAILY):
+        return head + "\n\n💡 发送「预演」可先模拟发送耗时、限流风险和同时段任务（不会真正发送）"
+    return head
+
+async def reply_dry_run(msg, context: ContextTypes.DEFAULT_TYPE, fire_at: Optional[datetime]):
+    if not fire_at:
+        await msg.reply_text("❗ 无法确定发送时间，无法预演")
+        return
+    groups_map = load_groups()
+    selected = [cid for cid in context.user_data.get(SELECTED_GROUPS, set()) if cid in groups_map]
+    report = await asyncio.to_thread(dry_run_report, selected, fire_at, load_posts())
+    await msg.reply_text(report + "\n请继续发送要群发的内容：")
+
 async def handle_button_flow(msg, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """
     返回 True 表示已处理（不继续往下）
@@ -454,7 +3155,7 @@ async def handle_button_flow(msg, context: ContextTypes.DEFAULT_TYPE) -> bool:
         if text == "1":
             context.user_data[BUTTONS] = None
             context.user_data[STEP] = S_AWAIT_CONTENT
-            await msg.reply_text("请发送要群发的内容（文字或图片+文字）：")
+            await msg.reply_text(content_prompt(context, "请发送要群发的内容（文字或图片+文字）："))
             return True
         if text == "2":
             context.user_data[BUTTONS] = {"copy": {}, "url": {}}
@@ -501,7 +3202,7 @@ async def handle_button_flow(msg, context: ContextTypes.DEFAULT_TYPE) -> bool:
             return True
         context.user_data[BUTTONS]["url"]["url"] = text
         context.user_data[STEP] = S_AWAIT_CONTENT
-        await msg.reply_text("✅ 按钮已配置完成。请发送要群发的内容（文字或图片+文字）：")
+        await msg.reply_text(content_prompt(context, "✅ 按钮已配置完成。请发送要群发的内容（文字或图片+文字）："))
         return True
 
     return False
@@ -601,38 +3302,31 @@ async def immediate_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             context.user_data.clear()
             return
 
-        content = content_from_message(msg)
+        content = await content_from_input(context, msg)
+        if content is None:
+            return
         buttons = context.user_data.get(BUTTONS)
         delete_minutes = int(context.user_data.get(TEMP, {}).get("delete_minutes", 0))
+        context.user_data.clear()
 
-        sent_msgs = []
-        sent, failed = 0, 0
-        reasons = []
-
-        for cid in selected:
-            try:
-                m = await send_content(context, int(cid), content, buttons=buttons)
-                sent_msgs.append({"chat_id": cid, "message_id": m.message_id})
-                sent += 1
-            except Exception as e:
-                failed += 1
-                reasons.append(f"{groups_map.get(cid)} ({cid}) -> {e}")
-                logger.error(f"[立即发送失败] chat={cid} err={e}")
-
-        # 立即发送也支持自动删除（如果安装了 job_queue）
-        if delete_minutes > 0 and sent_msgs and ensure_job_queue(context):
-            context.job_queue.run_once(
-                delete_messages_job,
-                when=delete_minutes * 60,
-                data={"messages": sent_msgs}
+        async def send_and_report():
+            b = await broadcast_content(
+                context, "立即发送", list(selected), content,
+                buttons=buttons, lane=LANE_IMMEDIATE, progress_chat_id=msg.chat_id
             )
+            reasons = [f"{groups_map.get(cid)} ({cid}) -> {err}" for cid, err in b.errors]
 
-        report = f"🎉 立即发送完成：成功 {sent} 群，失败 {failed} 群。"
-        if reasons:
-            report += "\n\n❌ 失败原因：\n" + "\n".join(reasons[:10])
+            # 立即发送也支持自动删除（如果安装了 job_queue）
+            schedule_auto_delete(context.job_queue, b.results, delete_minutes)
 
-        await msg.reply_text(report, reply_markup=MAIN_KEYBOARD)
-        context.user_data.clear()
+            report = f"🎉 立即发送完成：成功 {b.sent} 群，失败 {b.failed} 群。"
+            if reasons:
+                report += "\n\n❌ 失败原因：\n" + "\n".join(reasons[:10])
+            await msg.reply_text(report, reply_markup=MAIN_KEYBOARD)
+
+        # 群发（含排队）放到后台：更新是逐条处理的，在这里等会卡住所有人的菜单和按钮
+        context.application.create_task(send_and_report(), update=update)
+        await msg.reply_text(f"📤 已提交发送到 {len(selected)} 个群，完成后会通知你。", reply_markup=MAIN_KEYBOARD)
         return
 
 # =========================
@@ -744,6 +3438,10 @@ async def schedule_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if step == S_AWAIT_CONTENT:
+        if text in DRY_RUN_WORDS:
+            await reply_dry_run(msg, context, datetime.fromisoformat(context.user_data[TEMP]["send_time"]))
+            return
+
         if not ensure_job_queue(context):
             await msg.reply_text("❗ 当前环境缺少 JobQueue 依赖（job_queue=None）。请按 requirements.txt 安装 PTB job-queue。", reply_markup=MAIN_KEYBOARD)
             context.user_data.clear()
@@ -757,16 +3455,17 @@ async def schedule_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             context.user_data.clear()
             return
 
+        content = await content_from_input(context, msg)
+        if content is None:
+            return
         post_id = gen_id()
         send_time = context.user_data[TEMP]["send_time"]
         delete_minutes = int(context.user_data[TEMP].get("delete_minutes", 0))
         buttons = context.user_data.get(BUTTONS)
-        content = content_from_message(msg)
 
         job_name = f"schedule_{post_id}"
 
-        posts = load_posts()
-        posts.append({
+        REPO.insert({
             "id": post_id,
             "type": "schedule",
             "groups": list(selected),
@@ -776,8 +3475,8 @@ async def schedule_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "buttons": buttons,
             "enabled": True,
             "job_name": job_name,
+            "owner": update.effective_user.id,
         })
-        save_posts(posts)
 
         dt = datetime.fromisoformat(send_time)
         if dt.tzinfo is None:
@@ -797,44 +3496,33 @@ async def schedule_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def schedule_execute_job(context: ContextTypes.DEFAULT_TYPE):
     post_id = context.job.data.get("post_id")
-    posts = load_posts()
-    post = get_post(posts, post_id)
+    post = REPO.get(post_id)
     if not post or not post.get("enabled", True):
         return
 
-    groups = post.get("groups", [])
-    content = post.get("content", {})
-    buttons = post.get("buttons")
-    delete_minutes = int(post.get("delete_minutes", 0))
-
-    sent_msgs = []
-    for cid in groups:
-        try:
-            m = await send_content(context, int(cid), content, buttons=buttons)
-            sent_msgs.append({"chat_id": cid, "message_id": m.message_id})
-        except Exception as e:
-            logger.error(f"[定时发送失败] post={post_id} chat={cid} err={e}")
-
-    if delete_minutes > 0 and sent_msgs and getattr(context, "job_queue", None) is not None:
-        context.job_queue.run_once(
-            delete_messages_job,
-            when=delete_minutes * 60,
-            data={"messages": sent_msgs}
-        )
+    await dispatch_post(context, post)
 
 async def delete_messages_job(context: ContextTypes.DEFAULT_TYPE):
     msgs = context.job.data.get("messages", [])
+    deleted: Dict[Tuple[str, str], Set[str]] = {}
     for item in msgs:
         try:
-            await context.bot.delete_message(
+            await bot_for_record(context, item).delete_message(
                 chat_id=int(item["chat_id"]),
-                message_id=int(item["message_id"])
+                message_id=int(item["message_id"]),
+                rate_limit_args=LANE_CLEANUP
             )
         except Exception as e:
             logger.error(f"[删除失败] chat={item.get('chat_id')} msg={item.get('message_id')} err={e}")
+            continue
+        # 消息已不在群里：撤回 / 同步修改不再列出它（合并消息对应的每个帖子都要清）
+        for post_id, run_id in item.get("deliveries") or []:
+            deleted.setdefault((post_id, run_id), set()).add(str(item["chat_id"]))
+    for (post_id, run_id), chats in deleted.items():
+        DELIVERIES.forget(post_id, run_id, chats)
 
 # =========================
-# 每日循环
+# 循环发送（每天 / 每周几 / 每N小时 / cron）
 # =========================
 async def daily_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
@@ -850,7 +3538,7 @@ async def daily_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data[TEMP] = {}
     context.user_data[BUTTONS] = None
 
-    await update.message.reply_text("请选择要每日循环发送的群：", reply_markup=build_group_keyboard("dy", set()))
+    await update.message.reply_text("请选择要循环发送的群：", reply_markup=build_group_keyboard("dy", set()))
 
 async def daily_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
@@ -858,7 +3546,7 @@ async def daily_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await q.answer("无权限")
         return
     if context.user_data.get(MODE) != M_DAILY:
-        await q.answer("当前不在每日流程")
+        await q.answer("当前不在循环发送流程")
         return
 
     data = q.data
@@ -889,8 +3577,8 @@ async def daily_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await q.answer("请至少选择一个群")
             return
         context.user_data[STEP] = S_ASK_SEND_TIME
-        await q.answer("请输入每日时间")
-        await q.message.reply_text("请输入每日发送时间：20:30 / 20点30 / 9点 等", reply_markup=ReplyKeyboardRemove())
+        await q.answer("请输入循环规则")
+        await q.message.reply_text(RECURRENCE_PROMPT, reply_markup=ReplyKeyboardRemove())
         try:
             await q.message.delete()
         except Exception:
@@ -911,12 +3599,15 @@ async def daily_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = (msg.text or "").strip()
 
     if step == S_ASK_SEND_TIME:
-        tm = parse_time_flexible(text)
-        if not tm:
-            await msg.reply_text("❗ 时间格式错误，请重新输入：20:30 / 20点30 / 9点")
+        rec = parse_recurrence(text)
+        if not rec:
+            await msg.reply_text("❗ 规则格式错误，请重新输入。\n\n" + RECURRENCE_PROMPT)
+            return
+        if not next_fire_after(rec, now_local()):
+            await msg.reply_text("❗ 该规则在日期范围内已没有可发送的时间，请重新输入")
             return
 
-        context.user_data[TEMP]["daily_time"] = text
+        context.user_data[TEMP]["recurrence"] = rec
         context.user_data[STEP] = S_ASK_DELETE_MIN
         await msg.reply_text("若需自动删除，请输入【发送后多少分钟删除】（数字），不删输入 0")
         return
@@ -930,6 +3621,10 @@ async def daily_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if step == S_AWAIT_CONTENT:
+        if text in DRY_RUN_WORDS:
+            await reply_dry_run(msg, context, next_fire_after(context.user_data[TEMP]["recurrence"], now_local()))
+            return
+
         if not ensure_job_queue(context):
             await msg.reply_text("❗ 当前环境缺少 JobQueue 依赖（job_queue=None）。请按 requirements.txt 安装 PTB job-queue。", reply_markup=MAIN_KEYBOARD)
             context.user_data.clear()
@@ -943,66 +3638,54 @@ async def daily_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             context.user_data.clear()
             return
 
+        content = await content_from_input(context, msg)
+        if content is None:
+            return
         post_id = gen_id()
-        daily_time_raw = context.user_data[TEMP]["daily_time"]
+        rec = context.user_data[TEMP]["recurrence"]
         delete_minutes = int(context.user_data[TEMP].get("delete_minutes", 0))
-        tm = parse_time_flexible(daily_time_raw)
         buttons = context.user_data.get(BUTTONS)
-        content = content_from_message(msg)
 
         job_name = f"daily_{post_id}"
 
-        posts = load_posts()
-        posts.append({
+        post = {
             "id": post_id,
             "type": "daily",
             "groups": list(selected),
-            "daily_time": daily_time_raw,
+            "recurrence": rec,
+            "next_fire": None,
             "delete_minutes": delete_minutes,
             "content": content,
             "buttons": buttons,
             "enabled": True,
             "job_name": job_name,
-        })
-        save_posts(posts)
-
-        context.job_queue.run_daily(
-            daily_execute_job,
-            time=tm,
-            data={"post_id": post_id},
-            name=job_name
+            "owner": update.effective_user.id,
+        }
+        register_post_job(context.job_queue, post, recompute=True)
+        REPO.insert(post)
+
+        await msg.reply_text(
+            f"🔁 循环任务已创建（ID: {post_id}）\n"
+            f"规则：{describe_recurrence(rec)}\n"
+            f"首次发送：{fmt_dt(post['next_fire'])}",
+            reply_markup=MAIN_KEYBOARD
         )
-
-        await msg.reply_text(f"🔁 每日循环任务已创建（ID: {post_id}）", reply_markup=MAIN_KEYBOARD)
         context.user_data.clear()
         return
 
 async def daily_execute_job(context: ContextTypes.DEFAULT_TYPE):
     post_id = context.job.data.get("post_id")
-    posts = load_posts()
-    post = get_post(posts, post_id)
+    post = REPO.get(post_id)
     if not post or not post.get("enabled", True):
         return
 
-    groups = post.get("groups", [])
-    content = post.get("content", {})
-    buttons = post.get("buttons")
-    delete_minutes = int(post.get("delete_minutes", 0))
+    # 先推进 next_fire 并注册下一次（发送耗时不影响下一次触发）；只动调度字段，不升版本
+    fired_at = datetime.fromisoformat(post["next_fire"]) if post.get("next_fire") else now_local()
+    post["next_fire"] = None
+    register_post_job(context.job_queue, post, after=max(now_local(), fired_at))
+    REPO.save()
 
-    sent_msgs = []
-    for cid in groups:
-        try:
-            m = await send_content(context, int(cid), content, buttons=buttons)
-            sent_msgs.append({"chat_id": cid, "message_id": m.message_id})
-        except Exception as e:
-            logger.error(f"[每日发送失败] post={post_id} chat={cid} err={e}")
-
-    if delete_minutes > 0 and sent_msgs and getattr(context, "job_queue", None) is not None:
-        context.job_queue.run_once(
-            delete_messages_job,
-            when=delete_minutes * 60,
-            data={"messages": sent_msgs}
-        )
+    await dispatch_post(context, post)
 
 # =========================
 # 我的帖子：查看/编辑/删除/启停
@@ -1024,11 +3707,14 @@ async def my_posts(update: Update, context: ContextTypes.DEFAULT_TYPE):
             [
                 InlineKeyboardButton("🗑 删除", callback_data=f"post_del:{p['id']}"),
                 InlineKeyboardButton("⏹ 停用" if p.get("enabled", True) else "🔛 启用", callback_data=f"post_toggle:{p['id']}"),
+            ],
+            [
+                InlineKeyboardButton("↩️ 撤回", callback_data=f"post_recall:{p['id']}"),
             ]
         ])
         await update.message.reply_text(fmt_post(p), reply_markup=kb)
 
-    await update.message.reply_text("以上为所有任务。", reply_markup=MAIN_KEYBOARD)
+    await update.message.reply_text("以上为所有任务。已完成的帖子会自动归档，可用 /archive 关键词 查找和恢复。", reply_markup=MAIN_KEYBOARD)
 
 async def post_view_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
@@ -1036,8 +3722,7 @@ async def post_view_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await q.answer("无权限")
         return
     post_id = q.data.split(":", 1)[1]
-    posts = load_posts()
-    post = get_post(posts, post_id)
+    post = REPO.get(post_id)
     if not post:
         await q.answer("不存在")
         return
@@ -1050,136 +3735,799 @@ async def post_view_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await q.message.reply_text("📄 内容：\n" + (content.get("text") or ""))
     await q.answer("OK")
 
-async def post_edit_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def post_edit_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    if not is_admin(q.from_user.id):
+        await q.answer("无权限")
+        return
+    post_id = q.data.split(":", 1)[1]
+    if not REPO.get(post_id):
+        await q.answer("不存在")
+        return
+    context.user_data.clear()
+    context.user_data[MODE] = M_EDIT
+    context.user_data[STEP] = S_AWAIT_CONTENT
+    context.user_data[EDIT_POST_ID] = post_id
+    await q.answer("请发送新内容")
+    await q.message.reply_text(
+        "请发送新的内容（文字 或 图片+文字）。只改内容，不改时间/群/按钮。\n" + MEDIA_INPUT_HINT,
+        reply_markup=ReplyKeyboardRemove()
+    )
+
+async def post_edit_receive(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if context.user_data.get(MODE) != M_EDIT:
+        return
+    if context.user_data.get(STEP) != S_AWAIT_CONTENT:
+        return
+
+    msg = update.message
+    post_id = context.user_data.get(EDIT_POST_ID)
+    post = REPO.get(post_id)
+    if not post:
+        await msg.reply_text("❗ 任务不存在或已删除。", reply_markup=MAIN_KEYBOARD)
+        context.user_data.clear()
+        return
+
+    # 读取内容可能要上传图片；期间帖子被别人改过 / 删掉则放弃本次修改，不覆盖
+    version = int(post.get("version", 0))
+    old_content = post.get("content", {})
+    content = await content_from_input(context, msg)
+    if content is None:
+        return
+    try:
+        post = await REPO.update(post_id, lambda p: p.update(content=content), expected_version=version)
+    except ConflictError as e:
+        logger.warning(f"[编辑冲突] {e}")
+        await msg.reply_text("❗ 任务在你编辑期间被修改或删除，本次内容未保存，请重新编辑。", reply_markup=MAIN_KEYBOARD)
+        context.user_data.clear()
+        return
+
+    # schedule 未到时间：重建一次 job（确保更新内容生效）
+    if post.get("type") == "schedule" and post.get("enabled", True) and ensure_job_queue(context):
+        try:
+            dt = datetime.fromisoformat(post.get("send_time"))
+            if dt.tzinfo is None:
+                dt = dt.replace(tzinfo=LOCAL_TZ)
+            if dt > now_local():
+                job_name = post.get("job_name", f"schedule_{post_id}")
+                remove_jobs_by_name(context.job_queue, job_name)
+                delay = max(1, int((dt - now_local()).total_seconds()))
+                context.job_queue.run_once(
+                    schedule_execute_job,
+                    when=delay,
+                    data={"post_id": post_id},
+                    name=job_name
+                )
+        except Exception as e:
+            logger.error(f"[编辑后重建 schedule job 失败] {e}")
+
+    await msg.reply_text(f"✅ 已更新内容（ID: {post_id}）", reply_markup=MAIN_KEYBOARD)
+    context.user_data.clear()
+    await offer_live_edit(msg, post_id, old_content, post["content"])
+
+async def post_del_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    if not is_admin(q.from_user.id):
+        await q.answer("无权限")
+        return
+    post_id = q.data.split(":", 1)[1]
+    post = await REPO.delete(post_id)
+    if not post:
+        await q.answer("不存在")
+        return
+    job_name = post.get("job_name")
+    if job_name and getattr(context, "job_queue", None) is not None:
+        remove_jobs_by_name(context.job_queue, job_name)
+    await q.answer("已删除")
+    try:
+        await q.message.delete()
+    except Exception:
+        pass
+
+async def post_toggle_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    if not is_admin(q.from_user.id):
+        await q.answer("无权限")
+        return
+    post_id = q.data.split(":", 1)[1]
+    async with REPO.transaction(post_id) as post:
+        if not post:
+            await q.answer("不存在")
+            return
+
+        post["enabled"] = not post.get("enabled", True)
+        if post["enabled"]:
+            post.pop("disabled_at", None)
+        else:
+            post["disabled_at"] = time.time()  # 停用满 ARCHIVE_DISABLED_DAYS 天后归档
+
+        job_name = post.get("job_name")
+        if job_name and getattr(context, "job_queue", None) is not None:
+            remove_jobs_by_name(context.job_queue, job_name)
+
+        if post["enabled"] and ensure_job_queue(context):
+            try:
+                register_post_job(context.job_queue, post, recompute=True)
+            except Exception as e:
+                logger.error(f"[启用任务失败] {e}")
+
+    await q.answer("已切换")
+    try:
+        await q.message.edit_text(fmt_post(post))
+    except Exception:
+        pass
+
+# =========================
+# 归档：已完成的一次性帖子（可选：长期停用的帖子）移出 posts.json，按月追加到 archive/YYYY-MM.jsonl
+# =========================
+ARCHIVE_AFTER_HOURS = float(os.getenv("ARCHIVE_AFTER_HOURS", "24"))        # 完成后在任务列表里再留多久（方便撤回 / 改已发消息）
+ARCHIVE_DISABLED_DAYS = float(os.getenv("ARCHIVE_DISABLED_DAYS", "0"))     # 停用超过多少天也归档；0 = 停用的不归档
+ARCHIVE_RETENTION_DAYS = float(os.getenv("ARCHIVE_RETENTION_DAYS", "180"))  # 归档按月分段，整段过期后删除
+ARCHIVE_SHOW = 10
+ARCHIVE_REASONS = {"done": "已完成", "disabled": "长期停用"}
+
+def post_finished(p: Dict[str, Any], now: datetime) -> bool:
+    """一次性帖子的发送时间已过，或循环帖子的日期范围已结束"""
+    if p.get("type") == "schedule":
+        try:
+            dt = datetime.fromisoformat(p.get("send_time") or "")
+        except ValueError:
+            return False
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=LOCAL_TZ)
+        return dt <= now
+    if p.get("type") == "daily":
+        return p.get("enabled", True) and "next_fire" in p and not p["next_fire"]
+    return False
+
+def archive_segment(ts: float) -> Path:
+    return ARCHIVE_DIR / f"{datetime.fromtimestamp(ts, tz=LOCAL_TZ):%Y-%m}.jsonl"
+
+def archive_posts(now: datetime) -> List[Dict[str, Any]]:
+    """
+    第一次发现帖子完成 / 停用时记下时间（done_at / disabled_at），超过期限的整条追加到归档并移出 posts.json。
+    正在事务中的帖子本轮跳过。返回归档的帖子。
+    """
+    ts = now.timestamp()
+    stamped = False
+    out: List[Tuple[Dict[str, Any], str]] = []
+    for p in REPO.all():
+        if REPO.busy(p.get("id")):
+            continue
+        if post_finished(p, now):
+            if "done_at" not in p:
+                p["done_at"] = ts
+                stamped = True
+            elif ts - p["done_at"] >= ARCHIVE_AFTER_HOURS * 3600:
+                out.append((p, "done"))
+        elif ARCHIVE_DISABLED_DAYS > 0 and not p.get("enabled", True):
+            if "disabled_at" not in p:
+                p["disabled_at"] = ts
+                stamped = True
+            elif ts - p["disabled_at"] >= ARCHIVE_DISABLED_DAYS * 86400:
+                out.append((p, "disabled"))
+    if out:
+        # 先追加归档再移出列表（同一个写盘线程按提交顺序写）；中途崩溃最多两边各留一份，恢复时按 id 覆盖
+        ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
+        data = b"".join(json_dumps({"archived_at": ts, "reason": r, "post": p}) + b"\n" for p, r in out)
+        WRITER.append(archive_segment(ts), data)
+        REPO.remove_many({p["id"] for p, _ in out})
+    elif stamped:
+        REPO.save()
+    return [p for p, _ in out]
+
+def prune_archive(now: datetime) -> int:
+    """删除整月都已超过保留期的分段，返回删除的段数"""
+    if not ARCHIVE_DIR.exists():
+        return 0
+    cutoff = now - timedelta(days=ARCHIVE_RETENTION_DAYS)
+    n = 0
+    for seg in ARCHIVE_DIR.glob("*.jsonl"):
+        try:
+            start = datetime.strptime(seg.stem, "%Y-%m").replace(tzinfo=LOCAL_TZ)
+        except ValueError:
+            continue
+        month_end = (start + timedelta(days=32)).replace(day=1)
+        if month_end <= cutoff:
+            WRITER.delete(seg)
+            n += 1
+    return n
+
+def _archive_records():
+    """从新到旧逐条读归档（同一帖子可能归档过多次，调用方按 id 取第一次出现的）"""
+    WRITER.flush()
+    for seg in sorted(ARCHIVE_DIR.glob("*.jsonl"), reverse=True):
+        with open(seg, "rb") as fp:
+            lines = fp.readlines()
+        for line in reversed(lines):
+            try:
+                rec = json_loads(line)
+            except ValueError:
+                continue
+            if isinstance(rec, dict) and isinstance(rec.get("post"), dict):
+                yield rec
+
+def search_archive(keyword: str, limit: int = ARCHIVE_SHOW) -> Tuple[List[Dict[str, Any]], int]:
+    """按 id / 正文 / 图片说明查找（不区分大小写，空关键词 = 全部），返回 (最近 limit 条, 命中总数)；在工作线程中运行"""
+    kw = keyword.strip().lower()
+    seen: Set[str] = set()
+    hits: List[Dict[str, Any]] = []
+    total = 0
+    for rec in _archive_records():
+        p = rec["post"]
+        if p.get("id") in seen:
+            continue
+        seen.add(p.get("id"))
+        c = p.get("content") or {}
+        if kw and kw not in f"{p.get('id')}\n{c.get('text') or ''}\n{c.get('caption') or ''}".lower():
+            continue
+        total += 1
+        if len(hits) < limit:
+            hits.append(rec)
+    return hits, total
+
+def find_archived(post_id: str) -> Optional[Dict[str, Any]]:
+    return next((rec for rec in _archive_records() if rec["post"].get("id") == post_id), None)
+
+def describe_archive() -> str:
+    segs = list(ARCHIVE_DIR.glob("*.jsonl")) if ARCHIVE_DIR.exists() else []
+    size = sum(s.stat().st_size for s in segs)
+    return f"归档: {len(segs)} 段，{size // 1024} KB，保留 {ARCHIVE_RETENTION_DAYS:g} 天"
+
+def fmt_archived(rec: Dict[str, Any], restored: bool) -> str:
+    p = rec["post"]
+    c = p.get("content") or {}
+    text = (c.get("text") or c.get("caption") or ("[图片]" if c.get("type") == "photo" else "")).replace("\n", " ")
+    when = datetime.fromtimestamp(rec.get("archived_at", 0), tz=LOCAL_TZ).strftime("%Y/%m/%d %H:%M")
+    s = f"🆔 {p.get('id')}｜{p.get('type')}｜{len(p.get('groups', []))} 群｜{ARCHIVE_REASONS.get(rec.get('reason'), rec.get('reason'))}，归档于 {when}"
+    if restored:
+        s += "｜已恢复"
+    return s + f"\n    {text[:40]}{'…' if len(text) > 40 else ''}"
+
+async def archive_posts_job(context: ContextTypes.DEFAULT_TYPE):
+    now = now_local()
+    moved = archive_posts(now)
+    for p in moved:
+        remove_jobs_by_name(context.job_queue, p.get("job_name"))
+    pruned = prune_archive(now)
+    if moved or pruned:
+        logger.info(f"[归档] 移出 {len(moved)} 个帖子，删除过期分段 {pruned} 个，任务列表剩 {len(REPO.all())} 个")
+
+async def cmd_archive(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not is_admin(user.id):
+        await update.message.reply_text(f"⛔ 无权限。你的ID：{user.id}")
+        return
+    if update.effective_chat.type != "private":
+        await update.message.reply_text("请在私聊中使用 /archive")
+        return
+
+    keyword = " ".join(context.args or [])
+    hits, total = await asyncio.to_thread(search_archive, keyword)
+    if not hits:
+        await update.message.reply_text(f"📭 归档中没有{'包含“' + keyword + '”的' if keyword else '任何'}帖子。")
+        return
+
+    s = f"🗄 归档{'搜索“' + keyword + '”' if keyword else ''}：共 {total} 条，显示最近 {len(hits)} 条\n\n"
+    kb = []
+    for rec in hits:
+        pid = rec["post"].get("id")
+        restored = REPO.get(pid) is not None
+        s += fmt_archived(rec, restored) + "\n"
+        if not restored:
+            kb.append([InlineKeyboardButton(f"♻️ 恢复 {pid}", callback_data=f"arc_restore:{pid}")])
+    s += "\n用法：/archive 关键词（按 ID / 正文查找）"
+    await update.message.reply_text(s, reply_markup=InlineKeyboardMarkup(kb) if kb else None)
+
+def restore_archived(job_queue, rec: Dict[str, Any]) -> Tuple[Dict[str, Any], bool]:
+    """把归档记录放回 REPO；原来启用且还有下一次发送的重新注册 job，否则以停用状态放回。返回 (帖子, 是否已排期)"""
+    post = rec["post"]
+    for k in ("done_at", "disabled_at", "version"):
+        post.pop(k, None)
+    scheduled = False
+    if post.get("enabled", True) and job_queue is not None:
+        try:
+            scheduled = register_post_job(job_queue, post, recompute=True)
+        except Exception as e:
+            logger.error(f"[归档恢复] id={post.get('id')} 注册任务失败：{e}")
+    post["enabled"] = scheduled
+    REPO.insert(post)
+    return post, scheduled
+
+async def archive_restore_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     if not is_admin(q.from_user.id):
         await q.answer("无权限")
         return
     post_id = q.data.split(":", 1)[1]
-    posts = load_posts()
-    post = get_post(posts, post_id)
-    if not post:
-        await q.answer("不存在")
+    if REPO.get(post_id):
+        await q.answer("已在任务列表中")
         return
-    context.user_data.clear()
-    context.user_data[MODE] = M_EDIT
-    context.user_data[STEP] = S_AWAIT_CONTENT
-    context.user_data[EDIT_POST_ID] = post_id
-    await q.answer("请发送新内容")
-    await q.message.reply_text("请发送新的内容（文字 或 图片+文字）。只改内容，不改时间/群/按钮。", reply_markup=ReplyKeyboardRemove())
-
-async def post_edit_receive(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if context.user_data.get(MODE) != M_EDIT:
+    rec = await asyncio.to_thread(find_archived, post_id)
+    if rec is None:
+        await q.answer("归档中不存在（可能已过保留期）")
         return
-    if context.user_data.get(STEP) != S_AWAIT_CONTENT:
+    if REPO.get(post_id):  # 读归档期间被别人恢复了
+        await q.answer("已在任务列表中")
         return
 
-    msg = update.message
-    post_id = context.user_data.get(EDIT_POST_ID)
-    posts = load_posts()
-    post = get_post(posts, post_id)
-    if not post:
-        await msg.reply_text("❗ 任务不存在或已删除。", reply_markup=MAIN_KEYBOARD)
-        context.user_data.clear()
-        return
+    post, scheduled = restore_archived(context.job_queue if ensure_job_queue(context) else None, rec)
+    await q.answer("已恢复")
+    if scheduled:
+        note = "♻️ 已恢复并重新排期。"
+    else:
+        note = ("♻️ 已恢复为停用状态（没有以后的发送时间，或归档前就已停用），可在“📝 我的帖子”里查看、修改后启用。\n"
+                f"（已过发送时间的一次性帖子会在 {ARCHIVE_AFTER_HOURS:g} 小时后再次归档）")
+    await q.message.reply_text(fmt_post(post) + "\n\n" + note, reply_markup=MAIN_KEYBOARD)
+
+# =========================
+# 撤回：按投递索引删除某次群发发出的全部消息
+# =========================
+RECALL_RUNS_SHOW = 5        # 选择批次时最多列出最近几次
+DELETE_BATCH = 100          # deleteMessages 单次最多 100 条
 
-    post["content"] = content_from_message(msg)
-    save_posts(posts)
+def fmt_ts(ts: int) -> str:
+    return datetime.fromtimestamp(ts, tz=LOCAL_TZ).strftime("%m/%d %H:%M")
 
-    # schedule 未到时间：重建一次 job（确保更新内容生效）
-    if post.get("type") == "schedule" and post.get("enabled", True) and ensure_job_queue(context):
-        try:
-            dt = datetime.fromisoformat(post.get("send_time"))
-            if dt.tzinfo is None:
-                dt = dt.replace(tzinfo=LOCAL_TZ)
-            if dt > now_local():
-                job_name = post.get("job_name", f"schedule_{post_id}")
-                remove_jobs_by_name(context.job_queue, job_name)
-                delay = max(1, int((dt - now_local()).total_seconds()))
-                context.job_queue.run_once(
-                    schedule_execute_job,
-                    when=delay,
-                    data={"post_id": post_id},
-                    name=job_name
+async def recall_run(context: ContextTypes.DEFAULT_TYPE, post_id: str, run_id: str,
+                     progress_chat_id: Optional[int] = None) -> Tuple[Broadcast, List[str]]:
+    """
+    删除一次群发发出的消息：按群分组，每个群一次 deleteMessages，各群并发走群发流水线。
+    合并发送的消息里还有其他帖子的内容，不删；返回 (群发, 因此跳过的群)。
+    """
+    by_chat: Dict[str, Dict[str, List[int]]] = {}
+    merged: Set[str] = set()
+    for rec in DELIVERIES.messages(post_id, run_id):
+        if rec.get("merged"):
+            merged.add(rec["chat_id"])
+            continue
+        by_chat.setdefault(rec["chat_id"], {}).setdefault(rec.get("bot", ""), []).append(rec["message_id"])
+
+    async def action(cid: str) -> Dict[str, Any]:
+        for bot_id, mids in by_chat[cid].items():
+            bot = bot_for_record(context, {"bot": bot_id})
+            for i in range(0, len(mids), DELETE_BATCH):
+                await bot.delete_messages(
+                    chat_id=int(cid), message_ids=mids[i:i + DELETE_BATCH], rate_limit_args=LANE_IMMEDIATE
                 )
-        except Exception as e:
-            logger.error(f"[编辑后重建 schedule job 失败] {e}")
+        return {"chat_id": cid}
 
-    await msg.reply_text(f"✅ 已更新内容（ID: {post_id}）", reply_markup=MAIN_KEYBOARD)
-    context.user_data.clear()
+    b = Broadcast(f"撤回 post={post_id}", list(by_chat), action, lane=LANE_IMMEDIATE, verb="撤回")
+    if by_chat:
+        await run_broadcast(context, b, progress_chat_id)
+    DELIVERIES.forget(post_id, run_id, {r["chat_id"] for r in b.results} | merged)
+    return b, sorted(merged - set(by_chat))
 
-async def post_del_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def post_recall_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     if not is_admin(q.from_user.id):
         await q.answer("无权限")
         return
     post_id = q.data.split(":", 1)[1]
-    posts = load_posts()
-    post = get_post(posts, post_id)
-    if not post:
-        await q.answer("不存在")
+    runs = DELIVERIES.runs(post_id)[-RECALL_RUNS_SHOW:][::-1]
+    if not runs:
+        await q.answer(f"没有可撤回的投递记录（只保留 {DELIVERY_RETENTION_DAYS:g} 天）", show_alert=True)
         return
-    job_name = post.get("job_name")
-    if job_name and getattr(context, "job_queue", None) is not None:
-        remove_jobs_by_name(context.job_queue, job_name)
-    posts = [p for p in posts if p.get("id") != post_id]
-    save_posts(posts)
-    await q.answer("已删除")
+    rows = [
+        [InlineKeyboardButton(
+            f"{'最新 · ' if i == 0 else ''}{fmt_ts(ts)} · {n} 群",
+            callback_data=f"post_recall_run:{post_id}:{run_id}"
+        )]
+        for i, (run_id, ts, n) in enumerate(runs)
+    ]
+    await q.answer()
+    await q.message.reply_text(
+        f"↩️ 撤回任务 {post_id}：选择要撤回的那一次发送（会删除该次发到各群的消息）",
+        reply_markup=InlineKeyboardMarkup(rows)
+    )
+
+async def post_recall_run_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    if not is_admin(q.from_user.id):
+        await q.answer("无权限")
+        return
+    _, post_id, run_id = q.data.split(":", 2)
+    if not DELIVERIES.messages(post_id, run_id):
+        await q.answer("该次发送已撤回或记录已过期", show_alert=True)
+        return
+    await q.answer("开始撤回")
     try:
-        await q.message.delete()
+        await q.edit_message_text(f"↩️ 正在撤回任务 {post_id} 的发送（{run_id}）…")
     except Exception:
         pass
 
-async def post_toggle_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def recall_and_report():
+        b, skipped = await recall_run(context, post_id, run_id, progress_chat_id=q.message.chat_id)
+        groups_map = load_groups()
+        reasons = [f"{groups_map.get(cid, cid)} ({cid}) -> {err}" for cid, err in b.errors]
+        report = f"↩️ 撤回完成：{b.sent} 群已删除，失败 {b.failed} 群，耗时 {fmt_duration(b.elapsed())}。"
+        if skipped:
+            names = "、".join(groups_map.get(cid, cid) for cid in skipped[:10])
+            report += (f"\n\n⚠️ {len(skipped)} 个群里是与其他帖子合并发送的消息，删除会连带其他帖子，"
+                       f"未撤回（请手动处理）：{names}{' 等' if len(skipped) > 10 else ''}")
+        if reasons:
+            report += "\n\n❌ 失败原因：\n" + "\n".join(reasons[:10])
+        await q.message.reply_text(report)
+
+    context.application.create_task(recall_and_report(), update=update)
+
+# =========================
+# 同步修改：把新内容原地改到已发出的消息上（每群一次编辑，代替撤回 + 重发）
+# =========================
+# 编辑方式：t = 改文字，c = 改图片说明，m = 换图片
+LIVE_EDIT_KINDS = ("t", "c", "m")
+
+def live_edit_kind(old: Dict[str, Any], new: Dict[str, Any]) -> Optional[str]:
+    """新旧内容之间能用哪种方式原地修改；文字 ↔ 图片 之间不能改，返回 None"""
+    if old.get("type") != new.get("type"):
+        return None
+    if new.get("type") == "photo":
+        return "c" if old.get("photo_id") == new.get("photo_id") else "m"
+    return "t"
+
+async def offer_live_edit(msg, post_id: str, old: Dict[str, Any], new: Dict[str, Any]):
+    runs = DELIVERIES.runs(post_id)
+    if not runs:
+        return
+    kind = live_edit_kind(old, new)
+    if kind is None:
+        await msg.reply_text("ℹ️ 内容类型变了（文字 ↔ 图片），已发出的消息无法原地修改；如需替换请先 ↩️ 撤回 再重新发送。")
+        return
+    rows = [[InlineKeyboardButton(f"✏️ 同步到最近一次发送（{runs[-1][2]} 群）", callback_data=f"post_live:{post_id}:latest:{kind}")]]
+    if len(runs) > 1:
+        total = sum(n for _, _, n in runs)
+        rows.append([InlineKeyboardButton(f"✏️ 同步到全部 {len(runs)} 次发送（{total} 条）", callback_data=f"post_live:{post_id}:all:{kind}")])
+    rows.append([InlineKeyboardButton("不用同步", callback_data=f"post_live:{post_id}:no:-")])
+    await msg.reply_text("是否把新内容同步到已经发出去的消息？", reply_markup=InlineKeyboardMarkup(rows))
+
+async def edit_live_messages(context: ContextTypes.DEFAULT_TYPE, post: Dict[str, Any], run_ids: List[str], kind: str,
+                             progress_chat_id: Optional[int] = None) -> Broadcast:
+    """按投递记录逐群修改；已删除 / 超出可编辑范围的消息跳过（结果里记 skipped）"""
+    post_id = post["id"]
+    content = post.get("content", {})
+    rm = build_buttons(post.get("buttons"))
+    by_chat: Dict[str, List[Dict[str, Any]]] = {}
+    for rid in run_ids:
+        for rec in DELIVERIES.messages(post_id, rid):
+            by_chat.setdefault(rec["chat_id"], []).append(rec)
+
+    async def edit_one(rec: Dict[str, Any]):
+        bot = bot_for_record(context, rec)
+        kw = {"chat_id": int(rec["chat_id"]), "message_id": rec["message_id"], "reply_markup": rm,
+              "rate_limit_args": LANE_IMMEDIATE}
+        if kind == "t":
+            await bot.edit_message_text(text=content.get("text", "") or "", **kw)
+        elif kind == "c":
+            await bot.edit_message_caption(caption=content.get("caption", "") or "", **kw)
+        else:
+            media = InputMediaPhoto(media=content.get("photo_id"), caption=content.get("caption", "") or "")
+            await bot.edit_message_media(media=media, **kw)
+
+    async def action(cid: str) -> Dict[str, Any]:
+        res = {"chat_id": cid, "edited": 0, "skipped": 0}
+        for rec in by_chat[cid]:
+            if rec.get("merged"):
+                # 合并消息里还有其他任务的内容，不能整条替换
+                res["skipped"] += 1
+                continue
+            try:
+                await edit_one(rec)
+                res["edited"] += 1
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    res["edited"] += 1
+                else:
+                    res["skipped"] += 1
+                    logger.info(f"[同步修改跳过] chat={cid} msg={rec['message_id']} err={e}")
+        return res
+
+    b = Broadcast(f"同步修改 post={post_id}", list(by_chat), action, lane=LANE_IMMEDIATE, verb="修改")
+    await run_broadcast(context, b, progress_chat_id)
+    return b
+
+async def post_live_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     if not is_admin(q.from_user.id):
         await q.answer("无权限")
         return
-    post_id = q.data.split(":", 1)[1]
-    posts = load_posts()
-    post = get_post(posts, post_id)
-    if not post:
-        await q.answer("不存在")
+    _, post_id, scope, kind = q.data.split(":", 3)
+    if scope == "no":
+        await q.answer()
+        try:
+            await q.edit_message_text("已发出的消息保持不变。")
+        except Exception:
+            pass
+        return
+    post = get_post(load_posts(), post_id)
+    if scope == "latest":
+        latest = DELIVERIES.latest_run(post_id)
+        runs = [latest] if latest else []
+    else:
+        runs = [rid for rid, _, _ in DELIVERIES.runs(post_id)]
+    if not post or not runs or kind not in LIVE_EDIT_KINDS:
+        await q.answer("任务不存在或投递记录已过期", show_alert=True)
         return
+    await q.answer("开始同步")
+    try:
+        await q.edit_message_text(f"✏️ 正在同步修改任务 {post_id} 已发出的消息…")
+    except Exception:
+        pass
 
-    post["enabled"] = not post.get("enabled", True)
+    async def edit_and_report():
+        b = await edit_live_messages(context, post, runs, kind, progress_chat_id=q.message.chat_id)
+        edited = sum(r["edited"] for r in b.results)
+        skipped = sum(r["skipped"] for r in b.results)
+        groups_map = load_groups()
+        reasons = [f"{groups_map.get(cid, cid)} ({cid}) -> {err}" for cid, err in b.errors]
+        report = (f"✏️ 同步修改完成：已修改 {edited} 条，跳过 {skipped} 条（已删除、无法编辑或与其他任务合并发送），"
+                  f"失败 {b.failed} 群，耗时 {fmt_duration(b.elapsed())}。")
+        if reasons:
+            report += "\n\n❌ 失败原因：\n" + "\n".join(reasons[:10])
+        await q.message.reply_text(report)
 
-    job_name = post.get("job_name")
-    if job_name and getattr(context, "job_queue", None) is not None:
-        remove_jobs_by_name(context.job_queue, job_name)
+    context.application.create_task(edit_and_report(), update=update)
 
-    if post["enabled"] and ensure_job_queue(context):
+# =========================
+# 批量导入 / 导出（JSONL，逐行流式处理）
+# =========================
+# groups 每行：{"chat_id": "-100123", "title": "群名"}
+# posts  每行：与 posts.json 中单条记录结构相同（按 id 覆盖导入）
+POST_TYPES = ("schedule", "daily")
+# 帖子 ID 会写进投递日志（TSV）和按钮 callback_data（: 分隔、最长 64 字节），只接受 gen_id() 这种形状
+POST_ID_RE = re.compile(r"[A-Za-z0-9_-]{1,16}")
+IMPORT_CHUNK = 500   # 导入时每多少条合并一次
+IMPORT_ERROR_SHOW = 10
+
+def iter_jsonl(fp: TextIO):
+    """逐行读取 JSONL，产出 (行号, 记录, 错误信息)；不会一次性读入整个文件"""
+    for lineno, line in enumerate(fp, 1):
+        line = line.strip()
+        if not line:
+            continue
         try:
-            if post.get("type") == "daily":
-                tm = parse_time_flexible(post.get("daily_time", ""))
-                if tm:
-                    context.job_queue.run_daily(
-                        daily_execute_job,
-                        time=tm,
-                        data={"post_id": post_id},
-                        name=job_name
-                    )
-            elif post.get("type") == "schedule":
-                dt = datetime.fromisoformat(post.get("send_time"))
-                if dt.tzinfo is None:
-                    dt = dt.replace(tzinfo=LOCAL_TZ)
-                if dt > now_local():
-                    delay = max(1, int((dt - now_local()).total_seconds()))
-                    context.job_queue.run_once(
-                        schedule_execute_job,
-                        when=delay,
-                        data={"post_id": post_id},
-                        name=job_name
-                    )
+            yield lineno, json_loads(line), None
         except Exception as e:
-            logger.error(f"[启用任务失败] {e}")
+            yield lineno, None, f"JSON 解析失败：{e}"
+
+def _chat_id_str(value: Any) -> str:
+    s = str(value).strip()
+    if not re.fullmatch(r"-?\d+", s):
+        raise ValueError(f"chat_id 非法：{value!r}")
+    return s
+
+def validate_group_record(rec: Any) -> Tuple[str, str]:
+    if not isinstance(rec, dict):
+        raise ValueError("记录必须是 JSON 对象")
+    cid = _chat_id_str(rec.get("chat_id", ""))
+    title = str(rec.get("title") or "").strip() or f"group_{cid}"
+    return cid, title
+
+def validate_post_record(rec: Any) -> Dict[str, Any]:
+    if not isinstance(rec, dict):
+        raise ValueError("记录必须是 JSON 对象")
+
+    ptype = rec.get("type")
+    if ptype not in POST_TYPES:
+        raise ValueError(f"type 必须是 schedule 或 daily：{ptype!r}")
+
+    groups = rec.get("groups")
+    if not isinstance(groups, list) or not groups:
+        raise ValueError("groups 必须是非空列表")
+    groups = [_chat_id_str(g) for g in groups]
+
+    c = rec.get("content")
+    if not isinstance(c, dict):
+        raise ValueError("content 必须是对象")
+    if c.get("type") == "photo":
+        if not c.get("photo_id"):
+            raise ValueError("图片内容缺少 photo_id")
+        content = {"type": "photo", "photo_id": str(c["photo_id"]), "caption": str(c.get("caption") or "")}
+        if c.get("media"):
+            content["media"] = str(c["media"])
+    elif c.get("type") == "text":
+        if not c.get("text"):
+            raise ValueError("文字内容为空")
+        content = {"type": "text", "text": str(c["text"])}
+    else:
+        raise ValueError(f"content.type 必须是 text 或 photo：{c.get('type')!r}")
 
-    save_posts(posts)
-    await q.answer("已切换")
     try:
-        await q.message.edit_text(fmt_post(post))
-    except Exception:
-        pass
+        delete_minutes = int(rec.get("delete_minutes", 0))
+    except (TypeError, ValueError):
+        raise ValueError(f"delete_minutes 必须是整数：{rec.get('delete_minutes')!r}")
+    if delete_minutes < 0:
+        raise ValueError("delete_minutes 不能为负数")
+
+    buttons = rec.get("buttons")
+    if buttons is not None and not isinstance(buttons, dict):
+        raise ValueError("buttons 必须是对象或 null")
+
+    post_id = str(rec.get("id") or gen_id())
+    if not POST_ID_RE.fullmatch(post_id):
+        raise ValueError(f"id 只能是 1-16 位字母、数字、_ 或 -：{rec.get('id')!r}")
+    post: Dict[str, Any] = {"id": post_id, "type": ptype, "groups": groups}
+    if ptype == "schedule":
+        raw = str(rec.get("send_time") or "")
+        try:
+            dt = datetime.fromisoformat(raw)
+        except ValueError:
+            dt = parse_dt_full(raw)
+        if not dt:
+            raise ValueError(f"send_time 无法解析：{raw!r}")
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=LOCAL_TZ)
+        post["send_time"] = dt.isoformat()
+    elif rec.get("recurrence"):
+        post["recurrence"] = normalize_recurrence(rec["recurrence"])
+    else:
+        raw = str(rec.get("daily_time") or "")
+        if not parse_time_flexible(raw):
+            raise ValueError(f"daily_time 无法解析：{raw!r}")
+        post["recurrence"] = post_recurrence({"daily_time": raw})
+
+    if rec.get("owner") is not None:
+        try:
+            post["owner"] = int(rec["owner"])
+        except (TypeError, ValueError):
+            raise ValueError(f"owner 必须是用户 ID：{rec.get('owner')!r}")
+    if rec.get("weight") is not None:
+        try:
+            post["weight"] = max(1, int(rec["weight"]))
+        except (TypeError, ValueError):
+            raise ValueError(f"weight 必须是整数：{rec.get('weight')!r}")
+
+    post.update({
+        "delete_minutes": delete_minutes,
+        "content": content,
+        "buttons": buttons,
+        "enabled": bool(rec.get("enabled", True)),
+        "job_name": f"{ptype}_{post_id}",
+    })
+    return post
+
+def _note_import_error(stats: Dict[str, Any], lineno: int, err: str):
+    stats["bad"] += 1
+    if len(stats["errors"]) < IMPORT_ERROR_SHOW:
+        stats["errors"].append(f"第 {lineno} 行：{err}")
+
+# 逐行校验，每攒够 IMPORT_CHUNK 条交给 apply 合并一次：内存只和块大小有关，只保留计数和前几条错误。
+# 合并原地改内存里的数据，不会把导入期间别人做的修改整体覆盖掉
+def apply_groups_chunk(chunk: List[Tuple[str, str]]):
+    groups = load_groups()
+    groups.update(chunk)
+    save_groups(groups)
+
+def apply_posts_chunk(chunk: List[Dict[str, Any]]):
+    REPO.upsert_many(chunk)  # 同 id 以文件里靠后的一条为准
+
+def import_jsonl(kind: str, fp: TextIO, apply: Optional[Callable[[List[Any]], None]] = None) -> Dict[str, Any]:
+    validate = validate_group_record if kind == "groups" else validate_post_record
+    apply = apply or IMPORT_APPLIERS[kind]
+    stats: Dict[str, Any] = {"ok": 0, "bad": 0, "errors": []}
+    chunk: List[Any] = []
+    for lineno, rec, err in iter_jsonl(fp):
+        if err is None:
+            try:
+                chunk.append(validate(rec))
+            except ValueError as e:
+                err = str(e)
+            else:
+                stats["ok"] += 1
+                if len(chunk) >= IMPORT_CHUNK:
+                    apply(chunk)
+                    chunk = []
+                continue
+        _note_import_error(stats, lineno, err)
+    if chunk:
+        apply(chunk)
+    return stats
+
+def import_groups_jsonl(fp: TextIO) -> Dict[str, Any]:
+    return import_jsonl("groups", fp)
+
+def import_posts_jsonl(fp: TextIO) -> Dict[str, Any]:
+    return import_jsonl("posts", fp)
+
+def export_groups_jsonl(fp: TextIO) -> int:
+    n = 0
+    for cid, title in list(load_groups().items()):
+        fp.write(json_dumps({"chat_id": cid, "title": title}).decode("utf-8") + "\n")
+        n += 1
+    return n
+
+def export_posts_jsonl(fp: TextIO) -> int:
+    n = 0
+    for p in list(load_posts()):
+        fp.write(json_dumps(p).decode("utf-8") + "\n")
+        n += 1
+    return n
+
+EXPORTERS: Dict[str, Callable[[TextIO], int]] = {"groups": export_groups_jsonl, "posts": export_posts_jsonl}
+IMPORTERS: Dict[str, Callable[[TextIO], Dict[str, Any]]] = {"groups": import_groups_jsonl, "posts": import_posts_jsonl}
+IMPORT_APPLIERS: Dict[str, Callable[[List[Any]], None]] = {"groups": apply_groups_chunk, "posts": apply_posts_chunk}
+
+def import_file(kind: str, path: str, apply: Optional[Callable[[List[Any]], None]] = None) -> Dict[str, Any]:
+    with open(path, "r", encoding="utf-8-sig") as fp:
+        return import_jsonl(kind, fp, apply)
+
+def export_to_tempfile(kind: str) -> Tuple[str, int]:
+    fd, path = tempfile.mkstemp(prefix=f"{kind}_", suffix=".jsonl")
+    with os.fdopen(fd, "w", encoding="utf-8") as fp:
+        n = EXPORTERS[kind](fp)
+    return path, n
+
+def fmt_import_report(kind: str, stats: Dict[str, Any]) -> str:
+    s = f"📥 导入 {kind}：成功 {stats['ok']} 条，失败 {stats['bad']} 条。"
+    if stats["errors"]:
+        s += "\n\n❌ 错误示例：\n" + "\n".join(stats["errors"])
+    return s
+
+async def cmd_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not is_admin(user.id):
+        await update.message.reply_text(f"⛔ 无权限。你的ID：{user.id}")
+        return
+    if update.effective_chat.type != "private":
+        await update.message.reply_text("请在私聊中使用 /export")
+        return
+
+    stamp = now_local().strftime("%Y%m%d_%H%M")
+    for kind in ("groups", "posts"):
+        path, n = await asyncio.to_thread(export_to_tempfile, kind)
+        try:
+            await update.message.reply_document(
+                document=Path(path),
+                filename=f"{kind}_{stamp}.jsonl",
+                caption=f"{kind}：{n} 条"
+            )
+        finally:
+            Path(path).unlink(missing_ok=True)
+
+async def import_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not user or not is_admin(user.id):
+        return
+
+    msg = update.message
+    name = (msg.document.file_name or "").lower()
+    kind = next((k for k in IMPORTERS if name.startswith(k)), None)
+    if not kind:
+        await msg.reply_text("❗ 文件名需以 groups 或 posts 开头，例如 groups.jsonl / posts.jsonl")
+        return
+
+    loop = asyncio.get_running_loop()
+    jobs = kind == "posts" and ensure_job_queue(context)
+    registered = 0
+
+    async def apply_in_loop(chunk: List[Any]):
+        nonlocal registered
+        IMPORT_APPLIERS[kind](chunk)
+        if not jobs:
+            return
+        # 导入的帖子立即注册任务（覆盖同名旧任务）
+        for p in chunk:
+            remove_jobs_by_name(context.job_queue, p.get("job_name"))
+            if p.get("enabled", True) and register_post_job(context.job_queue, p, recompute=True):
+                registered += 1
+        REPO.save()
+
+    def apply_chunk(chunk: List[Any]):
+        # 解析在工作线程里，每一块回到事件循环合并，和 handler 不会交错
+        asyncio.run_coroutine_threadsafe(apply_in_loop(chunk), loop).result()
+
+    fd, path = tempfile.mkstemp(suffix=".jsonl")
+    os.close(fd)
+    try:
+        tg_file = await msg.document.get_file()
+        await tg_file.download_to_drive(path)
+        stats = await asyncio.to_thread(import_file, kind, path, apply_chunk)
+    finally:
+        Path(path).unlink(missing_ok=True)
+
+    report = fmt_import_report(kind, stats)
+    if jobs and stats["ok"]:
+        report += f"\n⏰ 已注册任务：{registered} 个"
+    await msg.reply_text(report, reply_markup=MAIN_KEYBOARD)
 
 # =========================
 # Router（唯一消息入口）
@@ -1220,7 +4568,7 @@ async def router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await immediate_start(update, context)
     if text == "⏰ 定时发送":
         return await schedule_start(update, context)
-    if text == "🔁 每日循环发送":
+    if text in ("🔁 循环发送", "🔁 每日循环发送"):
         return await daily_start(update, context)
     if text == "⬅️ 返回菜单":
         context.user_data.clear()
@@ -1229,62 +4577,260 @@ async def router(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # =========================
 # 启动恢复任务
 # =========================
-async def restore_jobs(app: Application):
-    posts = load_posts()
-    if not posts:
-        logger.info("无任务可恢复")
-        return
+def register_post_job(job_queue, p: Dict[str, Any], recompute: bool = False, after: Optional[datetime] = None) -> bool:
+    """
+    按一条帖子记录注册 job（补全 job_name）；返回是否注册成功。
+    daily：优先使用已保存且未过期的 next_fire；recompute / 传入 after 时按规则重新计算，
+    结果写回 p["next_fire"]（None 表示日期范围已结束）。
+    """
+    pid = p.get("id")
+    ptype = p.get("type")
+    job_name = p.get("job_name") or f"{ptype}_{pid}"
+    p["job_name"] = job_name
+
+    if ptype == "daily":
+        nxt = None
+        if not recompute and after is None:
+            if "next_fire" in p and not p["next_fire"]:
+                return False  # 已结束
+            if p.get("next_fire"):
+                nxt = datetime.fromisoformat(p["next_fire"])
+        if nxt is None or nxt <= now_local():
+            rec = post_recurrence(p)
+            if not rec:
+                return False
+            p["recurrence"] = rec
+            p.pop("daily_time", None)
+            nxt = next_fire_after(rec, after or now_local())
+            p["next_fire"] = nxt.isoformat() if nxt else None
+            if not nxt:
+                return False
+        job_queue.run_once(
+            daily_execute_job,
+            when=nxt,
+            data={"post_id": pid},
+            name=job_name
+        )
+        return True
+
+    if ptype == "schedule":
+        dt = datetime.fromisoformat(p.get("send_time"))
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=LOCAL_TZ)
+        if dt <= now_local():
+            return False
+        delay = max(1, int((dt - now_local()).total_seconds()))
+        job_queue.run_once(
+            schedule_execute_job,
+            when=delay,
+            data={"post_id": pid},
+            name=job_name
+        )
+        return True
+
+    return False
 
+# 启动时不在 post_init 里同步恢复：post_init 只登记一个立即执行的 job，
+# JobQueue 在 Webhook 端口绑定之后才启动，所以恢复全程都能正常接收更新。
+# 只注册 RESTORE_HORIZON_HOURS 内要发的任务，更远的由 topup_jobs_job 每半个窗口补一次（不会漏：补的时候窗口还剩一半）
+RESTORE_BATCH = int(os.getenv("RESTORE_BATCH", "200"))
+RESTORE_HORIZON_HOURS = float(os.getenv("RESTORE_HORIZON_HOURS", "6"))
+RESTORE_STATE: Dict[str, Any] = {"ready": False, "restored": 0, "deferred": 0, "done": 0, "total": 0, "seconds": 0.0}
+
+async def on_post_init(app: Application):
+    LOOP_MONITOR.start()
+    if BULK_BOT is not None:
+        await BULK_BOT.initialize()
+    if SENDERS is not None:
+        await SENDERS.initialize()
     if getattr(app, "job_queue", None) is None:
         logger.error("JobQueue 缺失：无法恢复任务。请确认 requirements.txt 使用 python-telegram-bot[job-queue,webhooks].")
+        RESTORE_STATE["ready"] = True
         return
+    app.job_queue.run_once(restore_jobs_job, when=0, name="restore_jobs")
+    topup = RESTORE_HORIZON_HOURS * 3600 / 2
+    app.job_queue.run_repeating(topup_jobs_job, interval=topup, first=topup, name="topup_jobs")
+    app.job_queue.run_repeating(evict_flows_job, interval=60, first=60, name="evict_flows")
+    app.job_queue.run_repeating(save_metrics_job, interval=600, first=600, name="save_metrics")
+    app.job_queue.run_repeating(validate_media_job, interval=300, first=120, name="validate_media")
+    app.job_queue.run_repeating(archive_posts_job, interval=3600, first=300, name="archive_posts")
+    app.job_queue.run_repeating(
+        compact_deliveries_job, interval=DELIVERY_COMPACT_HOURS * 3600, first=600, name="compact_deliveries"
+    )
 
-    restored = 0
-    for p in posts:
-        if not p.get("enabled", True):
-            continue
-        pid = p.get("id")
-        ptype = p.get("type")
-        job_name = p.get("job_name") or f"{ptype}_{pid}"
-        p["job_name"] = job_name
-
-        try:
-            if ptype == "daily":
-                tm = parse_time_flexible(p.get("daily_time", ""))
-                if tm:
-                    app.job_queue.run_daily(
-                        daily_execute_job,
-                        time=tm,
-                        data={"post_id": pid},
-                        name=job_name
-                    )
-                    restored += 1
-            elif ptype == "schedule":
-                dt = datetime.fromisoformat(p.get("send_time"))
-                if dt.tzinfo is None:
-                    dt = dt.replace(tzinfo=LOCAL_TZ)
-                if dt <= now_local():
+async def restore_jobs_job(context: ContextTypes.DEFAULT_TYPE):
+    await restore_jobs(context.application)
+
+async def register_due_posts(job_queue, posts: List[Dict[str, Any]], until: datetime,
+                             progress: Optional[Callable[[int, int, int], None]] = None) -> Tuple[int, int]:
+    """给 until 之前要发、还没有 job 的启用帖子注册 job，分批让出事件循环；返回 (注册数, 推迟数)"""
+    now = now_local()
+    registered, deferred, changed = 0, 0, False
+    for i in range(0, len(posts), RESTORE_BATCH):
+        # 每批刷新一次已存在的 job 名，跳过期间已被 handler 注册的任务
+        existing = {j.name for j in job_queue.jobs()}
+        for p in posts[i:i + RESTORE_BATCH]:
+            if not p.get("enabled", True) or p.get("job_name") in existing:
+                continue
+            before = (p.get("job_name"), p.get("next_fire"))
+            try:
+                fire_at = post_fire_time(p, now)
+                if fire_at is not None and fire_at > until:
+                    deferred += 1
                     continue
-                delay = max(1, int((dt - now_local()).total_seconds()))
-                app.job_queue.run_once(
-                    schedule_execute_job,
-                    when=delay,
-                    data={"post_id": pid},
-                    name=job_name
-                )
-                restored += 1
-        except Exception as e:
-            logger.error(f"[恢复失败] id={pid} type={ptype} err={e}")
+                if register_post_job(job_queue, p):
+                    registered += 1
+            except Exception as e:
+                logger.error(f"[恢复失败] id={p.get('id')} type={p.get('type')} err={e}")
+            changed = changed or before != (p.get("job_name"), p.get("next_fire"))
+        if progress:
+            progress(registered, deferred, min(i + RESTORE_BATCH, len(posts)))
+        await asyncio.sleep(0)
+
+    # 只有补算了 next_fire / job_name 才回写（写当前内存里的完整列表）
+    if changed:
+        REPO.save()
+    return registered, deferred
+
+async def restore_jobs(app: Application):
+    t0 = time.monotonic()
+    posts = list(load_posts())  # 快照；恢复期间新建的帖子由各自的 handler 注册
+    RESTORE_STATE.update(ready=False, restored=0, deferred=0, done=0, total=len(posts))
+    if not posts:
+        logger.info("无任务可恢复")
+        RESTORE_STATE["ready"] = True
+        return
+
+    def progress(registered: int, deferred: int, done: int):
+        RESTORE_STATE.update(restored=registered, deferred=deferred, done=done)
+
+    until = now_local() + timedelta(hours=RESTORE_HORIZON_HOURS)
+    restored, deferred = await register_due_posts(app.job_queue, posts, until, progress)
+    RESTORE_STATE.update(ready=True, seconds=time.monotonic() - t0)
+    logger.info(f"恢复完成：{restored} 个任务，{deferred} 个在 {RESTORE_HORIZON_HOURS:g} 小时以后、到时再注册，"
+                f"用时 {RESTORE_STATE['seconds']:.2f}s")
 
-    save_posts(posts)
-    logger.info(f"恢复完成：{restored} 个任务")
+async def topup_jobs_job(context: ContextTypes.DEFAULT_TYPE):
+    """把接下来一个窗口内要发的任务补注册上"""
+    if not RESTORE_STATE["ready"]:
+        return
+    until = now_local() + timedelta(hours=RESTORE_HORIZON_HOURS)
+    registered, deferred = await register_due_posts(context.job_queue, list(load_posts()), until)
+    if registered:
+        logger.info(f"[任务补注册] {registered} 个，仍在窗口外 {deferred} 个")
+
+async def on_shutdown(app: Application):
+    await LOOP_MONITOR.stop()
+    if SENDERS is not None:
+        await SENDERS.shutdown()
+    if BULK_BOT is not None:
+        await BULK_BOT.shutdown()
+    METRICS.save()
+    flush_stores()
+    logger.info("数据已落盘")
 
 async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
     logger.exception("Unhandled exception:", exc_info=context.error)
 
+# =========================
+# 更新入口：去重 + 分发前过滤（群里普通成员的聊天不进 handler）
+# =========================
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]   # 只订阅用得到的更新类型
+UPDATE_DEDUP_SIZE = int(os.getenv("UPDATE_DEDUP_SIZE", "2048"))  # 记住最近多少个 update_id
+PUBLIC_COMMANDS = ("/id",)                      # 非管理员也可以用的命令
+PRIVATE_PUBLIC_COMMANDS = PUBLIC_COMMANDS + ("/start",)   # 私聊里再加上 /start（告诉对方自己的 ID）
+
+class UpdateGate:
+    def __init__(self, size: int = UPDATE_DEDUP_SIZE):
+        self._recent: deque = deque(maxlen=max(1, size))
+        self._seen: Set[int] = set()
+        self.admitted = 0
+        self.duplicates = 0
+        self.filtered = 0
+
+    def _is_duplicate(self, update_id: int) -> bool:
+        if update_id in self._seen:
+            return True
+        if len(self._recent) == self._recent.maxlen:
+            self._seen.discard(self._recent[0])
+        self._recent.append(update_id)
+        self._seen.add(update_id)
+        return False
+
+    def admit(self, update: object) -> bool:
+        if not isinstance(update, Update):
+            return True
+        if self._is_duplicate(update.update_id):
+            self.duplicates += 1
+            return False
+        user = update.effective_user
+        chat = update.effective_chat
+        if user and is_admin(user.id):
+            self.admitted += 1
+            return True
+        # 非管理员（群里和私聊都一样）只放行公开命令，其余消息和按钮回调不进 handler
+        public = PRIVATE_PUBLIC_COMMANDS if chat and chat.type == "private" else PUBLIC_COMMANDS
+        msg = update.effective_message
+        text = (msg.text or "") if msg else ""
+        if text.startswith("/") and text.split(maxsplit=1)[0].split("@", 1)[0] in public:
+            self.admitted += 1
+            return True
+        self.filtered += 1
+        return False
+
+    def describe(self) -> str:
+        return f"更新入口: 处理 {self.admitted}，过滤 {self.filtered}，重复 {self.duplicates}"
+
+UPDATE_GATE = UpdateGate()
+
+class GatedApplication(Application):
+    async def process_update(self, update: object) -> None:
+        if UPDATE_GATE.admit(update):
+            await super().process_update(update)
+
+# 同时处理的更新数：帖子读写已经走 REPO 事务，可以调大。≤1 = 逐个处理（默认）
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "0"))
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """不同用户的更新并发处理；同一用户（没有用户时按聊天）的更新仍按到达顺序逐个处理，流程状态不会交错"""
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._locks: Dict[int, List[Any]] = {}   # key -> [锁, 引用数]；没人用了就删，不会无限增长
+
+    @staticmethod
+    def _key(update: object) -> int:
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return 0
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = self._key(update)
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._locks.pop(key, None)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
 # =========================
 # Webhook 启动
 # =========================
+# 启动很快且恢复在后台进行，默认保留重启期间积压的更新
+DROP_PENDING_UPDATES = os.getenv("DROP_PENDING_UPDATES", "0") == "1"
+
 def run_webhook(app: Application):
     if not WEBHOOK_BASE.startswith("https://"):
         raise RuntimeError("WEBHOOK_BASE 必须是 https:// 开头")
@@ -1298,8 +4844,8 @@ def run_webhook(app: Application):
         port=PORT,
         url_path=url_path,
         webhook_url=webhook_url,
-        allowed_updates=Update.ALL_TYPES,
-        drop_pending_updates=True,
+        allowed_updates=ALLOWED_UPDATES,
+        drop_pending_updates=DROP_PENDING_UPDATES,
     )
 
 def main():
@@ -1307,8 +4853,37 @@ def main():
         raise RuntimeError("BOT_TOKEN 为空，请在 Railway Variables 填 BOT_TOKEN")
     if not WEBHOOK_BASE:
         raise RuntimeError("WEBHOOK_BASE 为空，请在 Railway Variables 填 WEBHOOK_BASE")
+    write_pid_file()
+
+    global BULK_BOT, SENDERS
+    api = {}
+    if BOT_API_URL:
+        api = {"base_url": BOT_API_URL, "base_file_url": BOT_API_URL.rsplit("/bot", 1)[0] + "/file/bot"}
+    limiter = PriorityRateLimiter()
+    BULK_BOT = ExtBot(token=BOT_TOKEN, request=make_request("群发", HTTP_BULK_POOL_SIZE), rate_limiter=limiter, **api)
+    if SENDER_TOKENS:
+        # 每个发送 bot 有自己的 Telegram 限额，所以各配一个独立限速器
+        SENDERS = SenderPool(BULK_BOT, [
+            ExtBot(token=t, request=make_request(f"发送{i + 1}", HTTP_SENDER_POOL_SIZE),
+                   rate_limiter=PriorityRateLimiter(), **api)
+            for i, t in enumerate(SENDER_TOKENS)
+        ])
 
-    app = Application.builder().token(BOT_TOKEN).post_init(restore_jobs).build()
+    builder = Application.builder()
+    if api:
+        builder = builder.base_url(api["base_url"]).base_file_url(api["base_file_url"])
+    app = (
+        builder
+        .application_class(GatedApplication)
+        .token(BOT_TOKEN)
+        .request(make_request("交互", HTTP_POOL_SIZE))
+        .rate_limiter(limiter)
+        .persistence(FLOW_STORE)
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES) if CONCURRENT_UPDATES > 1 else False)
+        .post_init(on_post_init)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     # 命令
     app.add_handler(CommandHandler("start", cmd_start))
@@ -1317,9 +4892,14 @@ def main():
     app.add_handler(CommandHandler("register", register_group))
     app.add_handler(CommandHandler("unregister", unregister_group))
     app.add_handler(CommandHandler("managegroups", managegroups))
+    app.add_handler(CommandHandler("export", cmd_export))
+    app.add_handler(CommandHandler("stats", cmd_stats))
+    app.add_handler(CommandHandler("profile", cmd_profile))
+    app.add_handler(CommandHandler("archive", cmd_archive))
 
     # callbacks
     app.add_handler(CallbackQueryHandler(managegroups_cb, pattern=r"^mg_"))
+    app.add_handler(CallbackQueryHandler(archive_restore_cb, pattern=r"^arc_restore:"))
     app.add_handler(CallbackQueryHandler(immediate_cb, pattern=r"^im_"))
     app.add_handler(CallbackQueryHandler(schedule_cb, pattern=r"^sc_"))
     app.add_handler(CallbackQueryHandler(daily_cb, pattern=r"^dy_"))
@@ -1328,14 +4908,484 @@ def main():
     app.add_handler(CallbackQueryHandler(post_edit_cb, pattern=r"^post_edit:"))
     app.add_handler(CallbackQueryHandler(post_del_cb, pattern=r"^post_del:"))
     app.add_handler(CallbackQueryHandler(post_toggle_cb, pattern=r"^post_toggle:"))
+    app.add_handler(CallbackQueryHandler(post_recall_cb, pattern=r"^post_recall:"))
+    app.add_handler(CallbackQueryHandler(post_recall_run_cb, pattern=r"^post_recall_run:"))
+    app.add_handler(CallbackQueryHandler(post_live_cb, pattern=r"^post_live:"))
+
+    # JSONL 导入（私聊上传文档）
+    app.add_handler(MessageHandler(filters.ChatType.PRIVATE & filters.Document.FileExtension("jsonl"), import_document))
 
     # router（唯一消息入口）
     app.add_handler(MessageHandler(filters.TEXT | filters.PHOTO, router))
 
     app.add_error_handler(on_error)
 
+    # 启动前一次性读入内存，之后事件循环不再读盘
+    load_groups()
+    load_posts()
+    DELIVERIES.load()
+    METRICS.load()
+
     logger.info("Starting BG678 Webhook Bot…")
     run_webhook(app)
 
+# =========================
+# JSON 编解码基准（命令行 bench-json）
+# =========================
+def sample_posts(n: int, n_groups: int = 300, seed: int = 1) -> List[Dict[str, Any]]:
+    """按真实结构生成的示例帖子（中文文案 + 按钮 + 几十到几百个群）"""
+    import random
+    rnd = random.Random(seed)
+    groups = [f"-100{1000000000 + i * 7919}" for i in range(n_groups)]
+    words = "限时优惠今日上新欢迎咨询客服活动火热进行中点击下方按钮领取福利名额有限先到先得"
+    posts = []
+    for i in range(n):
+        daily = i % 2 == 0
+        p = {
+            "id": uuid.UUID(int=rnd.getrandbits(128)).hex[:8],
+            "type": "daily" if daily else "schedule",
+            "groups": rnd.sample(groups, rnd.randint(min(30, n_groups), n_groups)),
+            "content": {"type": "text", "text": "".join(rnd.choice(words) for _ in range(rnd.randint(80, 400)))},
+            "buttons": {"copy": {"text": "复制口令", "value": f"CODE{i:06d}"},
+                        "url": {"text": "立即参与", "url": f"https://example.com/p/{i}"}},
+            "delete_minutes": rnd.choice([0, 30, 60]),
+            "enabled": True,
+            "owner": 10000 + i % 5,
+            "weight": 1,
+        }
+        if daily:
+            p["recurrence"] = {"kind": "daily", "time": f"{rnd.randint(0, 23):02d}:{rnd.choice([0, 30]):02d}:00"}
+            p["next_fire"] = None
+            p["job_name"] = f"daily_{p['id']}"
+        else:
+            p["send_time"] = "2025/12/31 20:00:00"
+            p["job_name"] = f"schedule_{p['id']}"
+        posts.append(p)
+    return posts
+
+def bench_json(posts: List[Dict[str, Any]], rounds: int = 20) -> str:
+    lines = [f"{len(posts)} 个帖子，每项取 {rounds} 次中位数", f"{'编解码':<16}{'序列化':>10}{'解析':>10}{'大小':>12}"]
+    for codec in available_codecs().values():
+        for pretty in (True, False):
+            dump_t, load_t = [], []
+            for _ in range(rounds):
+                t0 = time.perf_counter()
+                raw = codec.dumps(posts, pretty)
+                t1 = time.perf_counter()
+                codec.loads(raw)
+                t2 = time.perf_counter()
+                dump_t.append(t1 - t0)
+                load_t.append(t2 - t1)
+            name = f"{codec.name}/{'缩进' if pretty else '紧凑'}"
+            lines.append(f"{name:<16}{sorted(dump_t)[rounds // 2] * 1000:>8.2f}ms"
+                         f"{sorted(load_t)[rounds // 2] * 1000:>8.2f}ms{len(raw) / 1024:>10.1f}KB")
+    lines.append(f"当前使用：{CODEC.name}/{'紧凑' if JSON_COMPACT else '缩进'}（JSON_CODEC / JSON_COMPACT）")
+    return "\n".join(lines)
+
+# =========================
+# 负载测试：本地启动一个机器人进程 + Bot API 替身，按设定速率回放更新
+# =========================
+LOADTEST_TOKEN = "123456:LOADTEST"
+LOADTEST_ADMIN_BASE = 9000000
+LOADTEST_ADMIN_TEXTS = ["📤 发送帖子", "⬅️ 返回菜单", "🧪 Debug", "/start"]
+LOADTEST_KINDS = ("chatter", "admin", "callback")
+
+class FakeBotApi:
+    """最小的 Bot API 替身：HTTP/1.1 keep-alive，按方法名返回固定结构；记录各方法调用数和按钮应答时间"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Dict[str, int] = {}
+        self.answered: Dict[str, float] = {}   # callback_query_id -> 收到 answerCallbackQuery 的时刻
+        self.port = 0
+        self._msg_id = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    def stop(self):
+        if self._server:
+            self._server.close()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+                path = head[0].split(" ")[1]
+                headers = {k.strip().lower(): v.strip() for k, v in (h.split(":", 1) for h in head[1:] if ":" in h)}
+                body = await reader.readexactly(int(headers.get("content-length") or 0))
+                result = self._handle(path.rsplit("/", 1)[-1], headers.get("content-type", ""), body)
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                payload = json_dumps({"ok": True, "result": result})
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                             b"Content-Length: %d\r\n\r\n" % len(payload) + payload)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def _handle(self, method: str, ctype: str, body: bytes) -> Any:
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params: Dict[str, Any] = {}
+        if "urlencoded" in ctype:
+            params = {k: v[0] for k, v in urllib.parse.parse_qs(body.decode("utf-8")).items()}
+        elif "json" in ctype and body:
+            params = json_loads(body)
+        if method == "answerCallbackQuery":
+            self.answered[str(params.get("callback_query_id", ""))] = time.perf_counter()
+            return True
+        if method == "getMe":
+            return {"id": int(LOADTEST_TOKEN.split(":")[0]), "is_bot": True,
+                    "first_name": "LoadTest", "username": "loadtest_bot"}
+        if method == "copyMessage" or (method.startswith(("send", "edit")) and method != "sendChatAction"):
+            self._msg_id += 1
+            try:
+                chat_id = int(params.get("chat_id") or 0)
+            except ValueError:
+                chat_id = 0
+            return {"message_id": self._msg_id, "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+        return True
+
+def parse_mix(raw: str) -> List[Tuple[str, int]]:
+    mix = []
+    for part in raw.split(","):
+        name, _, w = part.partition("=")
+        name = name.strip()
+        if name not in LOADTEST_KINDS:
+            raise ValueError(f"未知的更新类型：{name}（可选 {'/'.join(LOADTEST_KINDS)}）")
+        mix.append((name, int(w or 1)))
+    return mix
+
+def synthetic_updates(mix: List[Tuple[str, int]], admins: List[int], post_ids: List[str],
+                      groups: List[str], seed: int = 1):
+    """按比例无限生成：群内闲聊（入口过滤掉）、管理员菜单操作、我的帖子里的按钮点击"""
+    import random
+    rnd = random.Random(seed)
+    kinds = [k for k, _ in mix]
+    weights = [w for _, w in mix]
+    words = "今天有活动吗客服在不在谢谢收到了好的明白"
+    n = 0
+    while True:
+        n += 1
+        kind = rnd.choices(kinds, weights)[0]
+        now = int(time.time())
+        if kind == "chatter":
+            cid = int(rnd.choice(groups))
+            uid = 100000000 + rnd.randrange(100000)
+            yield kind, {"message": {
+                "message_id": n, "date": now, "chat": {"id": cid, "type": "supergroup", "title": f"group{cid}"},
+                "from": {"id": uid, "is_bot": False, "first_name": f"u{uid}"},
+                "text": "".join(rnd.choice(words) for _ in range(rnd.randint(2, 30))),
+            }}
+            continue
+        uid = rnd.choice(admins)
+        user = {"id": uid, "is_bot": False, "first_name": f"admin{uid}"}
+        chat = {"id": uid, "type": "private"}
+        if kind == "admin":
+            text = LOADTEST_ADMIN_TEXTS[n % len(LOADTEST_ADMIN_TEXTS)]
+            msg = {"message_id": n, "date": now, "chat": chat, "from": user, "text": text}
+            if text.startswith("/"):
+                msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+            yield kind, {"message": msg}
+        else:
+            action = rnd.choice(("post_view", "post_toggle"))
+            yield kind, {"callback_query": {
+                "id": f"lt{n}", "from": user, "chat_instance": str(uid),
+                "data": f"{action}:{rnd.choice(post_ids)}",
+                "message": {"message_id": n, "date": now, "chat": chat, "text": "📝"},
+            }}
+
+def replayed_updates(path: str):
+    """回放录下来的更新（每行一个 Telegram Update JSON）；循环播放，按钮 id 改成唯一值以便统计应答"""
+    with open(path, "rb") as fp:
+        records = [json_loads(line) for line in fp if line.strip()]
+    if not records:
+        raise ValueError(f"{path} 里没有更新")
+    n = 0
+    while True:
+        for rec in records:
+            n += 1
+            upd = copy.deepcopy(rec)
+            if "callback_query" in upd:
+                upd["callback_query"]["id"] = f"lt{n}"
+                yield "callback", upd
+            else:
+                msg = upd.get("message") or {}
+                yield ("admin" if (msg.get("chat") or {}).get("type") == "private" else "chatter"), upd
+
+def process_rss(pid: int) -> Optional[float]:
+    """进程常驻内存（MB）；只在 Linux 上可用"""
+    try:
+        with open(f"/proc/{pid}/status", encoding="ascii") as fp:
+            for line in fp:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def free_port() -> int:
+    with socket.socket() as sk:
+        sk.bind(("127.0.0.1", 0))
+        return sk.getsockname()[1]
+
+async def wait_port(port: int, proc, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.returncode is not None:
+            raise RuntimeError(f"机器人进程已退出（code {proc.returncode}）")
+        try:
+            _, w = await asyncio.open_connection("127.0.0.1", port)
+            w.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"机器人 {timeout:g}s 内没有开始监听 {port}")
+
+async def run_loadtest(args) -> str:
+    mix = parse_mix(args.mix)
+    data_dir = Path(tempfile.mkdtemp(prefix="loadtest_"))
+    admins = [LOADTEST_ADMIN_BASE + i for i in range(max(1, args.admins))]
+    posts = sample_posts(max(1, args.posts), max(1, args.groups))
+    for p in posts:
+        # 全部改成远期定时帖，点“启用”不会在测试期间真的触发群发
+        p.update(type="schedule", send_time="2099-01-01T00:00:00", job_name=f"schedule_{p['id']}")
+        p.pop("recurrence", None)
+        p.pop("next_fire", None)
+    groups = sorted({cid for p in posts for cid in p["groups"]})
+    (data_dir / "posts.json").write_bytes(json_dumps(posts))
+    (data_dir / "groups.json").write_bytes(json_dumps({cid: f"group{cid}" for cid in groups}))
+    if args.replay:
+        stream = replayed_updates(args.replay)
+    else:
+        stream = synthetic_updates(mix, admins, [p["id"] for p in posts], groups)
+
+    api = FakeBotApi(args.api_latency_ms / 1000)
+    await api.start()
+    port = free_port()
+    env = dict(os.environ,
+               BOT_TOKEN=LOADTEST_TOKEN, WEBHOOK_BASE="https://loadtest.invalid", PORT=str(port),
+               BOT_API_URL=f"http://127.0.0.1:{api.port}/bot", DATA_DIR=str(data_dir),
+               ADMIN_IDS=",".join(map(str, admins)), SENDER_TOKENS="",
+               CONCURRENT_UPDATES=str(args.concurrent))
+    log_path = data_dir / "bot.log"
+    with open(log_path, "wb") as log_fp:
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, str(Path(__file__).resolve()), env=env, stdout=log_fp, stderr=log_fp)
+    try:
+        await wait_port(port, proc)
+        rss = [process_rss(proc.pid)]
+        url = f"http://127.0.0.1:{port}/telegram/webhook/{LOADTEST_TOKEN}"
+        report = await _drive_load(args, url, stream, api, proc, rss)
+    finally:
+        if proc.returncode is None:
+            proc.terminate()
+            try:
+                await asyncio.wait_for(proc.wait(), 15)
+            except asyncio.TimeoutError:
+                proc.kill()
+        api.stop()
+        if args.keep:
+            print(f"数据目录和机器人日志保留在 {data_dir}", file=sys.stderr)
+        else:
+            shutil.rmtree(data_dir, ignore_errors=True)
+    return report
+
+async def _drive_load(args, url: str, stream, api: FakeBotApi, proc, rss: List[Optional[float]]) -> str:
+    total = max(1, int(args.rate * args.duration))
+    ingest = RollingStats(total)
+    handled = RollingStats(total)
+    kinds: Dict[str, int] = {}
+    pending_cb: Dict[str, float] = {}   # callback id -> 计划发出时刻
+    res = {"ok": 0, "failed": 0, "last": 0.0}
+    limits = httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections)
+    client = httpx.AsyncClient(limits=limits, timeout=30)
+
+    async def post(body: bytes, t_sched: float):
+        # 延迟从“计划发出时刻”算起：发不出去排队的时间也算进去，不会因为压测端变慢而显得更快
+        try:
+            r = await client.post(url, content=body, headers={"Content-Type": "application/json"})
+            ok = r.status_code == 200
+        except httpx.HTTPError:
+            ok = False
+        done = time.perf_counter()
+        res["ok" if ok else "failed"] += 1
+        res["last"] = max(res["last"], done)
+        ingest.add(done - t_sched)
+
+    async def sample_memory():
+        while True:
+            await asyncio.sleep(1)
+            rss.append(process_rss(proc.pid))
+
+    mem_task = asyncio.create_task(sample_memory())
+    tasks = []
+    t0 = time.perf_counter()
+    for i in range(total):
+        t_sched = t0 + i / args.rate
+        delay = t_sched - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        kind, upd = next(stream)
+        upd["update_id"] = i + 1
+        kinds[kind] = kinds.get(kind, 0) + 1
+        if kind == "callback":
+            pending_cb[upd["callback_query"]["id"]] = t_sched
+        tasks.append(asyncio.create_task(post(json_dumps(upd), t_sched)))
+    send_end = time.perf_counter()
+    await asyncio.gather(*tasks)
+
+    # 等机器人把积压的按钮点击处理完
+    deadline = time.perf_counter() + args.drain
+    while time.perf_counter() < deadline and not pending_cb.keys() <= api.answered.keys():
+        await asyncio.sleep(0.1)
+    for cb_id, t_sched in pending_cb.items():
+        if cb_id in api.answered:
+            handled.add(api.answered[cb_id] - t_sched)
+    rss.append(process_rss(proc.pid))
+    mem_task.cancel()
+    await client.aclose()
+
+    span = max(1e-9, res["last"] - t0)
+    mix = "，".join(f"{k} {n}" for k, n in sorted(kinds.items()))
+    lines = [
+        f"负载测试：目标 {args.rate:g} 条/秒 × {args.duration:g}s（{mix}；{args.replay or '合成更新'}）",
+        f"发出 {total} 条用时 {send_end - t0:.1f}s，入口接收成功 {res['ok']}，失败 {res['failed']}，"
+        f"实际 {res['ok'] / span:.1f} 条/秒",
+        f"入口延迟（计划发出 → webhook 返回 200）：{ingest.summary()}",
+    ]
+    if pending_cb:
+        lines.append(f"按钮处理延迟（计划发出 → answerCallbackQuery）：已应答 {handled.count}/{len(pending_cb)}，"
+                     f"{handled.summary() if handled.count else '无'}")
+    calls = sorted(api.calls.items(), key=lambda kv: -kv[1])
+    lines.append("出站请求：" + ("，".join(f"{m} {n}" for m, n in calls) or "无"))
+    mem = [m for m in rss if m is not None]
+    if mem:
+        lines.append(f"内存（RSS）：启动 {mem[0]:.1f}MB → 峰值 {max(mem):.1f}MB → 结束 {mem[-1]:.1f}MB"
+                     f"（{mem[-1] - mem[0]:+.1f}MB）")
+    else:
+        lines.append("内存（RSS）：当前系统不支持读取")
+    return "\n".join(lines)
+
+# =========================
+# 命令行（不带参数则启动机器人）
+# =========================
+def cli(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(
+        prog="群发机器人.py",
+        description="BG678 群发机器人命令行工具（不带参数运行则启动 Webhook 机器人）"
+    )
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_exp = sub.add_parser("export", help="导出 groups / posts 为 JSONL")
+    p_exp.add_argument("kind", choices=tuple(EXPORTERS))
+    p_exp.add_argument("file", nargs="?", default="-", help="输出文件，默认 - (stdout)")
+
+    p_imp = sub.add_parser(
+        "import",
+        help="从 JSONL 导入 groups / posts（posts 按 id 覆盖，下次启动时注册任务）。"
+             "只能在机器人停止时运行：机器人内存里有一份数据，下次落盘会覆盖掉导入；运行中请在私聊里发送文件导入"
+    )
+    p_imp.add_argument("kind", choices=tuple(IMPORTERS))
+    p_imp.add_argument("file", help="输入文件，- 表示 stdin")
+    p_imp.add_argument("--force", action="store_true", help="不检查机器人是否在运行（pid 文件误判时用）")
+
+    p_dry = sub.add_parser("dryrun", help="按 posts.json 预演帖子下一次发送的时间线（不会发送）")
+    p_dry.add_argument("post_ids", nargs="*", help="要预演的帖子 ID，默认全部启用中的帖子")
+    p_dry.add_argument("--posts", default=str(POSTS_FILE), help="posts.json 路径")
+    p_dry.add_argument("--rate", type=float, default=SEND_RATE_PER_SEC, help="全局速率（条/秒）")
+    p_dry.add_argument("--group-rate", type=int, default=GROUP_RATE_PER_MIN, help="单群速率（条/分钟）")
+    p_dry.add_argument("--workers", type=int, default=BROADCAST_WORKERS, help="并发发送数")
+    p_dry.add_argument("--latency-ms", type=int, default=SIMULATE_LATENCY_MS, help="单次请求耗时估算")
+
+    p_bench = sub.add_parser("bench-json", help="比较各 JSON 编解码 / 缩进与紧凑格式的速度和文件大小")
+    p_bench.add_argument("--posts", type=int, default=1000, help="生成多少个示例帖子")
+    p_bench.add_argument("--groups", type=int, default=300, help="示例群数量")
+    p_bench.add_argument("--rounds", type=int, default=20, help="每项重复次数")
+    p_bench.add_argument("--file", help="改用现有的 posts.json 测试")
+
+    p_load = sub.add_parser("loadtest", help="本地启动机器人 + Bot API 替身，按设定速率回放更新，测入口吞吐 / 延迟 / 内存")
+    p_load.add_argument("--rate", type=float, default=100, help="每秒发出多少条更新")
+    p_load.add_argument("--duration", type=float, default=30, help="持续秒数")
+    p_load.add_argument("--mix", default="chatter=80,admin=10,callback=10", help="合成更新的比例")
+    p_load.add_argument("--replay", help="改为循环回放录下的更新（JSONL，每行一个 Update）")
+    p_load.add_argument("--admins", type=int, default=3, help="模拟的管理员人数")
+    p_load.add_argument("--posts", type=int, default=50, help="预置帖子数")
+    p_load.add_argument("--groups", type=int, default=200, help="预置群数")
+    p_load.add_argument("--api-latency-ms", type=float, default=0, help="Bot API 替身每次响应前等待的毫秒数")
+    p_load.add_argument("--connections", type=int, default=64, help="压测端到 webhook 的最大连接数")
+    p_load.add_argument("--concurrent", type=int, default=CONCURRENT_UPDATES, help="传给机器人的 CONCURRENT_UPDATES")
+    p_load.add_argument("--drain", type=float, default=30, help="发完后最多再等多少秒让机器人处理完积压")
+    p_load.add_argument("--keep", action="store_true", help="保留临时数据目录和机器人日志")
+
+    args = parser.parse_args(argv)
+
+    if args.cmd == "export":
+        if args.file == "-":
+            n = EXPORTERS[args.kind](sys.stdout)
+        else:
+            with open(args.file, "w", encoding="utf-8") as fp:
+                n = EXPORTERS[args.kind](fp)
+        print(f"导出 {args.kind}：{n} 条", file=sys.stderr)
+        return 0
+
+    if args.cmd == "import":
+        pid = running_bot_pid()
+        if pid and not args.force:
+            print(f"机器人正在运行（pid {pid}，{PID_FILE}），导入会在它下次落盘时被覆盖。"
+                  f"请先停止机器人，或在私聊里把文件发给机器人导入。", file=sys.stderr)
+            return 1
+        if args.file == "-":
+            stats = IMPORTERS[args.kind](sys.stdin)
+        else:
+            stats = import_file(args.kind, args.file)
+        print(fmt_import_report(args.kind, stats), file=sys.stderr)
+        return 1 if stats["bad"] else 0
+
+    if args.cmd == "dryrun":
+        with open(args.posts, "rb") as fp:
+            posts = json_loads(fp.read())
+        now = now_local()
+        targets = [p for p in posts if not args.post_ids or p.get("id") in args.post_ids]
+        for p in targets:
+            fire_at = post_fire_time(p, now)
+            if not fire_at:
+                print(f"[{p.get('id')}] 已停用或没有后续发送时间，跳过\n")
+                continue
+            print(f"[{p.get('id')}] {p.get('type')}")
+            print(dry_run_report(
+                p.get("groups", []), fire_at, posts, exclude_id=p.get("id"), weight=p.get("weight", 1),
+                rate=args.rate, group_rate=args.group_rate, workers=args.workers, latency_ms=args.latency_ms
+            ))
+        return 0
+
+    if args.cmd == "bench-json":
+        if args.file:
+            with open(args.file, "rb") as fp:
+                posts = json_loads(fp.read())
+        else:
+            posts = sample_posts(args.posts, args.groups)
+        print(bench_json(posts, max(1, args.rounds)))
+        return 0
+
+    if args.cmd == "loadtest":
+        if args.rate <= 0 or args.duration <= 0:
+            parser.error("--rate 和 --duration 必须大于 0")
+        try:
+            parse_mix(args.mix)
+        except ValueError as e:
+            parser.error(str(e))
+        print(asyncio.run(run_loadtest(args)))
+        return 0
+
+    return 2
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(cli(sys.argv[1:]))
     main()